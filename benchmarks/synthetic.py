@@ -0,0 +1,78 @@
+"""Generators of synthetic features and step definitions, for benchmarks.
+
+A registry is a set of givens, whens and thens bags (as create_collector
+fills) of step definitions that do nothing. Its definitions come in the
+shapes rule files use: plain text, text followed by captured arguments,
+captured arguments in the middle of the text, and patterns that start with
+a group, so that every way StepIndex finds candidates is exercised. The
+number in the text of each keeps them from matching each other's steps.
+
+Features are made up of steps that each match exactly one definition of
+the registry, picked at random (from a fixed seed, so the same arguments
+always generate the same text)."""
+
+import os
+import re
+import sys
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pycucumber.ast_nodes import Condition, Action, Result
+
+def noop(*args):
+    pass
+
+# (pattern, step text, number of arguments) for each shape of definition,
+# filled in with the number of the definition
+SHAPES = [
+    (r"thing %d is ready", "thing %d is ready", 0),
+    (r"the count of %d is (\d+)", "the count of %d is 42", 1),
+    (r"user %d logs in as \"([^\"]*)\" with (\w+)", "user %d logs in as \"admin\" with password", 2),
+    (r"(\w+) has %d items?", "basket has %d items", 1),
+]
+
+class Registry(object):
+    """Step definitions split between the givens, whens and thens bags, and
+    the text of a step that matches each of them"""
+    def __init__(self, definitions):
+        self.bags = {Condition: [], Action: [], Result: []}
+        # (step type, step text) for every definition
+        self.steps = []
+        kinds = [Condition, Action, Result]
+        for number in range(definitions):
+            (pattern, text, arguments) = SHAPES[number % len(SHAPES)]
+            kind = kinds[number % len(kinds)]
+            self.bags[kind].append((re.compile(r"%s\Z" % (pattern % number)), noop, []))
+            self.steps.append((kind, text % number))
+        self.by_kind = dict((kind, [text for (step_kind, text) in self.steps if step_kind is kind])
+                            for kind in kinds)
+
+    def visitor_args(self):
+        """Return the bags in the order TestRunner and CheckRules take them"""
+        return (self.bags[Condition], self.bags[Action], self.bags[Result])
+
+PREFIXES = {Condition: "Given", Action: "When", Result: "Then"}
+
+def feature_texts(registry, features, scenarios, steps, rows=0, seed=0):
+    """Return the text of features features, of scenarios scenarios each,
+    with a Given followed by steps pairs of When and Then, and More Examples
+    with rows rows (after the heading row) if rows is set"""
+    chooser = random.Random(seed)
+    texts = []
+    for feature in range(features):
+        lines = ["Feature: synthetic %d" % feature,
+                 "  As a benchmark",
+                 "  I want to run steps that do nothing",
+                 "  In order to measure pycucumber"]
+        for scenario in range(scenarios):
+            lines.append("  Scenario: scenario %d of feature %d" % (scenario, feature))
+            for kind in [Condition] + [Action, Result] * steps:
+                lines.append("    %s %s" % (PREFIXES[kind], chooser.choice(registry.by_kind[kind])))
+            if rows:
+                lines.append("    More Examples:")
+                lines.append("      | value | name |")
+                for row in range(rows):
+                    lines.append("      | %d | row%d |" % (row, row))
+        texts.append("\n".join(lines) + "\n")
+    return texts
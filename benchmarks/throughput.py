@@ -0,0 +1,211 @@
+"""Benchmarks of pycucumber's own cost, phase by phase, over synthetic
+features and registries of step definitions that do nothing (see
+synthetic).
+
+For each size of registry, times separately:
+
+  parse   parsing the text of the features
+  index   building the StepIndex of each bag of step definitions
+  match   check_test on the text of every step, on freshly built indexes
+  check   a CheckRules visit of the features, with its output discarded
+  run     a TestRunner run, with its events handed to a reporter that
+          ignores them, after an untimed run that builds the indexes
+  output  formatting the events of that run with a TextReporter, to a
+          stream that discards them
+
+Each is the best of --repeat attempts. The results are printed as a table,
+and written as JSON Lines with --json, one object per phase and registry
+size. With --compare, the results are compared with those of a previous
+--json file, and the exit status is 1 if any phase has slowed down by more
+than --tolerance.
+
+Usage: python benchmarks/throughput.py [--features N] [--scenarios N] [--steps N]
+           [--rows N] [--definitions N,N,...] [--repeat N] [--json FILE] [--compare FILE]"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import json
+import platform
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pycucumber.argparse import ArgumentParser
+from pycucumber.ast_nodes import parse
+from pycucumber.ast_visitors import TestRunner, CheckRules, check_test
+from pycucumber.core import run_events
+from pycucumber.events import TEST
+from pycucumber.reporters import Reporter, TextReporter
+from pycucumber import step_matcher
+from synthetic import Registry, feature_texts
+
+# Fields that identify a result, for --compare
+KEY_FIELDS = ('phase', 'features', 'scenarios', 'steps', 'rows', 'definitions')
+
+class NullStream(object):
+    def write(self, text):
+        pass
+    def flush(self):
+        pass
+
+class RecordingReporter(Reporter):
+    """Keeps the events of a run, to be formatted separately"""
+    def __init__(self, stream):
+        Reporter.__init__(self, stream)
+        self.events = []
+
+    def report(self, event):
+        self.events.append(event)
+
+    def write(self, text):
+        pass
+
+def best_time(fn, repeat, setup=None):
+    """Return the shortest time fn took out of repeat calls, with sys.stdout
+    discarded. setup, if given, is called before each call without being
+    timed"""
+    best = None
+    for attempt in range(repeat):
+        if setup is not None:
+            setup()
+        stdout = sys.stdout
+        sys.stdout = NullStream()
+        try:
+            start = time.time()
+            fn()
+            elapsed = time.time() - start
+        finally:
+            sys.stdout = stdout
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def benchmark(registry, texts, repeat):
+    """Return (phase, seconds, count, unit) for each phase"""
+    features = [parse(unicode(text, 'utf-8')) for text in texts]
+    lines = sum(text.count("\n") for text in texts)
+    bags = registry.visitor_args()
+    steps = [(registry.bags[type(test)], test.text)
+             for feature in features for scenario in feature.scenarios for test in scenario.tests()]
+    definitions = sum(len(bag) for bag in bags)
+
+    def parse_all():
+        for text in texts:
+            parse(unicode(text, 'utf-8'))
+
+    def index_all():
+        for bag in bags:
+            step_matcher.StepIndex(bag)
+
+    def fresh_indexes():
+        # Forget the indexes, and the matches they remember
+        step_matcher._indexes.clear()
+        for bag in bags:
+            step_matcher.index_for(bag)
+
+    def match_all():
+        for (bag, text) in steps:
+            check_test(bag, text)
+
+    def check_all():
+        for feature in features:
+            run_events(feature.accept(CheckRules(*bags)), NullStream(), False, Reporter(NullStream()))
+
+    recorder = RecordingReporter(NullStream())
+    def run_all():
+        del recorder.events[:]
+        for feature in features:
+            run_events(feature.accept(TestRunner(*bags)), NullStream(), False, recorder)
+
+    def output_all():
+        reporter = TextReporter(NullStream())
+        for event in recorder.events:
+            reporter.report(event)
+
+    # One untimed run builds the indexes (and fills their caches), so that
+    # the run phase doesn't include index construction, however few the
+    # repeats
+    run_all()
+    run_time = best_time(run_all, repeat)
+    tests = sum(1 for event in recorder.events if event.kind is TEST)
+    return [('parse', best_time(parse_all, repeat), lines, 'line'),
+            ('index', best_time(index_all, repeat), definitions, 'definition'),
+            ('match', best_time(match_all, repeat, fresh_indexes), len(steps), 'step'),
+            ('check', best_time(check_all, repeat), len(steps), 'step'),
+            ('run', run_time, tests, 'test'),
+            ('output', best_time(output_all, repeat), len(recorder.events), 'event')]
+
+def key(result):
+    return tuple(result[field] for field in KEY_FIELDS)
+
+def compare(results, baseline_file, tolerance):
+    """Print how each result compares with the same one in baseline_file.
+    Returns whether none of them are slower by more than tolerance"""
+    with open(baseline_file) as baseline:
+        previous = dict((key(result), result) for result in map(json.loads, baseline) if result)
+    within = True
+    print
+    print "Compared with %s:" % baseline_file
+    for result in results:
+        before = previous.get(key(result))
+        if before is None or not before['per_unit_us']:
+            continue
+        ratio = result['per_unit_us'] / before['per_unit_us']
+        slower = ratio > 1 + tolerance
+        within = within and not slower
+        print "  %-6s %7d definitions  %6.2fx%s" % (result['phase'], result['definitions'], ratio,
+                                                   "  SLOWER" if slower else "")
+    return within
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--features', type=int, default=2)
+    parser.add_argument('--scenarios', type=int, default=100)
+    parser.add_argument('--steps', type=int, default=5,
+                        help='number of pairs of When and Then in each scenario, after a Given')
+    parser.add_argument('--rows', type=int, default=0,
+                        help='number of example rows in each scenario')
+    parser.add_argument('--definitions', default='10,1000,100000',
+                        help='comma separated sizes of registry to benchmark against')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', metavar='FILE',
+                        help='write the results to FILE as JSON Lines, or to standard output if FILE is -')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with those in FILE, written by --json')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='how much slower than in --compare a phase can be (default: %(default)s)')
+    args = parser.parse_args()
+
+    environment = {'python': platform.python_version(), 'implementation': platform.python_implementation(),
+                   'machine': platform.machine(), 'time': int(time.time())}
+    results = []
+    print "%d features x %d scenarios x %d steps, %d rows, best of %d" % (
+        args.features, args.scenarios, 1 + 2 * args.steps, args.rows, args.repeat)
+    for definitions in [int(size) for size in args.definitions.split(',')]:
+        registry = Registry(definitions)
+        texts = feature_texts(registry, args.features, args.scenarios, args.steps, args.rows)
+        for (phase, seconds, count, unit) in benchmark(registry, texts, args.repeat):
+            result = {'phase': phase, 'features': args.features, 'scenarios': args.scenarios,
+                      'steps': args.steps, 'rows': args.rows, 'definitions': definitions,
+                      'seconds': seconds, 'count': count, 'unit': unit,
+                      'per_unit_us': seconds * 1e6 / count if count else 0.0}
+            result.update(environment)
+            results.append(result)
+            print "%-6s %7d definitions  %10.3fs  %9.2f us/%s" % (phase, definitions, seconds,
+                                                                  result['per_unit_us'], unit)
+
+    if args.json:
+        out = sys.stdout if args.json == '-' else open(args.json, 'w')
+        try:
+            for result in results:
+                print >> out, json.dumps(result, sort_keys=True)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""Micro-benchmark of the cost of the Visitor framework per step.
+
+Runs CheckRules and TestRunner over a synthetic feature whose steps do
+nothing, writing to a stream that discards its output, once with walk and
+once with the nested forwarding that walk replaced, in which every event
+was passed up through the generator of each visit enclosing it. The
+forwarding baseline leaves out the extra generator TestNode.accept used to
+add for every node, so it understates the old overhead slightly.
+
+Usage: python benchmarks/visitor_overhead.py [--scenarios N] [--steps N] [--repeat N]"""
+
+import os
+import sys
+import time
+from types import GeneratorType
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pycucumber.argparse import ArgumentParser
+from pycucumber.ast_nodes import parse
+from pycucumber.ast_visitors import TestRunner, CheckRules, YieldResults
+from pycucumber.core import run_events
+from pycucumber.walker import walk
+import re
+
+class NullStream(object):
+    def write(self, text):
+        pass
+    def flush(self):
+        pass
+
+def noop(*args):
+    pass
+
+bag = [(re.compile(r"step (\d+)\Z"), noop, [])]
+
+def forwarded(gen):
+    """Deliver the events of gen the way visits did before walk, forwarding
+    the events of each nested visit through this generator"""
+    result = None
+    while True:
+        event = gen.send(result)
+        result = None
+        if type(event) is GeneratorType:
+            child = forwarded(event)
+            try:
+                while True:
+                    result = yield child.send(result)
+            except StopIteration:
+                result = None
+        else:
+            result = yield event
+
+def synthetic_feature(scenarios, steps):
+    lines = ["Feature: benchmark"]
+    for scenario in range(scenarios):
+        lines.append("  Scenario: %d" % scenario)
+        lines.append("    Given step %d" % scenario)
+        for step in range(steps):
+            lines.append("    When step %d" % step)
+            lines.append("    Then step %d" % step)
+    return parse(u"\n".join(lines) + u"\n")
+
+def print_events(gen):
+    run_events(gen, sys.stdout, False)
+
+def drain_events(gen):
+    for event in gen:
+        pass
+
+def time_run(engine, make_visitor, consume, feature, repeat):
+    best = None
+    for attempt in range(repeat):
+        visitor = make_visitor()
+        stdout = sys.stdout
+        sys.stdout = NullStream()
+        try:
+            start = time.time()
+            consume(engine(visitor.visitFeature(feature)))
+            elapsed = time.time() - start
+        finally:
+            sys.stdout = stdout
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', type=int, default=500)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    feature = synthetic_feature(args.scenarios, args.steps)
+    tests = sum(len(scenario.tests()) for scenario in feature.scenarios)
+    print "%d scenarios, %d tests, best of %d" % (args.scenarios, tests, args.repeat)
+    # Draining the events of YieldResults does next to nothing but visit, so
+    # shows the overhead of the framework itself. It needs the results left
+    # by a TestRunner
+    visitors = [('CheckRules', lambda: CheckRules(bag, bag, bag), print_events),
+                ('TestRunner', lambda: TestRunner(bag, bag, bag), print_events),
+                ('YieldResults', YieldResults, drain_events)]
+    for (name, make_visitor, consume) in visitors:
+        before = time_run(forwarded, make_visitor, consume, feature, args.repeat)
+        after = time_run(walk, make_visitor, consume, feature, args.repeat)
+        print "%-12s forwarded %6.2f us/test   walk %6.2f us/test   (%.2fx)" % (
+            name, before * 1e6 / tests, after * 1e6 / tests, before / after)
+
+if __name__ == '__main__':
+    main()
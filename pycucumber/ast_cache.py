@@ -0,0 +1,155 @@
+"""Persistent cache of parsed features.
+
+Features are stored as nested tuples of their text (which marshal can write
+and read back much faster than the text can be reparsed), in files named
+after a hash of the feature text and the version of the parser that
+produced them. The least recently used entries are removed once the cache
+grows past its size limit.
+
+The size of the cache is only measured once, when the first entry is
+stored, and kept up to date from then on with the sizes of the entries
+this cache stores, so that filling the cache doesn't scan it every time.
+Entries stored by other runs meanwhile are only counted the next time the
+cache is over its limit and has to be scanned anyway."""
+
+import os
+import sys
+import marshal
+import hashlib
+import tempfile
+from ast_nodes import (Purpose, Role, Goal, Condition, Action, Result, Step,
+                       Scenario, Feature, MoreExamples, ExampleRow, parse)
+from feature_parser import PARSER_VERSION
+
+DEFAULT_DIRECTORY = '.pycucumber_cache'
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+SUFFIX = '.ast'
+
+def text_of(node):
+    return node.text if node is not None else None
+
+def encode_scenario(scenario):
+    examples = scenario.more_examples
+    return (scenario.text,
+            [cond.text for cond in scenario.conditions],
+            [([act.text for act in step.actions], [res.text for res in step.results])
+             for step in scenario.steps],
+            (examples.header, [row.data for row in examples.rows]) if examples else None)
+
+def encode_feature(feature):
+    return (feature.text, text_of(feature.purpose), text_of(feature.role), text_of(feature.goal),
+            [encode_scenario(scenario) for scenario in feature.scenarios])
+
+def decode_scenario(data):
+    (text, conditions, steps, examples) = data
+    return Scenario(text,
+                    [Condition(cond) for cond in conditions],
+                    [Step([Action(act) for act in actions], [Result(res) for res in results])
+                     for (actions, results) in steps],
+                    MoreExamples(examples[0], [ExampleRow(row) for row in examples[1]]) if examples else None)
+
+def decode_feature(data):
+    (text, purpose, role, goal, scenarios) = data
+    return Feature(text,
+                   Purpose(purpose) if purpose is not None else None,
+                   Role(role) if role is not None else None,
+                   Goal(goal) if goal is not None else None,
+                   [decode_scenario(scenario) for scenario in scenarios])
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class FeatureCache(object):
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        # The total size of the entries, once it has been measured
+        self.size = None
+
+    def key(self, text):
+        digest = hashlib.sha1()
+        digest.update("%s:%s:%s:" % (PARSER_VERSION, marshal.version, sys.version_info[:2]))
+        digest.update(text)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def load(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as file:
+                feature = decode_feature(marshal.load(file))
+            # Loading an entry counts as using it, for the purposes of eviction
+            os.utime(path, None)
+            return feature
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def store(self, key, feature):
+        path = self.path(key)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Write to a temporary file first so that concurrent runs never
+            # see a partially written entry
+            (fd, temp_path) = tempfile.mkstemp(dir=self.directory)
+            try:
+                with os.fdopen(fd, 'wb') as file:
+                    marshal.dump(encode_feature(feature), file)
+                    size = file.tell()
+                replaced = self.entry_size(path)
+                os.rename(temp_path, path)
+            except:
+                remove(temp_path)
+                raise
+        except (IOError, OSError):
+            return
+        if self.size is None:
+            self.size = sum(entry_size for (mtime, entry_size, entry_path) in self.entries())
+        else:
+            self.size += size - replaced
+        if self.size > self.max_size:
+            self.evict()
+
+    def entry_size(self, path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_size bytes"""
+        entries = sorted(self.entries())
+        total = sum(size for (mtime, size, path) in entries)
+        for (mtime, size, path) in entries:
+            if total <= self.max_size:
+                break
+            remove(path)
+            total -= size
+        self.size = total
+
+    def parse(self, text):
+        """Return the Feature for the utf-8 encoded text, parsing it only if
+        it isn't already in the cache"""
+        key = self.key(text)
+        feature = self.load(key)
+        if feature is None:
+            feature = parse(unicode(text, 'utf-8'))
+            self.store(key, feature)
+        return feature
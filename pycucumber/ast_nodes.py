@@ -3,9 +3,11 @@ from pyparsing import ZeroOrMore, OneOrMore, LineStart, Optional, Suppress
 from pyparsing import Group, Keyword, ParserElement, Combine, Word, printables
 from pyparsing import LineEnd, White, alphanums, CharsNotIn, delimitedList, Regex
 from pyparsing import Or, Empty, restOfLine, StringStart, StringEnd, replaceWith, SkipTo,traceParseAction, Literal
+import itertools
+from walker import walk
 
 def create(type):
-    return lambda t: [type(t)]
+    return lambda t: [type.from_tokens(t)]
 
 ParserElement.setDefaultWhitespaceChars(" \t\r")
 
@@ -58,8 +60,24 @@ def grammar():
     feature.ignore(comment)
     return feature
 
+_grammar = None
+def parse_pyparsing(text):
+    global _grammar
+    if _grammar is None:
+        _grammar = grammar()
+    return _grammar.parseString(text, True)["feature"][0]
+
 def parse(text):
-    return grammar().parseString(text, True)["feature"][0]
+    """Parse the text of a feature file into a Feature.
+
+    Uses the line-oriented parser from feature_parser, and falls back to the
+    pyparsing grammar if that parser rejects the text, so that syntax errors
+    are still reported as pyparsing ParseExceptions"""
+    from feature_parser import parse_feature, FeatureSyntaxError
+    try:
+        return parse_feature(text)
+    except FeatureSyntaxError:
+        return parse_pyparsing(text)
 
 class TestNode(object):
     def children(self):
@@ -69,15 +87,15 @@ class TestNode(object):
     def __neq__(self, other):
         return not self == other
     def accept(self, visitor, *args, **kwargs):
-        gen = self.get_gen(visitor, *args, **kwargs)
-        result = None
-        while True:
-            result = yield gen.send(result)
+        return walk(self.get_gen(visitor, *args, **kwargs))
 
 
 class Purpose(TestNode):
-    def __init__(self, tokens):
-        self.text = tokens["text"]
+    def __init__(self, text):
+        self.text = text
+    @classmethod
+    def from_tokens(cls, tokens):
+        return cls(tokens["text"])
     def get_gen(self, visitor, *args, **kwargs):
         return visitor.visitPurpose(self, *args, **kwargs)
     def __eq__(self, other):
@@ -85,8 +103,11 @@ class Purpose(TestNode):
 
 
 class Role(TestNode):
-    def __init__(self, tokens):
-        self.text = tokens["text"]
+    def __init__(self, text):
+        self.text = text
+    @classmethod
+    def from_tokens(cls, tokens):
+        return cls(tokens["text"])
     def get_gen(self, visitor, *args, **kwargs):
         return visitor.visitRole(self, *args, **kwargs)
     def __eq__(self, other):
@@ -94,8 +115,11 @@ class Role(TestNode):
 
 
 class Goal(TestNode):
-    def __init__(self, tokens):
-        self.text = tokens["text"]
+    def __init__(self, text):
+        self.text = text
+    @classmethod
+    def from_tokens(cls, tokens):
+        return cls(tokens["text"])
     def get_gen(self, visitor, *args, **kwargs):
         return visitor.visitGoal(self, *args, **kwargs)
     def __eq__(self, other):
@@ -103,9 +127,12 @@ class Goal(TestNode):
 
 
 class Condition(TestNode):
-    def __init__(self, tokens):
-        self.text = tokens["text"]
+    def __init__(self, text):
+        self.text = text
         self.result = None
+    @classmethod
+    def from_tokens(cls, tokens):
+        return cls(tokens["text"])
     def get_gen(self, visitor, *args, **kwargs):
         return visitor.visitCondition(self, *args, **kwargs)
     def __eq__(self, other):
@@ -113,9 +140,12 @@ class Condition(TestNode):
 
 
 class Action(TestNode):
-    def __init__(self, tokens):
-        self.text = tokens["text"]
+    def __init__(self, text):
+        self.text = text
         self.result = None
+    @classmethod
+    def from_tokens(cls, tokens):
+        return cls(tokens["text"])
     def get_gen(self, visitor, *args, **kwargs):
         return visitor.visitAction(self, *args, **kwargs)
     def __eq__(self, other):
@@ -123,9 +153,12 @@ class Action(TestNode):
 
 
 class Result(TestNode):
-    def __init__(self, tokens):
-        self.text = tokens["text"]
+    def __init__(self, text):
+        self.text = text
         self.result = None
+    @classmethod
+    def from_tokens(cls, tokens):
+        return cls(tokens["text"])
     def get_gen(self, visitor, *args, **kwargs):
         return visitor.visitResult(self, *args, **kwargs)
     def __eq__(self, other):
@@ -133,10 +166,13 @@ class Result(TestNode):
 
 
 class Step(TestNode):
-    def __init__(self, tokens):
-        self.actions = tokens["actions"].asList()
-        self.results = tokens["results"].asList()
+    def __init__(self, actions, results):
+        self.actions = actions
+        self.results = results
         self.result = None
+    @classmethod
+    def from_tokens(cls, tokens):
+        return cls(tokens["actions"].asList(), tokens["results"].asList())
     def get_gen(self, visitor, *args, **kwargs):
         return visitor.visitStep(self, *args, **kwargs)
     def children(self):
@@ -144,42 +180,88 @@ class Step(TestNode):
 
 
 class Feature(TestNode):
-    def __init__(self, tokens):
-        self.text = tokens["text"]
-        self.purpose = tokens["purpose"][0] if "purpose" in tokens else None
-        self.role = tokens["role"][0] if "role" in tokens else None
-        self.goal = tokens["goal"][0] if "goal" in tokens else None
-        self.scenarios = tokens["scenarios"].asList()
+    def __init__(self, text, purpose, role, goal, scenarios):
+        self.text = text
+        self.purpose = purpose
+        self.role = role
+        self.goal = goal
+        self.scenarios = scenarios
         self.result = None
 
+    @classmethod
+    def from_tokens(cls, tokens):
+        return cls(tokens["text"],
+                   tokens["purpose"][0] if "purpose" in tokens else None,
+                   tokens["role"][0] if "role" in tokens else None,
+                   tokens["goal"][0] if "goal" in tokens else None,
+                   tokens["scenarios"].asList())
+
     def get_gen(self, visitor, *args, **kwargs):
         return visitor.visitFeature(self, *args, **kwargs)
 
-    def children(self):
-        children = []
+    def header(self):
+        header = []
         if self.purpose:
-            children.append(self.purpose)
+            header.append(self.purpose)
         if self.role:
-            children.append(self.role)
+            header.append(self.role)
         if self.goal:
-            children.append(self.goal)
-        children.extend(self.scenarios)
-        return children
+            header.append(self.goal)
+        return header
+
+    def children(self):
+        return self.header() + list(self.scenarios)
 
     def __eq__(self, other):
         return self.text == other.text and self.children() == other.children()
 
+class StreamingFeature(Feature):
+    """A Feature whose scenarios are an iterator rather than a list.
+
+    Each scenario is produced as the previous one finishes being visited and
+    is not retained afterwards, so a StreamingFeature can only be visited once"""
+    def children(self):
+        return itertools.chain(self.header(), self.scenarios)
+
 class Scenario(TestNode):
-    def __init__(self, tokens):
-        self.text = tokens["text"]
-        self.conditions = tokens["conditions"].asList() if "conditions" in tokens else []
-        self.steps = tokens["steps"].asList()
-        self.more_examples = tokens["more_examples"][0] if "more_examples" in tokens else None
+    def __init__(self, text, conditions, steps, more_examples):
+        self.text = text
+        self.conditions = conditions
+        self.steps = steps
+        self.more_examples = more_examples
         self.result = None
 
+    @classmethod
+    def from_tokens(cls, tokens):
+        return cls(tokens["text"],
+                   tokens["conditions"].asList() if "conditions" in tokens else [],
+                   tokens["steps"].asList(),
+                   tokens["more_examples"][0] if "more_examples" in tokens else None)
+
     def get_gen(self, visitor, *args, **kwargs):
         return visitor.visitScenario(self, *args, **kwargs)
 
+    def with_results(self, results):
+        """Return a copy of the scenario, without its More Examples, whose tests
+        have the results in results (in the order returned by tests())"""
+        results = iter(results)
+        def copy(test):
+            node = type(test)(test.text)
+            node.result = results.next()
+            return node
+        conditions = [copy(cond) for cond in self.conditions]
+        steps = [Step([copy(act) for act in step.actions], [copy(res) for res in step.results])
+                 for step in self.steps]
+        return Scenario(self.text, conditions, steps, None)
+
+    def tests(self):
+        """Return the conditions, actions and results of the scenario in the order they run"""
+        tests = list(self.conditions)
+        for step in self.steps:
+            tests.extend(step.actions)
+            tests.extend(step.results)
+        return tests
+
     def children(self):
         children = []
         children.extend(self.conditions)
@@ -192,11 +274,15 @@ class Scenario(TestNode):
         return self.text == other.text and self.children() == other.children()
 
 class MoreExamples(TestNode):
-    def __init__(self, tokens):
-        self.header = tokens["header"].asList()
-        self.rows = tokens["rows"].asList()
+    def __init__(self, header, rows):
+        self.header = header
+        self.rows = rows
         self.result = None
 
+    @classmethod
+    def from_tokens(cls, tokens):
+        return cls(tokens["header"].asList(), tokens["rows"].asList())
+
     def get_gen(self, visitor, *args, **kwargs):
         return visitor.visitMoreExamples(self, *args, **kwargs)
 
@@ -208,13 +294,32 @@ class MoreExamples(TestNode):
 
 
 class ExampleRow(TestNode):
-    def __init__(self, tokens):
-        self.data = tokens.asList()
+    def __init__(self, data):
+        self.data = data
         self.result = None
-        self.scenario = None
+        self.template = None
+        self.results = None
+
+    @classmethod
+    def from_tokens(cls, tokens):
+        return cls(tokens.asList())
+
+    @property
+    def scenario(self):
+        """The scenario this row was run as, with the results of each of its
+        tests. Rows only store their results, so the scenario is rebuilt
+        from the template each time it is asked for"""
+        if self.template is None:
+            return None
+        scenario = self.template.with_results(self.results)
+        scenario.result = self.result
+        return scenario
 
     def get_gen(self, visitor, *args, **kwargs):
         return visitor.visitExampleRow(self, *args, **kwargs)
 
     def children(self):
         return []
+
+    def __eq__(self, other):
+        return self.data == other.data
@@ -1,8 +1,13 @@
 from __future__ import with_statement
 
+import inspect
 import traceback
-import copy
 import contextlib
+import coroutines
+from step_matcher import index_for
+from ast_nodes import Condition, Action, Result
+from events import (Event, FEATURE, HEADER, SCENARIO, TEST, TEST_RESULT, MORE_EXAMPLES, ROW, ROW_RESULT,
+                    SCENARIO_END)
 
 class Visitor(object):
     def empty_generator(*args, **kwargs):
@@ -10,8 +15,7 @@ class Visitor(object):
 
     def yield_child_events(self, node):
         for child in node.children():
-            for event in child.accept(self):
-                yield event
+            yield child.get_gen(self)
 
     visitFeature = yield_child_events
     visitScenario = yield_child_events
@@ -36,12 +40,7 @@ def RegisterScenarioContextManager(manager):
     scenario_managers.append(manager())
 
 def get_matches(bag, line):
-    matches = []
-    for (regex, fn, name) in bag:
-        match = regex.match(line)
-        if (match):
-            matches.append((fn, match.groups()))
-    return matches
+    return index_for(bag).matches(line)
 
 def check_test(bag, line):
     matches = get_matches(bag, line)
@@ -52,6 +51,47 @@ def check_test(bag, line):
     (fn, args) = matches[0]
     return WellFormed(fn, args)
 
+# Called around every call of a step definition, by way of their start(fn)
+# and stop(fn, started) methods, where started is what start returned. See
+# timing.StepTimer and profiling.StepProfiler
+step_hooks = []
+
+def call_test(fn, args, line):
+    hooks = step_hooks
+    if hooks:
+        started = [hook.start(fn) for hook in hooks]
+    try:
+        value = fn(*args)
+    except Exception, e:
+        result = Failed("%s" % traceback.format_exc(e), line)
+    else:
+        result = run_coroutine(value, line) if inspect.isgenerator(value) else Succeeded(line)
+    if hooks:
+        for (hook, hook_started) in reversed(zip(hooks, started)):
+            hook.stop(fn, hook_started)
+    return result
+
+def run_coroutine(coroutine, line):
+    """Run the coroutine returned by a step definition to completion. If a
+    Scheduler is already running on this thread, return a Pending for it to
+    run instead, so that other scenarios can run while the step waits"""
+    if coroutines.running() is not None:
+        return Pending(coroutine, line)
+    return coroutine_result(coroutines.run(coroutine), line)
+
+def coroutine_result(task, line):
+    if task.exc_info is None:
+        return Succeeded(line)
+    return Failed("".join(traceback.format_exception(*task.exc_info)), line)
+
+class Pending(object):
+    """A coroutine step that has yet to be run by the running Scheduler.
+    Whatever is driving the visitor events must spawn the coroutine and send
+    back the coroutine_result of its Task in place of the Pending"""
+    def __init__(self, coroutine, line):
+        self.coroutine = coroutine
+        self.line = line
+
 def run_test(bag, line, arg_queue = None):
     syntax_check = check_test(bag, line)
     if not syntax_check.is_success():
@@ -60,10 +100,54 @@ def run_test(bag, line, arg_queue = None):
         args = [arg_queue.pop(0) for arg in syntax_check.args]
     else:
         args = syntax_check.args
-    try:
-        syntax_check.fn(*args)
-    except Exception, e:
-        return Failed("%s" % traceback.format_exc(e), line)
+    return call_test(syntax_check.fn, args, line)
+
+class OutlineTemplate(object):
+    """The tests of a scenario with More Examples, resolved against the step
+    definitions once so that each example row only has to bind its values
+    to the arguments they capture"""
+    def __init__(self, scenario, bags):
+        self.scenario = scenario
+        self.checks = [check_test(bags[type(test)], test.text) for test in scenario.tests()]
+
+    def bind(self, data):
+        return RowBinding(self.checks, data)
+
+class RowBinding(object):
+    """The values of one example row, handed out to the arguments of each
+    test in turn, and the results of running each test with them"""
+    def __init__(self, checks, data):
+        self.checks = iter(checks)
+        self.values = data
+        self.next_value = 0
+        self.results = []
+
+    def next_check(self):
+        """Return the resolved check for the next test of the scenario. Must
+        be called for every test, in order, whether or not it is run"""
+        return self.checks.next()
+
+    def bind(self, args):
+        """Return args with the next row values in place of the template values"""
+        args = list(args)
+        # Arguments capture successive row values for as long as there are
+        # any left, and keep the value from the template text after that
+        for position in range(len(args)):
+            if self.next_value < len(self.values):
+                args[position] = self.values[self.next_value]
+                self.next_value += 1
+        return args
+
+    def run(self, syntax_check, line):
+        if not syntax_check.is_success():
+            return syntax_check
+        return call_test(syntax_check.fn, self.bind(syntax_check.args), line)
+
+def scenario_result(results, line):
+    """Return the first result in results that wasn't a success, or Succeeded"""
+    for result in results:
+        if result is not None and not result.is_success():
+            return result
     return Succeeded(line)
 
 class Unimplemented(object):
@@ -170,7 +254,7 @@ def format_result(result, is_first, indent_str):
     return format_test(result, "Then", is_first, indent_str)
 
 def format_row(row_data):
-    return "|%s|" % "|".join(row_data), example.result
+    return u"|%s|\n" % u"|".join(row_data)
 
 def format_more_examples(examples):
     return 'More Examples:\n'
@@ -189,121 +273,156 @@ class IndentManager:
     def indented_line(self, line):
         return u"%s%s" % (self.indent_str*self.indent, line)
 
-class TestRunner(Visitor):
-    def __init__(self, conditions, actions, results, output_file = None):
-        self.cond_funcs = conditions
-        self.act_funcs = actions
-        self.res_funcs = results
-        self.output_file = output_file
+class ExecutionContext(object):
+    """The state of running one scenario (or one example row), kept apart
+    from the TestRunner so that it can run several scenarios at once"""
+    def __init__(self, indent=0, row=None, template=None):
         self.indenter = IndentManager()
-
-    def visitPurpose(self, purpose, arg_queue=None):
-        yield self.indenter.indented_line(format_purpose(purpose))
-
-    def visitGoal(self, goal, arg_queue=None):
-        yield self.indenter.indented_line(format_goal(goal))
-
-    def visitRole(self, role, arg_queue=None):
-        yield self.indenter.indented_line(format_role(role))
-
-    def visitChildren(self, node, arg_queue=None):
-        with self.indenter:
-            for child in node.children():
-                gen = child.accept(self, arg_queue)
-                result = None
-                try:
-                    while True:
-                        result = yield gen.send(result)
-                except StopIteration:
-                    pass
-
-    def visitFeature(self, feature):
-        yield self.indenter.indented_line(format_feature(feature))
-        with contextlib.nested(*(feature_managers + [self.indenter])):
-            gen = self.visitChildren(feature)
-            result = None
-            while True:
-                result = yield gen.send(result)
-
-    def visitScenario(self, scenario, arg_queue=None):
+        self.indenter.indent = indent
+        self.row = row
+        self.template = template
+        self.scenario = None
         self.execute_next_condition = True
         self.execute_next_action = True
         self.execute_next_result = True
-        self.current_scenario = scenario
-
-        yield self.indenter.indented_line(format_scenario(scenario))
         self.first_cond = True
-
-        with contextlib.nested(*(scenario_managers + [self.indenter])):
-            gen = self.visitChildren(scenario, arg_queue)
-            result = None
-            while True:
-                result = yield gen.send(result)
-
-    def visitStep(self, step, arg_queue=None):
         self.first_action = True
         self.first_result = True
-        gen = self.visitChildren(step, arg_queue)
-        result = None
-        while True:
-            result = yield gen.send(result)
 
-    def visitCondition(self, cond, arg_queue=None):
-        yield self.indenter.indented_line(
-            format_condition(cond, self.first_cond, self.indenter.indent_str))
-        cond.result = yield lambda: run_test(self.cond_funcs, cond.text, arg_queue) if self.execute_next_condition else Skipped(cond.text)
-        if not cond.result.is_success():
-            self.execute_next_condition = False
-            self.execute_next_action = False
-            self.execute_next_result = False
-
-        yield format_test_result(cond.result)
-        self.first_cond = False
-
-    def visitAction(self, act, arg_queue=None):
-        yield self.indenter.indented_line(
-            format_action(act, self.first_action, self.indenter.indent_str))
-
-        act.result = yield lambda: run_test(self.act_funcs, act.text, arg_queue) if self.execute_next_action else Skipped(act.text)
-        if not act.result.is_success():
-            self.execute_next_action = False
-            self.execute_next_result = False
-
-        yield format_test_result(act.result)
-        self.first_action = False
-
-    def visitResult(self, res, arg_queue=None):
-        yield self.indenter.indented_line(
-            format_result(res, self.first_result, self.indenter.indent_str))
-
-        res.result = yield lambda: run_test(self.res_funcs, res.text, arg_queue) if self.execute_next_result else Skipped(res.text)
-        if not res.result.is_success():
-            self.execute_next_action = False
+    def nested(self, row=None, template=None):
+        """Return a fresh context that starts at the current indentation"""
+        return ExecutionContext(self.indenter.indent, row, template)
 
-        yield format_test_result(res.result)
-        self.first_result = False
-
-    def visitMoreExamples(self, examples, arg_queue=None):
-        yield self.indenter.indented_line(format_more_examples(examples))
-        with self.indenter:
-            gen = self.visitChildren(examples, arg_queue)
-            result = None
-            while True:
-                result = yield gen.send(result)
-
-    def visitExampleRow(self, example, arg_queue):
-        yield self.indenter.indented_line(format_row(example))
-
-        example.scenario = copy.deepcopy(self.current_scenario)
-        example.scenario.more_examples = None
-        gen = self.visitScenario(example.scenario, copy.deepcopy(example.data))
-        result = None
-        while True:
-            result = yield gen.send(result)
-
-        example.result = example.scenario.result
-
-        yield self.indenter.indented_line(format_result(example.result))
+class TestRunner(Visitor):
+    def __init__(self, conditions, actions, results, output_file = None):
+        self.cond_funcs = conditions
+        self.act_funcs = actions
+        self.res_funcs = results
+        self.output_file = output_file
+        self.bags = {Condition: conditions, Action: actions, Result: results}
+        self.succeeded = True
+
+    def record_result(self, result):
+        # Only ever cleared, so that scenarios running concurrently can't
+        # overwrite each other's failures
+        if not result.is_success():
+            self.succeeded = False
+
+    def store_result(self, test, result, context):
+        if context.row is None:
+            test.result = result
+        else:
+            context.row.results.append(result)
+
+    def test_event(self, bag, test, context, execute):
+        """Return the callable that runs test (or skips it, if execute is False)"""
+        row = context.row
+        if row is None:
+            return lambda: run_test(bag, test.text) if execute else Skipped(test.text)
+        syntax_check = row.next_check()
+        return lambda: row.run(syntax_check, test.text) if execute else Skipped(test.text)
+
+    def visitPurpose(self, purpose, context):
+        yield Event(HEADER, purpose, indent=context.indenter.indent)
+
+    visitGoal = visitPurpose
+    visitRole = visitPurpose
+
+    def visitChildren(self, node, context, children=None):
+        with context.indenter:
+            for child in node.children() if children is None else children:
+                yield child.get_gen(self, context)
+
+    def visitHeader(self, feature, context):
+        """Visit the Purpose, Role and Goal of feature, at the current indent"""
+        for child in feature.header():
+            yield child.get_gen(self, context)
+
+    def visitFeatureChildren(self, feature, context):
+        return self.visitChildren(feature, context)
+
+    def visitFeature(self, feature, context=None):
+        if context is None:
+            context = ExecutionContext()
+        yield Event(FEATURE, feature, indent=context.indenter.indent)
+        with contextlib.nested(*(feature_managers + [context.indenter])):
+            yield self.visitFeatureChildren(feature, context)
+
+    def visitScenario(self, scenario, context):
+        context = context.nested(context.row)
+        context.scenario = scenario
+
+        yield Event(SCENARIO, scenario, indent=context.indenter.indent)
+
+        # Example rows run the tests of the template scenario itself, so its
+        # More Examples mustn't be visited again
+        children = None if context.row is None else scenario.conditions + scenario.steps
+        with contextlib.nested(*(scenario_managers + [context.indenter])):
+            yield self.visitChildren(scenario, context, children)
+        if context.row is None:
+            scenario.result = scenario_result((test.result for test in scenario.tests()), scenario.text)
+        yield Event(SCENARIO_END, scenario)
+
+    def visitStep(self, step, context):
+        context.first_action = True
+        context.first_result = True
+        yield self.visitChildren(step, context)
+
+    def visitCondition(self, cond, context):
+        yield Event(TEST, cond, indent=context.indenter.indent, first=context.first_cond)
+        result = yield self.test_event(self.cond_funcs, cond, context, context.execute_next_condition)
+        self.store_result(cond, result, context)
+        self.record_result(result)
+        if not result.is_success():
+            context.execute_next_condition = False
+            context.execute_next_action = False
+            context.execute_next_result = False
+
+        yield Event(TEST_RESULT, cond, result)
+        context.first_cond = False
+
+    def visitAction(self, act, context):
+        yield Event(TEST, act, indent=context.indenter.indent, first=context.first_action)
+
+        result = yield self.test_event(self.act_funcs, act, context, context.execute_next_action)
+        self.store_result(act, result, context)
+        self.record_result(result)
+        if not result.is_success():
+            context.execute_next_action = False
+            context.execute_next_result = False
+
+        yield Event(TEST_RESULT, act, result)
+        context.first_action = False
+
+    def visitResult(self, res, context):
+        yield Event(TEST, res, indent=context.indenter.indent, first=context.first_result)
+
+        result = yield self.test_event(self.res_funcs, res, context, context.execute_next_result)
+        self.store_result(res, result, context)
+        self.record_result(result)
+        if not result.is_success():
+            context.execute_next_action = False
+
+        yield Event(TEST_RESULT, res, result)
+        context.first_result = False
+
+    def visitMoreExamples(self, examples, context):
+        yield Event(MORE_EXAMPLES, examples, indent=context.indenter.indent)
+        rows_context = context.nested(template=OutlineTemplate(context.scenario, self.bags))
+        with rows_context.indenter:
+            yield self.visitChildren(examples, rows_context)
+
+    def visitExampleRow(self, example, context):
+        yield Event(ROW, example, indent=context.indenter.indent)
+
+        template = context.template
+        binding = template.bind(example.data)
+        yield self.visitScenario(template.scenario, context.nested(row=binding))
+
+        example.template = template.scenario
+        example.results = binding.results
+        example.result = scenario_result(binding.results, template.scenario.text)
+        yield Event(ROW_RESULT, example, example.result, context.indenter.indent)
 
 
 class CheckRules(Visitor):
@@ -317,13 +436,7 @@ class CheckRules(Visitor):
     def visitChildren(self, node, arg_queue=None):
         with self.indenter:
             for child in node.children():
-                gen = child.accept(self, arg_queue)
-                result = None
-                try:
-                    while True:
-                        result = yield gen.send(result)
-                except StopIteration:
-                    pass
+                yield child.get_gen(self, arg_queue)
 
     def visitPurpose(self, purpose, arg_queue=None):
         yield self.indenter.indented_line(format_purpose(purpose))
@@ -337,10 +450,7 @@ class CheckRules(Visitor):
     def visitFeature(self, feature):
         yield self.indenter.indented_line(format_feature(feature))
         with self.indenter:
-            gen = self.visitChildren(feature)
-            result = None
-            while True:
-                result = yield gen.send(result)
+            yield self.visitChildren(feature)
 
     def visitScenario(self, scenario, arg_queue=None):
         self.args_required = 0
@@ -349,18 +459,12 @@ class CheckRules(Visitor):
 
         self.first_cond = True
         with self.indenter:
-            gen = self.visitChildren(scenario, arg_queue)
-            result = None
-            while True:
-                result = yield gen.send(result)
+            yield self.visitChildren(scenario, arg_queue)
 
     def visitStep(self, step, arg_queue=None):
         self.first_action = True
         self.first_result = True
-        gen = self.visitChildren(step, arg_queue)
-        result = None
-        while True:
-            result = yield gen.send(result)
+        yield self.visitChildren(step, arg_queue)
 
     def visitCondition(self, cond, arg_queue=None):
         yield self.indenter.indented_line(
@@ -403,13 +507,10 @@ class CheckRules(Visitor):
     def visitMoreExamples(self, examples, arg_queue=None):
         yield self.indenter.indented_line(format_more_examples(examples))
         with self.indenter:
-            gen = self.visitChildren(examples, arg_queue)
-            result = None
-            while True:
-                result = yield gen.send(result)
+            yield self.visitChildren(examples, arg_queue)
 
     def visitExampleRow(self, example, arg_queue):
-        yield self.indenter.indented_line(format_row(example))
+        yield self.indenter.indented_line(format_row(example.data))
         if not self.args_accurate:
             example.result = Skipped(None)
         elif self.args_required != len(example.data):
@@ -417,7 +518,7 @@ class CheckRules(Visitor):
         else:
             example.result = WellFormed(None, None)
 
-        yield self.indenter.indented_line(format_result(example.result))
+        yield self.indenter.indented_line(format_test_result(example.result))
 
 class YieldResults(Visitor):
 
@@ -0,0 +1,102 @@
+"""Sending a command to a pycucumber serve daemon, which carries it out
+with the rules it already has loaded, and writing out what it sends back.
+
+Usage: python path/to/pycucumber/client.py [--socket PATH] COMMAND [OPTIONS]...
+
+where COMMAND and its options are what would follow the rule files on the
+runner's command line, and are interpreted in the current directory. The
+exit status is that of the command.
+
+Run this file as a script rather than with -m, so that it doesn't import
+the rest of pycucumber, which would take as long as the daemon saves. For
+the same reason, it only uses the standard library, and the daemon imports
+the protocol from it.
+
+The client sends one request frame, of JSON, and the daemon answers with
+frames of output and errors, and then one with the exit status. Every frame
+is a channel byte and a length, followed by that many bytes."""
+
+import os
+import sys
+import json
+import errno
+import socket
+import struct
+
+DEFAULT_SOCKET = '.pycucumber.sock'
+
+FRAME = struct.Struct('!cI')
+REQUEST = 'r'
+OUTPUT = 'o'
+ERROR = 'e'
+EXIT = 'x'
+
+def send_frame(connection, channel, data):
+    connection.sendall(FRAME.pack(channel, len(data)) + data)
+
+def receive_exactly(connection, size):
+    chunks = []
+    while size:
+        chunk = connection.recv(min(size, 1 << 16))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+def receive_frame(connection):
+    """Return the (channel, data) of the next frame, or None if the other
+    end has gone"""
+    header = receive_exactly(connection, FRAME.size)
+    if header is None:
+        return None
+    (channel, size) = FRAME.unpack(header)
+    data = receive_exactly(connection, size)
+    if data is None:
+        return None
+    return (channel, data)
+
+def request(path, argv, stdout=sys.stdout, stderr=sys.stderr):
+    """Have the daemon listening on path carry out argv, writing what it
+    sends back to stdout and stderr. Returns the exit status"""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            connection.connect(path)
+        except socket.error, e:
+            if e.args[0] not in (errno.ENOENT, errno.ECONNREFUSED):
+                raise
+            print >> stderr, "no pycucumber serve daemon is listening on %s" % path
+            return 2
+        send_frame(connection, REQUEST, json.dumps({'argv': argv, 'cwd': os.getcwd(),
+                                                    'tty': stdout.isatty()}))
+        while True:
+            frame = receive_frame(connection)
+            if frame is None:
+                print >> stderr, "the pycucumber serve daemon closed the connection"
+                return 2
+            (channel, data) = frame
+            if channel == OUTPUT:
+                stdout.write(data)
+                stdout.flush()
+            elif channel == ERROR:
+                stderr.write(data)
+                stderr.flush()
+            elif channel == EXIT:
+                return int(data)
+    finally:
+        connection.close()
+
+def main():
+    argv = sys.argv[1:]
+    path = DEFAULT_SOCKET
+    if argv[:1] == ['--socket'] and len(argv) > 1:
+        path = argv[1]
+        argv = argv[2:]
+    if not argv:
+        print >> sys.stderr, __doc__.split("\n\n")[1]
+        return 2
+    return request(path, argv)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,285 @@
+"""Ahead-of-time compilation of features into Python code.
+
+A compiled feature has a function for each scenario that makes straight-line
+calls to the step definitions its lines resolved to, with the arguments they
+captured. It writes the same output, and skips the same tests after a
+failure, as a TestRunner would, but without parsing the feature, matching
+step lines or visiting nodes when it runs.
+
+The source and bytecode of compiled features are stored in files named after
+a hash of the feature text and of the registered step definitions, so a
+feature is only compiled again once either of them changes."""
+
+from __future__ import with_statement
+
+import os
+import sys
+import marshal
+import hashlib
+import tempfile
+import contextlib
+from ast_nodes import Condition, Action, Result
+from ast_visitors import (Visitor, ExecutionContext, RowBinding, Skipped, Unimplemented, Ambiguous,
+                          call_test, scenario_result, feature_managers, scenario_managers,
+                          format_feature, format_purpose, format_role, format_goal, format_scenario,
+                          format_condition, format_action, format_result, format_more_examples,
+                          format_row, format_test_result)
+from walker import walk
+import core
+
+# Increment whenever the code generated for the same feature changes, so that
+# features are compiled again
+COMPILER_VERSION = 2
+
+DEFAULT_DIRECTORY = '.pycucumber_compiled'
+SOURCE_SUFFIX = '.py'
+CODE_SUFFIX = '.code'
+
+def registry_fingerprint(conditions, actions, results):
+    """Return a hash of the step definitions in the bags, which changes when
+    one is added, removed, moved or given a different pattern"""
+    digest = hashlib.sha1()
+    for bag in (conditions, actions, results):
+        digest.update("%d\n" % len(bag))
+        for (regex, fn, names) in bag:
+            digest.update("%r\n" % ((regex.pattern, regex.flags, fn.__module__, fn.__name__, names),))
+    return digest.hexdigest()
+
+def resolve(bag, line):
+    """Return the position in bag of every step definition that matches line,
+    along with the arguments it captures"""
+    matches = []
+    for (position, (regex, fn, names)) in enumerate(bag):
+        match = regex.match(line)
+        if match:
+            matches.append((position, match.groups()))
+    return matches
+
+def emit(out, text):
+    """Write text to out in the same way core.run_events writes an event"""
+    print >> out, text,
+
+def runtime():
+    """Return the globals that compiled features run with"""
+    return {'contextlib': contextlib,
+            'emit': emit,
+            'call_test': call_test,
+            'scenario_result': scenario_result,
+            'format_test_result': format_test_result,
+            'feature_managers': feature_managers,
+            'scenario_managers': scenario_managers,
+            'RowBinding': RowBinding,
+            'Skipped': Skipped,
+            'Unimplemented': Unimplemented,
+            'Ambiguous': Ambiguous}
+
+class FeatureCompiler(Visitor):
+    """Generates the source of a compiled feature. Its events are the lines of
+    the source.
+
+    Everything a TestRunner writes apart from the results of the tests is
+    worked out here, using an ExecutionContext in the same way as TestRunner,
+    so that the compiled code only has to run the tests and write their results"""
+    def __init__(self, conditions, actions, results):
+        self.bags = {Condition: (conditions, 'givens'), Action: (actions, 'whens'), Result: (results, 'thens')}
+
+    def emit(self, depth, context, text):
+        return "%semit(out, %r)" % ("    " * depth, context.indenter.indented_line(text))
+
+    def visitFeature(self, feature, fingerprint):
+        context = ExecutionContext()
+        yield "# Generated by pycucumber.compiler. Do not edit"
+        yield "FINGERPRINT = %r" % fingerprint
+        yield ""
+        yield "def run(givens, whens, thens, out):"
+        yield "    succeeded = True"
+        yield self.emit(1, context, format_feature(feature))
+        yield "    with contextlib.nested(*feature_managers):"
+        with context.indenter:
+            with context.indenter:
+                for child in feature.header():
+                    yield child.get_gen(self, context, 2)
+                for index in range(len(feature.scenarios)):
+                    yield "        succeeded = scenario_%d(givens, whens, thens, out) and succeeded" % index
+                yield "    return succeeded"
+                for (index, scenario) in enumerate(feature.scenarios):
+                    yield ""
+                    yield "def scenario_%d(givens, whens, thens, out):" % index
+                    yield "    succeeded = True"
+                    yield scenario.get_gen(self, context, 1)
+                    yield "    return succeeded"
+
+    def visitPurpose(self, purpose, context, depth):
+        yield self.emit(depth, context, format_purpose(purpose))
+
+    def visitGoal(self, goal, context, depth):
+        yield self.emit(depth, context, format_goal(goal))
+
+    def visitRole(self, role, context, depth):
+        yield self.emit(depth, context, format_role(role))
+
+    def visitChildren(self, node, context, depth, children=None):
+        with context.indenter:
+            for child in node.children() if children is None else children:
+                yield child.get_gen(self, context, depth)
+
+    def visitScenario(self, scenario, context, depth):
+        context = context.nested(context.row)
+        context.scenario = scenario
+        indent = "    " * depth
+
+        yield self.emit(depth, context, format_scenario(scenario))
+        yield indent + "with contextlib.nested(*scenario_managers):"
+        yield indent + "    run_conditions = run_actions = run_results = True"
+
+        children = None if context.row is None else scenario.conditions + scenario.steps
+        with context.indenter:
+            yield self.visitChildren(scenario, context, depth + 1, children)
+        # Flushed where a TestRunner yields END_OF_SCENARIO
+        yield indent + "out.flush()"
+
+    def visitStep(self, step, context, depth):
+        context.first_action = True
+        context.first_result = True
+        yield self.visitChildren(step, context, depth)
+
+    def compile_test(self, test, context, depth, line, execute, failed):
+        """Generate the code that runs test, if execute is true, and clears
+        the flags in failed if it doesn't succeed"""
+        (bag, name) = self.bags[type(test)]
+        matches = resolve(bag, test.text)
+        if not matches:
+            run = "Unimplemented(%r)" % test.text
+        elif len(matches) > 1:
+            run = "Ambiguous([%s], %r)" % (", ".join("(%s[%d], %r)" % (name, position, args)
+                                                     for (position, args) in matches), test.text)
+        else:
+            (position, args) = matches[0]
+            if context.row is not None:
+                args = "row.bind(%r)" % (args,)
+            else:
+                args = repr(args)
+            run = "call_test(%s[%d], %s, %r)" % (name, position, args, test.text)
+
+        indent = "    " * depth
+        yield indent + "emit(out, %r)" % context.indenter.indented_line(line)
+        yield indent + "result = %s if %s else Skipped(%r)" % (run, execute, test.text)
+        if context.row is not None:
+            yield indent + "row.results.append(result)"
+        yield indent + "if not result.is_success():"
+        yield indent + "    succeeded = %s = False" % " = ".join(failed)
+        yield indent + "emit(out, format_test_result(result))"
+
+    def visitCondition(self, cond, context, depth):
+        line = format_condition(cond, context.first_cond, context.indenter.indent_str)
+        yield self.compile_test(cond, context, depth, line, "run_conditions",
+                                ["run_conditions", "run_actions", "run_results"])
+        context.first_cond = False
+
+    def visitAction(self, act, context, depth):
+        line = format_action(act, context.first_action, context.indenter.indent_str)
+        yield self.compile_test(act, context, depth, line, "run_actions", ["run_actions", "run_results"])
+        context.first_action = False
+
+    def visitResult(self, res, context, depth):
+        line = format_result(res, context.first_result, context.indenter.indent_str)
+        yield self.compile_test(res, context, depth, line, "run_results", ["run_actions"])
+        context.first_result = False
+
+    def visitMoreExamples(self, examples, context, depth):
+        yield self.emit(depth, context, format_more_examples(examples))
+        rows_context = context.nested()
+        rows_context.scenario = context.scenario
+        with rows_context.indenter:
+            yield self.visitChildren(examples, rows_context, depth)
+
+    def visitExampleRow(self, example, context, depth):
+        indent = "    " * depth
+        yield self.emit(depth, context, format_row(example.data))
+        yield indent + "row = RowBinding((), %r)" % (example.data,)
+        yield self.visitScenario(context.scenario, context.nested(row=example), depth)
+        yield indent + "emit(out, %r + format_test_result(scenario_result(row.results, %r)))" % (
+            context.indenter.indented_line(u""), context.scenario.text)
+
+def generate_source(feature, conditions, actions, results, fingerprint):
+    compiler = FeatureCompiler(conditions, actions, results)
+    return "\n".join(walk(compiler.visitFeature(feature, fingerprint))) + "\n"
+
+class CompiledFeatures(object):
+    def __init__(self, directory=DEFAULT_DIRECTORY):
+        self.directory = directory
+
+    def key(self, text, conditions, actions, results):
+        digest = hashlib.sha1()
+        digest.update("%s:%s:%s:" % (COMPILER_VERSION, marshal.version, sys.version_info[:2]))
+        digest.update(registry_fingerprint(conditions, actions, results))
+        digest.update(text)
+        return digest.hexdigest()
+
+    def path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def load(self, key):
+        try:
+            with open(self.path(key, CODE_SUFFIX), 'rb') as file:
+                return marshal.load(file)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def write(self, path, data, mode):
+        # Write to a temporary file first so that concurrent runs never see
+        # a partially written file
+        (fd, temp_path) = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, mode) as file:
+                file.write(data)
+            os.rename(temp_path, path)
+        except:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def store(self, key, feature, conditions, actions, results):
+        """Compile feature, and return the code of the compiled feature"""
+        source = generate_source(feature, conditions, actions, results, key)
+        source_path = self.path(key, SOURCE_SUFFIX)
+        code = compile(source, source_path, 'exec')
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self.write(source_path, source, 'w')
+            self.write(self.path(key, CODE_SUFFIX), marshal.dumps(code), 'wb')
+        except (IOError, OSError):
+            pass
+        return code
+
+    def compile(self, text, conditions, actions, results, cache=None):
+        """Return (key, code, compiled) for the compiled feature of the utf-8
+        encoded text, where compiled is whether it had to be compiled again.
+        cache is the FeatureCache to parse the text with, if any"""
+        key = self.key(text, conditions, actions, results)
+        code = self.load(key)
+        if code is not None:
+            return (key, code, False)
+        feature = core.parse_text(text, cache)
+        return (key, self.store(key, feature, conditions, actions, results), True)
+
+def run_compiled(code, conditions, actions, results, output_stream=sys.stdout):
+    """Run the code of a compiled feature with the step definitions in the bags
+    it was compiled against. Returns whether every test succeeded"""
+    namespace = runtime()
+    exec code in namespace
+    return namespace['run']([fn for (regex, fn, names) in conditions],
+                            [fn for (regex, fn, names) in actions],
+                            [fn for (regex, fn, names) in results],
+                            output_stream)
+
+def CompiledTest(text, compiled, output_stream=sys.stdout, cache=None):
+    """Run the feature in the utf-8 encoded text from its compiled code in
+    compiled (a CompiledFeatures), compiling it first if need be. Returns
+    whether every test succeeded"""
+    bags = (core._givens, core._whens, core._thens)
+    (key, code, fresh) = compiled.compile(text, *bags, cache=cache)
+    return run_compiled(code, *bags, output_stream=output_stream)
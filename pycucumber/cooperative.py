@@ -0,0 +1,93 @@
+"""Running the scenarios of a feature concurrently on a single thread.
+
+Step definitions written as coroutines (see the coroutines module) hand
+control back to a Scheduler whenever they wait, and it carries on with the
+other scenarios in the meantime. Ordinary step definitions run to
+completion without letting any other scenario run. As with threads,
+scenarios must be independent of each other, and scenario context managers
+will be entered for several scenarios at once."""
+
+from __future__ import with_statement
+
+import sys
+from ast_visitors import TestRunner, Pending, coroutine_result
+from events import Event, SCENARIO_END
+from reporters import TextReporter
+from output import CapturedOutput
+from coroutines import Scheduler, Semaphore
+from threaded import ThreadOutput
+from walker import walk
+import core
+
+class CooperativeTestRunner(TestRunner):
+    """A TestRunner that runs up to concurrency scenarios of a feature at a
+    time as Tasks on a Scheduler. The output of each scenario, including
+    what its steps print, is written to a buffer by a copy of reporter (by
+    default, a TextReporter), and the buffers are written out in order"""
+    def __init__(self, conditions, actions, results, concurrency, reporter=None):
+        TestRunner.__init__(self, conditions, actions, results)
+        self.concurrency = concurrency
+        self.reporter = TextReporter(sys.stdout) if reporter is None else reporter
+
+    def run_scenario(self, scheduler, semaphore, scenario, context, reporter):
+        """A coroutine that runs scenario, doing what core.run_events does
+        with its events, and running the coroutines of its steps as Tasks"""
+        yield semaphore.acquire()
+        try:
+            gen = walk(self.visitScenario(scenario, context))
+            event = gen.next()
+            while True:
+                if callable(event):
+                    result = event()
+                    if isinstance(result, Pending):
+                        task = scheduler.spawn(result.coroutine)
+                        task.output = reporter.stream
+                        yield task
+                        result = coroutine_result(task, result.line)
+                elif type(event) is Event:
+                    result = None
+                    reporter.report(event)
+                else:
+                    result = None
+                    reporter.write(event)
+                event = gen.send(result)
+        except StopIteration:
+            pass
+        finally:
+            semaphore.release()
+
+    def visitFeatureChildren(self, feature, context):
+        with context.indenter:
+            yield self.visitHeader(feature, context)
+
+            # What a Task prints goes to the output buffer of its scenario
+            output = ThreadOutput(sys.stdout)
+            def switch(task):
+                output.local.buffer = getattr(task, 'output', output.stream)
+
+            scheduler = Scheduler(switch)
+            semaphore = Semaphore(self.concurrency)
+            tasks = []
+            for scenario in feature.scenarios:
+                reporter = self.reporter.copy(CapturedOutput(), feature)
+                task = scheduler.spawn(self.run_scenario(scheduler, semaphore, scenario, context.nested(), reporter))
+                task.output = reporter.stream
+                tasks.append((scenario, reporter, task))
+
+            sys.stdout = output
+            try:
+                for (scenario, reporter, task) in tasks:
+                    scheduler.run_until(task)
+                    if task.exc_info is not None:
+                        raise task.exc_info[0], task.exc_info[1], task.exc_info[2]
+                    self.reporter.merge(reporter.summary())
+                    yield task.output.getvalue()
+                    yield Event(SCENARIO_END, scenario)
+            finally:
+                sys.stdout = output.stream
+
+def CooperativeTest(text, concurrency, output_stream=sys.stdout, cache=None, reporter=None):
+    if reporter is None:
+        reporter = TextReporter(output_stream)
+    runner = CooperativeTestRunner(core._givens, core._whens, core._thens, concurrency, reporter)
+    return core.run_visitor(core.parse_text(text, cache), runner, output_stream, False, reporter)
@@ -1,10 +1,14 @@
 from __future__ import with_statement
 import re
 from ast_nodes import Purpose, Role, Goal, Condition, Action, Result, Scenario, Feature, parse
+from feature_parser import stream_feature
 from ast_visitors import TestRunner, CheckRules, Skipped, Succeeded, Failed
+from events import Event
+from reporters import TextReporter
 from regex_parser import parse_regex, SimplifyPrinter, TreePrinter
 import inspect
 import readline
+import codecs
 import sys
 
 _givens = []
@@ -25,31 +29,61 @@ Given = create_collector(_givens)
 When = create_collector(_whens)
 Then = create_collector(_thens)
 
-def Test(text, output_stream=sys.stdout, interactive=False):
-    return run_visitor(text, TestRunner(_givens, _whens, _thens), output_stream, interactive)
+def parse_text(text, cache=None):
+    if cache is None:
+        return parse(unicode(text, 'utf-8'))
+    return cache.parse(text)
 
-def CheckSyntax(text, output_stream=sys.stdout):
-    return run_visitor(text, CheckRules(_givens, _whens, _thens), output_stream, False)
+def Test(text, output_stream=sys.stdout, interactive=False, cache=None, reporter=None):
+    return run_visitor(parse_text(text, cache), TestRunner(_givens, _whens, _thens), output_stream, interactive,
+                       reporter)
 
-def run_visitor(text, visitor, output_stream, interactive):
-    feature = parse(unicode(text, 'utf-8'))
-    feature_gen = feature.accept(visitor)
-    event = feature_gen.next()
+def StreamTest(stream, output_stream=sys.stdout, interactive=False, reporter=None):
+    """Run the feature read from stream (a file object, or sys.stdin), starting
+    each scenario as soon as it has been parsed.
+
+    Scenarios are discarded once they have run, so the parsed tree is not
+    available afterwards. Returns whether every test succeeded"""
+    feature = stream_feature(codecs.getreader('utf-8')(stream))
+    runner = TestRunner(_givens, _whens, _thens)
+    run_visitor(feature, runner, output_stream, interactive, reporter)
+    return runner.succeeded
+
+def CheckSyntax(text, output_stream=sys.stdout, cache=None):
+    return run_visitor(parse_text(text, cache), CheckRules(_givens, _whens, _thens), output_stream, False)
+
+def run_visitor(feature, visitor, output_stream, interactive, reporter=None):
+    run_events(feature.accept(visitor), output_stream, interactive, reporter)
+    return feature
+
+def run_events(feature_gen, output_stream, interactive, reporter=None):
+    """Hand the events generated by a visitor, and any text it generates, to
+    reporter (by default, a TextReporter writing to output_stream), and send
+    back the result of calling each callable event.
+
+    The reporter flushes output_stream at the end of every scenario. It is
+    also flushed before every prompt, and at the end"""
+    if reporter is None:
+        reporter = TextReporter(output_stream)
     try:
+        event = feature_gen.next()
         while True:
-            if callable(event):
+            result = None
+            if type(event) is Event:
+                reporter.report(event)
+            elif callable(event):
                 if interactive:
+                    output_stream.flush()
                     result = interact(event)
                 else:
                     result = event()
             else:
-                result = None
-                print >> output_stream, event,
-                output_stream.flush()
+                reporter.write(event)
             event = feature_gen.send(result)
     except StopIteration:
         pass
-    return feature
+    finally:
+        output_stream.flush()
 
 previous_selection = 'r'
 def get_choice():
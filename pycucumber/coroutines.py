@@ -0,0 +1,224 @@
+"""Cooperative scheduling of step definitions that wait on I/O.
+
+A step definition may be written as a generator function, in the style of
+tornado's gen.coroutine, instead of as an ordinary function. Each time it
+yields, it hands control back to a Scheduler, which resumes it once what it
+yielded is ready. A coroutine may yield:
+    None                  to let other coroutines run
+    sleep(seconds)        to wait for a time
+    readable(file)        to wait until a socket or file can be read
+    writable(file)        to wait until a socket or file can be written
+    a generator           to run it as a sub-coroutine, until it finishes
+    a Task                to wait until the Task finishes
+    semaphore.acquire()   to wait until a Semaphore can be acquired
+
+Exceptions raised by a sub-coroutine are raised in the coroutine that
+yielded it."""
+
+import sys
+import time
+import heapq
+import select
+import itertools
+import threading
+import collections
+from types import GeneratorType
+
+_state = threading.local()
+
+def running():
+    """Return the Scheduler that is running on this thread, or None"""
+    return getattr(_state, 'scheduler', None)
+
+class Task(object):
+    """A coroutine being run by a Scheduler. Once it is done, exc_info holds
+    the exception it raised, if any"""
+    def __init__(self, coroutine):
+        # The coroutine, followed by the sub-coroutines it is waiting on
+        self.stack = [coroutine]
+        self.value = None
+        self.exc_info = None
+        self.done = False
+        self.waiters = []
+
+    def schedule(self, scheduler, task):
+        if self.done:
+            scheduler.ready(task, self)
+        else:
+            self.waiters.append(task)
+
+class Sleep(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def schedule(self, scheduler, task):
+        scheduler.wake_at(time.time() + self.seconds, task)
+
+class Readable(object):
+    def __init__(self, file):
+        self.file = file
+
+    def schedule(self, scheduler, task):
+        scheduler.readers.append((self.file, task))
+
+class Writable(object):
+    def __init__(self, file):
+        self.file = file
+
+    def schedule(self, scheduler, task):
+        scheduler.writers.append((self.file, task))
+
+sleep = Sleep
+readable = Readable
+writable = Writable
+
+class Semaphore(object):
+    """Limits the number of coroutines that hold it at the same time to count"""
+    def __init__(self, count):
+        self.count = count
+        self.waiting = collections.deque()
+
+    def acquire(self):
+        return Acquire(self)
+
+    def release(self):
+        if self.waiting:
+            (scheduler, task) = self.waiting.popleft()
+            scheduler.ready(task)
+        else:
+            self.count += 1
+
+class Acquire(object):
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+
+    def schedule(self, scheduler, task):
+        if self.semaphore.count:
+            self.semaphore.count -= 1
+            scheduler.ready(task)
+        else:
+            self.semaphore.waiting.append((scheduler, task))
+
+class Scheduler(object):
+    """Runs Tasks one at a time on the current thread, switching between them
+    whenever the running one yields.
+
+    If switch is given, it is called with each Task before it is resumed, and
+    with None when the Scheduler stops running"""
+    def __init__(self, switch=None):
+        self.switch = switch
+        self.queue = collections.deque()
+        self.sleeping = []
+        self.sequence = itertools.count()
+        self.readers = []
+        self.writers = []
+
+    def spawn(self, coroutine):
+        task = Task(coroutine)
+        self.ready(task)
+        return task
+
+    def ready(self, task, value=None):
+        task.value = value
+        self.queue.append(task)
+
+    def wake_at(self, when, task):
+        heapq.heappush(self.sleeping, (when, next(self.sequence), task))
+
+    def step(self, task):
+        if self.switch is not None:
+            self.switch(task)
+        coroutine = task.stack[-1]
+        (value, exc_info) = (task.value, task.exc_info)
+        task.value = task.exc_info = None
+        try:
+            if exc_info is None:
+                request = coroutine.send(value)
+            else:
+                request = coroutine.throw(*exc_info)
+        except StopIteration:
+            self.unwind(task)
+        except Exception:
+            (type, value, tb) = sys.exc_info()
+            # Leave this frame out of the traceback, so that it starts at
+            # the outermost coroutine
+            task.exc_info = (type, value, tb.tb_next)
+            self.unwind(task)
+        else:
+            self.handle(task, request)
+
+    def unwind(self, task):
+        task.stack.pop()
+        if task.stack:
+            self.queue.append(task)
+            return
+        task.done = True
+        for waiter in task.waiters:
+            self.ready(waiter, task)
+
+    def handle(self, task, request):
+        if request is None:
+            self.ready(task)
+        elif isinstance(request, GeneratorType):
+            task.stack.append(request)
+            self.ready(task)
+        elif hasattr(request, 'schedule'):
+            request.schedule(self, task)
+        else:
+            error = TypeError("Coroutines can't yield %r" % (request,))
+            task.exc_info = (TypeError, error, None)
+            self.ready(task)
+
+    def poll(self):
+        """Wait until at least one sleeping or waiting Task can be resumed.
+        Returns False if there are none"""
+        if not (self.sleeping or self.readers or self.writers):
+            return False
+        timeout = None
+        if self.sleeping:
+            timeout = max(0, self.sleeping[0][0] - time.time())
+        if self.readers or self.writers:
+            (readable, writable, errors) = select.select([file for (file, task) in self.readers],
+                                                         [file for (file, task) in self.writers],
+                                                         [], timeout)
+            self.readers = self.wake_waiting(self.readers, readable)
+            self.writers = self.wake_waiting(self.writers, writable)
+        else:
+            time.sleep(timeout)
+        now = time.time()
+        while self.sleeping and self.sleeping[0][0] <= now:
+            self.ready(heapq.heappop(self.sleeping)[2])
+        return True
+
+    def wake_waiting(self, waiting, ready_files):
+        still_waiting = []
+        for (file, task) in waiting:
+            if file in ready_files:
+                self.ready(task)
+            else:
+                still_waiting.append((file, task))
+        return still_waiting
+
+    def run_until(self, task=None):
+        """Run Tasks until task is done or, if task is None, until there are none left"""
+        previous = running()
+        _state.scheduler = self
+        try:
+            while task is None or not task.done:
+                if self.queue:
+                    self.step(self.queue.popleft())
+                elif not self.poll():
+                    if task is not None:
+                        raise RuntimeError("Task can never finish, as nothing is left to run")
+                    break
+        finally:
+            _state.scheduler = previous
+            if self.switch is not None:
+                self.switch(None)
+
+def run(coroutine):
+    """Run coroutine to completion on a new Scheduler, and return its Task"""
+    scheduler = Scheduler()
+    task = scheduler.spawn(coroutine)
+    scheduler.run_until(task)
+    return task
@@ -0,0 +1,186 @@
+"""Keeping the rules loaded between commands, for the serve command."""
+
+from __future__ import with_statement
+
+import os
+import sys
+import json
+import errno
+import signal
+import socket
+import traceback
+from StringIO import StringIO
+from client import DEFAULT_SOCKET, REQUEST, OUTPUT, ERROR, EXIT, send_frame, receive_frame
+from ast_visitors import feature_managers, scenario_managers
+import core
+import step_matcher
+import package_globals
+
+class RuleFiles(object):
+    """The rule files in paths, loaded with load, and when each was last
+    modified when they were"""
+    def __init__(self, paths, load):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.load = load
+        self.loaded = self.modified()
+
+    def modified(self):
+        return [os.path.getmtime(path) if os.path.exists(path) else None for path in self.paths]
+
+    def refresh(self):
+        """Load the rule files again if any of them (but not the modules
+        they import) has been modified since they were last loaded. Returns
+        whether they were"""
+        modified = self.modified()
+        if modified == self.loaded:
+            return False
+        self.forget()
+        # Until the rules load without error, try again on every command
+        self.loaded = None
+        self.load(self.paths)
+        self.loaded = modified
+        return True
+
+    def forget(self):
+        """Forget everything the rule files registered when they were loaded"""
+        for registered in (core._givens, core._whens, core._thens, feature_managers, scenario_managers,
+                           package_globals.rule_args, package_globals.callbacks):
+            del registered[:]
+        # An index of a bag with as many definitions as before would
+        # otherwise be kept
+        step_matcher._indexes.clear()
+        for path in self.paths:
+            sys.modules.pop(os.path.basename(path).replace('.py', ''), None)
+
+class ChannelStream(object):
+    """Stands in for sys.stdout or sys.stderr, and sends what is written to
+    it to the client on channel when flushed"""
+    def __init__(self, connection, channel, tty=False):
+        self.connection = connection
+        self.channel = channel
+        self.tty = tty
+        self.pending = []
+        self.encoding = 'utf-8'
+        self.softspace = 0
+
+    def write(self, text):
+        self.pending.append(text.encode('utf-8') if isinstance(text, unicode) else text)
+
+    def flush(self):
+        if self.pending:
+            (pending, self.pending) = (self.pending, [])
+            send_frame(self.connection, self.channel, "".join(pending))
+
+    def isatty(self):
+        return self.tty
+
+def exit_status(code):
+    """Return the exit status that sys.exit(code) would have given"""
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print >> sys.stderr, code
+    return 1
+
+def listen(path):
+    """Return a socket listening on path, replacing any socket left there by
+    a daemon that has gone"""
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error, e:
+        if e.args[0] == errno.ECONNREFUSED:
+            os.unlink(path)
+        elif e.args[0] != errno.ENOENT:
+            raise
+    else:
+        raise socket.error(errno.EADDRINUSE, "a daemon is already listening on %s" % path)
+    finally:
+        probe.close()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(socket.SOMAXCONN)
+    return listener
+
+def parse_request(data):
+    """Return the (argv, cwd, tty) of a request. Raises ValueError if it
+    isn't one"""
+    request = json.loads(data)
+    if not isinstance(request, dict):
+        raise ValueError("a request has to be a JSON object")
+    (argv, cwd, tty) = (request.get('argv'), request.get('cwd'), request.get('tty', False))
+    if not isinstance(argv, list) or not all(isinstance(arg, unicode) for arg in argv):
+        raise ValueError("the argv of a request has to be a list of strings")
+    if not isinstance(cwd, unicode):
+        raise ValueError("the cwd of a request has to be a string")
+    return ([arg.encode('utf-8') for arg in argv], cwd, bool(tty))
+
+def handle(connection, rule_files, execute):
+    """Carry out the command the client on connection sent, with execute,
+    and send back what it wrote and its exit status. A request that can't
+    be carried out is answered with an error, and an exit status of 2"""
+    frame = receive_frame(connection)
+    if frame is None:
+        return
+    try:
+        if frame[0] != REQUEST:
+            raise ValueError("expected a request")
+        (argv, cwd, tty) = parse_request(frame[1])
+    except ValueError, e:
+        send_frame(connection, ERROR, "pycucumber serve: malformed request: %s\n" % e)
+        send_frame(connection, EXIT, "2")
+        return
+    out = ChannelStream(connection, OUTPUT, tty)
+    err = ChannelStream(connection, ERROR)
+    saved = (sys.stdout, sys.stderr, sys.stdin, sys.argv, os.getcwd())
+    (sys.stdout, sys.stderr, sys.stdin) = (out, err, StringIO())
+    sys.argv = [saved[3][0]] + rule_files.paths + argv
+    try:
+        try:
+            os.chdir(cwd)
+            if rule_files.refresh():
+                print >> sys.stderr, "reloaded %s" % ", ".join(os.path.basename(path) for path in rule_files.paths)
+            status = execute(rule_files.paths, argv)
+        except SystemExit, e:
+            status = exit_status(e.code)
+        except socket.error:
+            # The client has gone
+            raise
+        except Exception:
+            traceback.print_exc()
+            status = 1
+    finally:
+        (sys.stdout, sys.stderr, sys.stdin, sys.argv) = saved[:4]
+        os.chdir(saved[4])
+    out.flush()
+    err.flush()
+    send_frame(connection, EXIT, str(int(status or 0)))
+
+def serve(path, rules, load, execute):
+    """Carry out the commands sent to the Unix socket at path, one at a
+    time, with execute(rules, argv), reloading rules with load when they
+    are modified. Runs until interrupted or terminated"""
+    rule_files = RuleFiles(rules, load)
+    listener = listen(path)
+    # Let the finally clause remove the socket when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print >> sys.stderr, "serving on %s" % path
+    try:
+        while True:
+            (connection, peer) = listener.accept()
+            try:
+                handle(connection, rule_files, execute)
+            except socket.error:
+                pass
+            except Exception:
+                # Whatever went wrong was this connection's alone
+                traceback.print_exc()
+            finally:
+                connection.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        os.unlink(path)
+    return 0
@@ -0,0 +1,333 @@
+"""Running features on worker processes that connect over a socket, for run
+--coordinator and the worker command."""
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import errno
+import socket
+import json
+import struct
+import threading
+import subprocess
+from collections import deque
+from ast_cache import encode_feature, decode_feature
+from reporters import REPORTERS
+from history import HistoryReporter
+import parallel
+
+DEFAULT_ATTEMPTS = 3
+DEFAULT_CONNECT_TIMEOUT = 30.0
+
+# Every message is a JSON array, preceded by its length
+LENGTH = struct.Struct('!I')
+
+def parse_address(text):
+    """Return the (family, address) of a socket given as unix:PATH (or any
+    path with a / in it), HOST:PORT or just PORT"""
+    if text.startswith('unix:'):
+        return (socket.AF_UNIX, text[len('unix:'):])
+    if '/' in text:
+        return (socket.AF_UNIX, text)
+    (host, port) = text.rsplit(':', 1) if ':' in text else ('', text)
+    return (socket.AF_INET, (host or '127.0.0.1', int(port)))
+
+def is_loopback(address):
+    """Return whether address (as parse_address takes) can only be
+    reached from this machine"""
+    (family, location) = parse_address(address)
+    if family == socket.AF_UNIX:
+        return True
+    try:
+        return socket.gethostbyname(location[0]).startswith('127.')
+    except socket.error:
+        return False
+
+def send(connection, message):
+    data = json.dumps(message)
+    connection.sendall(LENGTH.pack(len(data)) + data)
+
+def receive_exactly(connection, size):
+    chunks = []
+    while size:
+        chunk = connection.recv(min(size, 1 << 16))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+def receive(connection):
+    """Return the next message, or None if the other end has gone. Raises
+    ValueError if it isn't JSON"""
+    header = receive_exactly(connection, LENGTH.size)
+    if header is None:
+        return None
+    data = receive_exactly(connection, LENGTH.unpack(header)[0])
+    if data is None:
+        return None
+    return json.loads(data)
+
+def listen(address):
+    (family, location) = parse_address(address)
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_UNIX:
+        if os.path.exists(location):
+            os.unlink(location)
+    else:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(location)
+    listener.listen(socket.SOMAXCONN)
+    return listener
+
+def connect(address, timeout=DEFAULT_CONNECT_TIMEOUT):
+    """Connect to the coordinator at address, trying again until timeout
+    seconds have passed, as it may not have started listening yet"""
+    (family, location) = parse_address(address)
+    deadline = time.time() + timeout
+    while True:
+        connection = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            connection.connect(location)
+            return connection
+        except socket.error, e:
+            connection.close()
+            if e.args[0] not in (errno.ENOENT, errno.ECONNREFUSED) or time.time() >= deadline:
+                raise
+            time.sleep(0.1)
+
+class Coordinator(object):
+    """Hands out the units of work of features to the workers that connect
+    to address, and collects their results. reporter_kind is the (format,
+    history) the workers make their reporters from"""
+    def __init__(self, features, address, reporter_kind, attempts=DEFAULT_ATTEMPTS):
+        self.features = features
+        self.encoded = [encode_feature(feature) for feature in features]
+        self.address = address
+        self.reporter_kind = reporter_kind
+        self.max_attempts = attempts
+        self.units = list(parallel.work_units(features))
+        self.pending = deque(range(len(self.units)))
+        self.attempts = [0] * len(self.units)
+        # index -> (output, succeeded, summary), until it is reported
+        self.results = {}
+        self.finished = 0
+        self.condition = threading.Condition()
+        self.listener = listen(address)
+
+    def done(self):
+        return self.finished == len(self.units)
+
+    def serve(self):
+        """Accept workers on a thread of their own, until close"""
+        thread = threading.Thread(target=self.accept)
+        thread.setDaemon(True)
+        thread.start()
+
+    def accept(self):
+        while True:
+            try:
+                (connection, peer) = self.listener.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self.handle, args=(connection,))
+            thread.setDaemon(True)
+            thread.start()
+
+    def handle(self, connection):
+        """Send a worker units to run, one at a time, until there are none
+        left, putting back the unit it was running if it goes"""
+        index = None
+        try:
+            send(connection, ('features', self.encoded, self.reporter_kind))
+            while True:
+                index = self.next_unit()
+                if index is None:
+                    send(connection, ('done',))
+                    return
+                send(connection, ('unit', index, self.units[index]))
+                reply = receive(connection)
+                if reply is None:
+                    return
+                (kind, reply_index, output, succeeded, summary) = reply
+                if kind != 'result' or reply_index != index:
+                    return
+                self.finish_unit(index, (output, bool(succeeded), summary))
+                index = None
+        except (socket.error, ValueError, TypeError):
+            # A worker that doesn't keep to the protocol is treated as one
+            # that has gone
+            pass
+        finally:
+            if index is not None:
+                self.requeue(index)
+            connection.close()
+
+    def next_unit(self):
+        """Return the index of the next unit to run, waiting for one to be
+        put back if need be, or None once every unit is finished"""
+        with self.condition:
+            while not self.pending and not self.done():
+                self.condition.wait()
+            if not self.pending:
+                return None
+            index = self.pending.popleft()
+            self.attempts[index] += 1
+            return index
+
+    def finish_unit(self, index, result):
+        with self.condition:
+            self.results[index] = result
+            self.finished += 1
+            self.condition.notify_all()
+
+    def requeue(self, index):
+        with self.condition:
+            if self.attempts[index] >= self.max_attempts:
+                self.results[index] = (self.lost(index), False, None)
+                self.finished += 1
+            else:
+                self.pending.appendleft(index)
+            self.condition.notify_all()
+
+    def lose_pending(self):
+        """Give up on every unit that hasn't been handed out, when there is
+        nothing left to run them"""
+        with self.condition:
+            while self.pending:
+                index = self.pending.popleft()
+                self.results[index] = (self.lost(index), False, None)
+                self.finished += 1
+            self.condition.notify_all()
+
+    def lost(self, index):
+        """Return the output that stands in for a unit no worker finished"""
+        if self.attempts[index]:
+            reason = u"Lost: no worker finished it after %d attempt%s" % (
+                self.attempts[index], u"" if self.attempts[index] == 1 else u"s")
+        else:
+            reason = u"Lost: no worker was left to run it"
+        return parallel.missing_output(self.features, self.units[index], reason)
+
+    def results_in_order(self, monitor=None):
+        """Yield the (unit, result) of every unit, in order, as they
+        arrive. monitor, if given, is called every second while waiting"""
+        for index in range(len(self.units)):
+            with self.condition:
+                while index not in self.results:
+                    self.condition.wait(1.0)
+                    if monitor is not None and index not in self.results:
+                        self.condition.release()
+                        try:
+                            monitor()
+                        finally:
+                            self.condition.acquire()
+                result = self.results.pop(index)
+            yield (self.units[index], result)
+
+    def close(self):
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.listener.close()
+        (family, location) = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(location):
+            os.unlink(location)
+
+class LocalWorkers(object):
+    """Worker processes started on this machine, running the worker command
+    with rules. Workers that die are replaced, up to attempts times as many
+    of them as there were to begin with"""
+    def __init__(self, rules, address, count, attempts=DEFAULT_ATTEMPTS):
+        self.command = [sys.executable, '-m', 'pycucumber.runner'] + list(rules) + ['worker', address]
+        self.environment = dict(os.environ)
+        # The workers have to be able to import this copy of pycucumber
+        package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.environment['PYTHONPATH'] = os.pathsep.join(
+            [package_parent] + filter(None, [self.environment.get('PYTHONPATH')]))
+        self.count = count
+        self.spawns_left = count * attempts
+        self.processes = []
+        for worker in range(count):
+            self.spawn()
+
+    def spawn(self):
+        self.spawns_left -= 1
+        with open(os.devnull, 'w') as devnull:
+            self.processes.append(subprocess.Popen(self.command, env=self.environment, stdout=devnull))
+
+    def monitor(self, coordinator):
+        """Replace the workers that have died while there is still work.
+        Once none can be, give up on the work left"""
+        self.processes = [process for process in self.processes if process.poll() is None]
+        if coordinator.done():
+            return
+        while len(self.processes) < self.count and self.spawns_left > 0:
+            self.spawn()
+        if not self.processes:
+            coordinator.lose_pending()
+
+    def stop(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in self.processes:
+            process.wait()
+
+def CoordinatedTest(features, address, output_stream=sys.stdout, reporter_kind=('text', False), reporter=None,
+                    rules=(), local_workers=0, attempts=DEFAULT_ATTEMPTS):
+    """Run the parsed features on the workers that connect to address, and
+    on local_workers workers of its own with rules, writing their output to
+    output_stream in feature order with reporter. Returns whether every
+    test succeeded"""
+    coordinator = Coordinator(features, address, reporter_kind, attempts)
+    output_stream.flush()
+    coordinator.serve()
+    workers = LocalWorkers(rules, address, local_workers, attempts) if local_workers else None
+    try:
+        monitor = (lambda: workers.monitor(coordinator)) if workers is not None else None
+        return parallel.report_units(features, coordinator.results_in_order(monitor), output_stream, reporter)
+    finally:
+        coordinator.close()
+        if workers is not None:
+            workers.stop()
+
+def make_reporter(reporter_kind):
+    """Return a reporter to make copies of in a worker, of the same kind as
+    the coordinator's"""
+    (format, history) = reporter_kind
+    reporter = REPORTERS[format](None)
+    if history:
+        reporter = HistoryReporter(reporter, None, [])
+    return reporter
+
+def work(address, connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+    """Run units of work from the coordinator at address until it has none
+    left. Returns the number of units run"""
+    connection = connect(address, connect_timeout)
+    run = 0
+    try:
+        message = receive(connection)
+        if message is None:
+            return run
+        (kind, encoded, reporter_kind) = message
+        parallel._features = [decode_feature(data) for data in encoded]
+        parallel._templates.clear()
+        parallel._reporter = make_reporter(reporter_kind)
+        while True:
+            message = receive(connection)
+            if message is None or message[0] == 'done':
+                parallel.leave_feature()
+                return run
+            (kind, index, unit) = message
+            (output, succeeded, summary) = parallel.run_unit(tuple(unit))
+            if isinstance(output, str):
+                # Whatever the steps printed, it has to be text to be sent
+                output = output.decode('utf-8', 'replace')
+            send(connection, ('result', index, output, succeeded, summary))
+            run += 1
+    finally:
+        connection.close()
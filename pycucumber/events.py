@@ -0,0 +1,32 @@
+"""The events a TestRunner yields as it runs a feature.
+
+Events say what happened to which node, rather than how to show it, so that
+each reporter (see reporters) only does the formatting it needs for what it
+actually writes."""
+
+FEATURE = 'feature'
+HEADER = 'header'
+SCENARIO = 'scenario'
+TEST = 'test'
+TEST_RESULT = 'test result'
+MORE_EXAMPLES = 'more examples'
+ROW = 'row'
+ROW_RESULT = 'row result'
+SCENARIO_END = 'end of scenario'
+
+class Event(object):
+    """kind is one of the constants above, and node the node the event is
+    about. result is set for TEST_RESULT and ROW_RESULT events. indent is how
+    deeply the node is nested, and first, for TEST events, whether the test
+    is the first of its type in a row (and so isn't shown as an And)"""
+    __slots__ = ('kind', 'node', 'result', 'indent', 'first')
+
+    def __init__(self, kind, node, result=None, indent=0, first=False):
+        self.kind = kind
+        self.node = node
+        self.result = result
+        self.indent = indent
+        self.first = first
+
+    def __repr__(self):
+        return "Event(%r, %r, %r)" % (self.kind, self.node, self.result)
@@ -0,0 +1,157 @@
+"""Single pass, line-oriented parser for feature files.
+
+Builds the same Feature/Scenario/Step/MoreExamples trees as the pyparsing
+grammar in ast_nodes, but does so with one tokenizing pass over the lines of
+the file and a recursive-descent parser with a single token of lookahead"""
+
+import string
+from ast_nodes import (Purpose, Role, Goal, Condition, Action, Result, Step,
+                       Scenario, Feature, StreamingFeature, MoreExamples, ExampleRow)
+
+# Increment whenever the trees produced for the same text change, so that
+# features cached by ast_cache are parsed again
+PARSER_VERSION = 1
+
+KEYWORDS = ["Feature:", "Scenario:", "More Examples:", "In order", "As",
+            "I want", "Given", "When", "Then", "And"]
+
+# Characters that may not directly follow a keyword (pyparsing's defaults
+# for Keyword), so that "Andrew" is not read as "And rew"
+_keyword_chars = frozenset(string.ascii_letters + string.digits + "_$")
+_whitespace = " \t\r"
+
+ROW = "|"
+END = "end of file"
+EOF = (END, None, None)
+
+class FeatureSyntaxError(Exception):
+    def __init__(self, msg, lineno, line):
+        Exception.__init__(self, msg, lineno, line)
+        self.msg = msg
+        self.lineno = lineno
+        self.line = line
+    def __str__(self):
+        return "%s (line %s)" % (self.msg, self.lineno)
+
+def split_row(line, lineno):
+    cells = line[1:].split(ROW)
+    if len(cells) < 2 or cells[-1].strip(_whitespace):
+        raise FeatureSyntaxError("Example rows must end with '|'", lineno, line)
+    return [cell.strip() for cell in cells[:-1]]
+
+def match_keyword(line):
+    for keyword in KEYWORDS:
+        if line.startswith(keyword):
+            rest = line[len(keyword):]
+            if not rest or rest[0] not in _keyword_chars:
+                return keyword, rest.strip()
+    return None, line
+
+def tokenize(lines):
+    """Yield a (keyword, text, lineno) token for every significant line.
+
+    Blank lines and comments are dropped. Example rows are returned with
+    a keyword of ROW and the list of cell values as their text"""
+    lineno = 0
+    for line in lines:
+        lineno += 1
+        if line.endswith("\n"):
+            line = line[:-1]
+        line = line.lstrip(_whitespace)
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith(ROW):
+            yield ROW, split_row(line, lineno), lineno
+        else:
+            keyword, text = match_keyword(line)
+            yield keyword, text, lineno
+
+class FeatureParser(object):
+    def __init__(self, lines):
+        self.tokens = tokenize(lines)
+        self.advance()
+
+    def advance(self):
+        self.current = next(self.tokens, EOF)
+
+    def at(self, *keywords):
+        return self.current[0] in keywords
+
+    def accept(self, *keywords):
+        if not self.at(*keywords):
+            return None
+        (keyword, text, lineno) = self.current
+        self.advance()
+        return text
+
+    def expect(self, *keywords):
+        if not self.at(*keywords):
+            (keyword, text, lineno) = self.current
+            if keyword == END:
+                found = END
+            else:
+                found = "%r" % (keyword if keyword is not None else text)
+            raise FeatureSyntaxError("Expected %s, found %s" % (" or ".join(map(repr, keywords)), found),
+                                     lineno, text)
+        return self.accept(*keywords)
+
+    def parse_block(self, type, keyword):
+        block = [type(self.expect(keyword))]
+        while self.at("And", keyword):
+            block.append(type(self.accept("And", keyword)))
+        return block
+
+    def parse_step(self):
+        actions = self.parse_block(Action, "When")
+        results = self.parse_block(Result, "Then")
+        return Step(actions, results)
+
+    def parse_more_examples(self):
+        self.expect("More Examples:")
+        header = self.expect(ROW)
+        rows = [ExampleRow(self.expect(ROW))]
+        while self.at(ROW):
+            rows.append(ExampleRow(self.accept(ROW)))
+        return MoreExamples(header, rows)
+
+    def parse_scenario(self):
+        text = self.expect("Scenario:")
+        conditions = self.parse_block(Condition, "Given") if self.at("Given") else []
+        steps = [self.parse_step()]
+        while self.at("When"):
+            steps.append(self.parse_step())
+        more_examples = self.parse_more_examples() if self.at("More Examples:") else None
+        return Scenario(text, conditions, steps, more_examples)
+
+    def parse_header(self):
+        text = self.expect("Feature:")
+        role = self.accept("As")
+        goal = self.accept("I want")
+        purpose = self.accept("In order")
+        return (text,
+                Purpose(purpose) if purpose is not None else None,
+                Role(role) if role is not None else None,
+                Goal(goal) if goal is not None else None)
+
+    def iter_scenarios(self):
+        yield self.parse_scenario()
+        while self.at("Scenario:"):
+            yield self.parse_scenario()
+        self.expect(END)
+
+    def parse_feature(self):
+        (text, purpose, role, goal) = self.parse_header()
+        return Feature(text, purpose, role, goal, list(self.iter_scenarios()))
+
+    def stream_feature(self):
+        (text, purpose, role, goal) = self.parse_header()
+        return StreamingFeature(text, purpose, role, goal, self.iter_scenarios())
+
+def parse_feature(text):
+    return FeatureParser(text.split("\n")).parse_feature()
+
+def stream_feature(lines):
+    """Parse the header of a feature from an iterable of lines (such as a file
+    object), and return a StreamingFeature that parses each of its scenarios
+    only when the previous one has been visited"""
+    return FeatureParser(lines).stream_feature()
@@ -0,0 +1,251 @@
+"""Keeping the results of runs in a SQLite database, for run --history,
+and reporting on how long scenarios have taken over the runs kept, for the
+history command."""
+
+import os
+import time
+import sqlite3
+from ast_visitors import format_row
+from events import TEST, TEST_RESULT
+from reporters import ScenarioReporter, result_name, step_line
+
+DEFAULT_FILE = '.pycucumber_history.sqlite'
+DEFAULT_RUNS = 5
+DEFAULT_THRESHOLD = 0.2
+DEFAULT_MIN_CHANGE = 0.01
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    finished REAL,
+    succeeded INTEGER,
+    command TEXT
+);
+CREATE TABLE IF NOT EXISTS scenarios (
+    id INTEGER PRIMARY KEY,
+    run INTEGER NOT NULL REFERENCES runs (id),
+    feature TEXT NOT NULL,
+    scenario TEXT NOT NULL,
+    result TEXT NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scenarios_by_name ON scenarios (feature, scenario, run);
+CREATE INDEX IF NOT EXISTS scenarios_by_run ON scenarios (run);
+CREATE TABLE IF NOT EXISTS steps (
+    scenario INTEGER NOT NULL REFERENCES scenarios (id),
+    position INTEGER NOT NULL,
+    step TEXT NOT NULL,
+    result TEXT NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS steps_by_scenario ON steps (scenario);
+"""
+
+class History(object):
+    """The database of the results of runs kept in path"""
+    def __init__(self, path=DEFAULT_FILE):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self.run = None
+
+    def start_run(self, command=None):
+        """Start recording a run. Nothing is visible to other connections
+        until end_run"""
+        cursor = self.connection.execute("INSERT INTO runs (started, command) VALUES (?, ?)",
+                                         (time.time(), command))
+        self.run = cursor.lastrowid
+        return self.run
+
+    def add(self, feature, scenario, result, duration, steps):
+        """Record the result and duration of scenario, and the (step,
+        result, duration) of each of its steps"""
+        cursor = self.connection.execute(
+            "INSERT INTO scenarios (run, feature, scenario, result, duration) VALUES (?, ?, ?, ?, ?)",
+            (self.run, feature, scenario, result, duration))
+        scenario_id = cursor.lastrowid
+        self.connection.executemany(
+            "INSERT INTO steps (scenario, position, step, result, duration) VALUES (?, ?, ?, ?, ?)",
+            [(scenario_id, position, step, step_result, step_duration)
+             for (position, (step, step_result, step_duration)) in enumerate(steps)])
+
+    def end_run(self, succeeded):
+        self.connection.execute("UPDATE runs SET finished = ?, succeeded = ? WHERE id = ?",
+                                (time.time(), int(succeeded), self.run))
+        self.connection.commit()
+        self.run = None
+
+    def close(self):
+        if self.run is not None:
+            self.connection.rollback()
+            self.run = None
+        self.connection.close()
+
+    def runs(self, count):
+        """Return the ids of the last count runs that finished, oldest first"""
+        rows = self.connection.execute(
+            "SELECT id FROM runs WHERE finished IS NOT NULL ORDER BY id DESC LIMIT ?", (count,))
+        return sorted(run for (run,) in rows)
+
+    def durations(self, runs, feature=None, scenario=None):
+        """Return {(feature, scenario): [(run, result, duration)...]} over
+        runs, optionally only of the feature path and scenarios whose text
+        contains scenario"""
+        if not runs:
+            return {}
+        query = ("SELECT feature, scenario, run, result, duration FROM scenarios WHERE run IN (%s)" %
+                 ", ".join("?" * len(runs)))
+        parameters = list(runs)
+        if feature is not None:
+            query += " AND feature = ?"
+            parameters.append(feature)
+        if scenario is not None:
+            query += " AND scenario LIKE ?"
+            parameters.append(u"%%%s%%" % scenario)
+        durations = {}
+        for (row_feature, row_scenario, run, result, duration) in self.connection.execute(
+                query + " ORDER BY run, id", parameters):
+            durations.setdefault((row_feature, row_scenario), []).append((run, result, duration))
+        return durations
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+class Trend(object):
+    """How long a scenario took in each run, and whether it regressed in
+    the latest: took longer than the median of the runs before it by more
+    than threshold. Only runs in which it succeeded count, as a failing
+    scenario stops at its first failure"""
+    def __init__(self, feature, scenario, durations, latest_run, threshold, min_change):
+        self.feature = feature
+        self.scenario = scenario
+        # The duration of each run in which the scenario succeeded
+        self.durations = [(run, duration) for (run, result, duration) in durations if result == 'succeeded']
+        self.latest = None
+        self.baseline = None
+        if self.durations and self.durations[-1][0] == latest_run:
+            self.latest = self.durations[-1][1]
+            previous = [duration for (run, duration) in self.durations[:-1]]
+            if previous:
+                self.baseline = median(previous)
+        self.regressed = (self.baseline is not None and
+                          self.latest - self.baseline > max(self.baseline * threshold, min_change))
+
+    def change(self):
+        if self.baseline is None:
+            return None
+        if not self.baseline:
+            return float('inf') if self.latest else 0.0
+        return (self.latest - self.baseline) / self.baseline
+
+def trends(history, runs=DEFAULT_RUNS, threshold=DEFAULT_THRESHOLD, min_change=DEFAULT_MIN_CHANGE,
+           feature=None, scenario=None):
+    """Return a Trend for each scenario over the latest run and up to runs
+    runs before it, in feature and scenario order"""
+    run_ids = history.runs(runs + 1)
+    if not run_ids:
+        return []
+    durations = history.durations(run_ids, feature, scenario)
+    return [Trend(path, name, durations[(path, name)], run_ids[-1], threshold, min_change)
+            for (path, name) in sorted(durations)]
+
+def write_trends(out, found, runs, regressions_only=False):
+    """Write a line for each trend, with the duration of each run (oldest
+    first, up to runs of them before the latest), the latest and the
+    baseline it is compared with. Returns the number of scenarios that
+    regressed"""
+    regressed = [trend for trend in found if trend.regressed]
+    shown = regressed if regressions_only else found
+    columns = min(runs + 1, max([len(trend.durations) for trend in shown] + [1]))
+    width = 8 * columns - 1
+    if shown:
+        print >> out, "%-*s  %9s  %9s  %8s  scenario" % (width, "durations", "latest", "baseline", "change")
+    for trend in shown:
+        durations = " ".join("%7.3f" % duration for (run, duration) in trend.durations[-columns:])
+        change = trend.change()
+        print >> out, (u"%-*s  %9s  %9s  %8s  %s: %s%s" % (
+            width, durations,
+            "%.3fs" % trend.latest if trend.latest is not None else "-",
+            "%.3fs" % trend.baseline if trend.baseline is not None else "-",
+            "%+.1f%%" % (100 * change) if change is not None else "-",
+            trend.feature, trend.scenario, "  REGRESSED" if trend.regressed else "")).encode('utf-8')
+    print >> out, "%d of %d scenarios regressed" % (len(regressed), len(found))
+    return len(regressed)
+
+def feature_path(path):
+    """Return the path a feature file is recorded under"""
+    return path if path == '-' else os.path.normpath(path)
+
+def scenario_name(scenario, row):
+    if row is None:
+        return scenario.text
+    return scenario.text + u" " + format_row(row.data).strip()
+
+class HistoryReporter(ScenarioReporter):
+    """Records the result and duration of each scenario (and each example
+    row) and its steps in history, under the path in paths of the feature
+    they are part of. The features are reported in the order of paths.
+    Everything is written in one transaction, once the run has finished"""
+    def __init__(self, reporter, history, paths):
+        ScenarioReporter.__init__(self, reporter)
+        self.history = history
+        self.paths = [feature_path(path) for path in paths]
+        self.features = 0
+        self.path = None
+        self.test_started = None
+        self.succeeded = True
+        # The (name, result, duration, steps) of the scenarios of a copy
+        self.records = None
+
+    def report(self, event):
+        kind = event.kind
+        if kind is TEST:
+            self.test_started = time.time()
+        elif kind is TEST_RESULT:
+            # current is [name, started, [(step, result, duration)...]]
+            self.current[2].append((step_line(event.node), result_name(event.result),
+                                    time.time() - self.test_started))
+        ScenarioReporter.report(self, event)
+
+    def start_feature(self, feature):
+        self.path = self.paths[self.features] if self.features < len(self.paths) else u""
+        self.features += 1
+        ScenarioReporter.start_feature(self, feature)
+
+    def start_scenario(self, scenario, row):
+        return [scenario_name(scenario, row), time.time(), []]
+
+    def end_scenario(self, current):
+        (name, started, steps) = current
+        # The result of the first step that didn't succeed, as in JSON Lines
+        results = [result for (step, result, duration) in steps if result != 'succeeded']
+        self.add((name, results[0] if results else 'succeeded', time.time() - started, steps))
+
+    def add(self, record):
+        if self.records is not None:
+            self.records.append(record)
+            return
+        (name, result, duration, steps) = record
+        self.succeeded = self.succeeded and result == 'succeeded'
+        self.history.add(self.path, name, result, duration, steps)
+
+    def wrap(self, reporter):
+        reporter = HistoryReporter(reporter, self.history, [])
+        reporter.records = []
+        return reporter
+
+    def own_summary(self):
+        return self.records
+
+    def merge_own(self, records):
+        for record in records:
+            self.add(record)
+
+    def finish(self):
+        ScenarioReporter.finish(self)
+        self.history.end_run(self.succeeded)
@@ -0,0 +1,107 @@
+"""Running each scenario, or each feature, in a child process forked from
+the runner, for run --isolate."""
+
+import os
+import gc
+import sys
+import traceback
+import cPickle as pickle
+from itertools import izip
+from reporters import TextReporter
+import parallel
+
+GRANULARITIES = ['scenario', 'feature']
+
+def freeze():
+    """Get the parent's objects out of the way of the children's garbage
+    collections. Returns whether the children have to do without them"""
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+        return False
+    return True
+
+def groups(units, granularity):
+    """Split units into the lists run by each child"""
+    if granularity == 'scenario':
+        return [[unit] for unit in units]
+    by_feature = []
+    for unit in units:
+        if not by_feature or by_feature[-1][0][0] != unit[0]:
+            by_feature.append([])
+        by_feature[-1].append(unit)
+    return by_feature
+
+def run_child(units, pipe, disable_gc):
+    """Run units in a forked child, sending back the result of each down
+    pipe as it finishes, and then leave the feature context managers that
+    running them entered. Never returns"""
+    status = 0
+    try:
+        if disable_gc:
+            gc.disable()
+        for unit in units:
+            pickle.dump(parallel.run_unit(unit), pipe, pickle.HIGHEST_PROTOCOL)
+            pipe.flush()
+        # os._exit skips everything that would otherwise leave them
+        parallel.leave_feature()
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        # Skip the parent's exit handlers, and whatever its streams still
+        # have buffered
+        os._exit(status)
+
+def fork_units(features, units, disable_gc):
+    """Yield the (output, succeeded, summary) of each of units, run in a
+    child process"""
+    (read_end, write_end) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        run_child(units, os.fdopen(write_end, 'wb'), disable_gc)
+    os.close(write_end)
+    results = os.fdopen(read_end, 'rb')
+    received = 0
+    try:
+        while received < len(units):
+            try:
+                result = pickle.load(results)
+            except EOFError:
+                break
+            received += 1
+            yield result
+    finally:
+        results.close()
+        status = os.waitpid(pid, 0)[1]
+    for unit in units[received:]:
+        yield (parallel.missing_output(features, unit, describe_exit(status)), False, None)
+
+def describe_exit(status):
+    if os.WIFSIGNALED(status):
+        return u"Crashed: its process was killed by signal %d" % os.WTERMSIG(status)
+    return u"Crashed: its process exited with status %d" % os.WEXITSTATUS(status)
+
+def IsolatedTest(features, granularity='scenario', output_stream=sys.stdout, reporter=None):
+    """Run the parsed features in a child process for each scenario (or
+    each feature, by granularity), writing their output to output_stream
+    in feature order with reporter (by default, a TextReporter). Returns
+    whether every test succeeded"""
+    if reporter is None:
+        reporter = TextReporter(output_stream)
+    parallel._features = features
+    parallel._templates.clear()
+    parallel._reporter = reporter
+    units = list(parallel.work_units(features))
+    # Anything still buffered would otherwise be copied into every child
+    output_stream.flush()
+    sys.stdout.flush()
+    disable_gc = freeze()
+    try:
+        results = (result for group in groups(units, granularity)
+                   for result in fork_units(features, group, disable_gc))
+        return parallel.report_units(features, izip(units, results), output_stream, reporter)
+    finally:
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
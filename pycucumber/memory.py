@@ -0,0 +1,116 @@
+"""Tracking how much memory each scenario leaves allocated, for run
+--track-memory."""
+
+import gc
+import sys
+import heapq
+from reporters import ScenarioReporter, describe_scenario
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DEFAULT_THRESHOLD = 64 * 1024
+DEFAULT_TOP = 5
+
+class TracemallocSnapshots(object):
+    """Snapshots of the memory traced by tracemalloc, by line of code"""
+    def __init__(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+
+    def take(self):
+        gc.collect()
+        return tracemalloc.take_snapshot().filter_traces(self.filters)
+
+    def compare(self, before, after, top):
+        """Return the net number of bytes allocated between before and after,
+        and (bytes, count, place) for the top places that allocated them"""
+        stats = after.compare_to(before, 'lineno')
+        places = [(stat.size_diff, stat.count_diff, str(stat.traceback)) for stat in stats if stat.size_diff > 0]
+        return (sum(stat.size_diff for stat in stats), places[:top])
+
+class ObjectSnapshots(object):
+    """Snapshots of the number and size of the objects tracked by the garbage
+    collector, by type, for where tracemalloc is missing. Objects that can't
+    refer to others, such as strings, aren't tracked, so the sizes are only
+    a lower bound.
+
+    A snapshot is a pair of dicts, from the name of a type to a count and to
+    a size. As they only hold strings and numbers, the garbage collector
+    doesn't track them, so they leave themselves out"""
+    def take(self):
+        gc.collect()
+        counts = {}
+        sizes = {}
+        for obj in gc.get_objects():
+            kind = type(obj)
+            name = "%s.%s" % (kind.__module__, kind.__name__)
+            counts[name] = counts.get(name, 0) + 1
+            sizes[name] = sizes.get(name, 0) + sys.getsizeof(obj)
+        return (counts, sizes)
+
+    def compare(self, before, after, top):
+        ((counts_before, sizes_before), (counts_after, sizes_after)) = (before, after)
+        diffs = [(sizes_after.get(name, 0) - sizes_before.get(name, 0),
+                  counts_after.get(name, 0) - counts_before.get(name, 0), "%s objects" % name)
+                 for name in set(sizes_before) | set(sizes_after)]
+        places = heapq.nlargest(top, [diff for diff in diffs if diff[0] > 0])
+        return (sum(size for (size, count, place) in diffs), places)
+
+def snapshots():
+    """Return the best kind of snapshots available"""
+    if tracemalloc is not None:
+        return TracemallocSnapshots()
+    return ObjectSnapshots()
+
+class MemoryReporter(ScenarioReporter):
+    """Takes a snapshot of memory before and after each scenario (and each
+    example row), and adds the scenarios that grew by more than threshold
+    bytes to the end of the report, with the top places that allocated the
+    memory of each"""
+    def __init__(self, reporter, snapshots, threshold=DEFAULT_THRESHOLD, top=DEFAULT_TOP):
+        ScenarioReporter.__init__(self, reporter)
+        self.snapshots = snapshots
+        self.threshold = threshold
+        self.top = top
+        self.scenarios = 0
+        # (name, bytes, places) for every scenario that grew too much
+        self.grown = []
+
+    def start_scenario(self, scenario, row):
+        return (describe_scenario(self.feature, scenario, row), self.snapshots.take())
+
+    def end_scenario(self, current):
+        (name, before) = current
+        (growth, places) = self.snapshots.compare(before, self.snapshots.take(), self.top)
+        self.scenarios += 1
+        if growth > self.threshold:
+            self.grown.append((name, growth, places))
+
+    def wrap(self, reporter):
+        return MemoryReporter(reporter, self.snapshots, self.threshold, self.top)
+
+    def own_summary(self):
+        return (self.scenarios, self.grown)
+
+    def merge_own(self, summary):
+        (scenarios, grown) = summary
+        self.scenarios += scenarios
+        self.grown.extend(grown)
+
+    def finish(self):
+        self.reporter.finish()
+        write_growth(sys.stdout, self.grown, self.scenarios, self.threshold)
+        sys.stdout.flush()
+
+def write_growth(out, grown, scenarios, threshold):
+    print >> out
+    print >> out, "%d of %d scenarios left more than %d bytes allocated%s" % (
+        len(grown), scenarios, threshold, ":" if grown else "")
+    for (name, growth, places) in grown:
+        print >> out, (u"  %+10d bytes  %s" % (growth, name)).encode('utf-8')
+        for (size, count, place) in places:
+            print >> out, "      %+10d bytes %+7d  %s" % (size, count, place)
@@ -0,0 +1,93 @@
+"""Writing runner output in batches.
+
+Writing and flushing the output of every event separately costs at least
+two system calls per test, which slows down runs whose output goes to a
+pipe. A BufferedOutput holds on to what is written to it until it is
+flushed, which the runners do at the end of each scenario and before
+prompting for input, or until interval seconds have passed since it was
+last flushed. So that a long step doesn't hold back what came before it, a
+thread flushes the output once it is due, even if nothing more is written.
+Call stop when done with it, to stop the thread."""
+
+from __future__ import with_statement
+
+import sys
+import time
+import threading
+from StringIO import StringIO
+
+# The longest time, in seconds, that buffered output is held back for
+DEFAULT_INTERVAL = 1.0
+
+class BufferedOutput(object):
+    """Stands in for a file object (usually sys.stdout, so that what steps
+    print stays in order with the runner's output). An interval of 0 passes
+    every write straight on to the stream, and flushes it"""
+    def __init__(self, stream, interval=DEFAULT_INTERVAL):
+        self.stream = stream
+        self.interval = interval
+        self.pending = []
+        self.last_flush = time.time()
+        # Used by print to remember whether it owes a space
+        self.softspace = 0
+        # Held while pending changes, and while it is written out, as the
+        # timer thread flushes as well
+        self.lock = threading.Lock()
+        self.timer = None
+        self.stopped = threading.Event()
+
+    def write(self, text):
+        with self.lock:
+            self.pending.append(text)
+            due = self.interval <= 0 or time.time() - self.last_flush >= self.interval
+        if due:
+            self.flush()
+        elif self.timer is None:
+            self.timer = threading.Thread(target=self.flush_when_due)
+            self.timer.setDaemon(True)
+            self.timer.start()
+
+    def flush_when_due(self):
+        """Flush whatever is pending once interval seconds have passed since
+        the last flush, until stopped"""
+        while not self.stopped.isSet():
+            if self.pending:
+                wait = self.last_flush + self.interval - time.time()
+                if wait <= 0:
+                    self.flush()
+                    continue
+            else:
+                wait = self.interval
+            self.stopped.wait(wait)
+
+    def flush(self):
+        with self.lock:
+            self.last_flush = time.time()
+            if not self.pending:
+                return
+            (pending, self.pending) = (self.pending, [])
+            if isinstance(self.stream, file):
+                # Encode unicode as the file itself would have, so that the
+                # pieces can be joined and written at once
+                encoding = self.stream.encoding or sys.getdefaultencoding()
+                self.stream.write("".join(text.encode(encoding) if isinstance(text, unicode) else text
+                                          for text in pending))
+            else:
+                for text in pending:
+                    self.stream.write(text)
+            self.stream.flush()
+
+    def stop(self):
+        """Stop the timer thread, and flush whatever is pending"""
+        self.stopped.set()
+        self.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class CapturedOutput(StringIO):
+    """A StringIO for capturing the output of a scenario, which encodes
+    unicode as utf-8, so that the runner's output can be mixed with the
+    byte strings steps print"""
+    def write(self, text):
+        StringIO.write(self, text.encode('utf-8') if isinstance(text, unicode) else text)
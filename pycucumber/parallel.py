@@ -0,0 +1,184 @@
+"""Running features across a pool of worker processes.
+
+The features are parsed, and the rules loaded, before the pool is forked,
+so every worker starts with both already in memory. Work is handed out a
+scenario (or a single example row of a scenario) at a time. Each worker
+captures the output of the units it runs, and the parent writes them out
+in the same order a serial run would have.
+
+A serial run enters the feature context managers once around the
+scenarios of each feature. A worker enters them when it gets its first
+unit of a feature, and stays in them while the units it gets are of the
+same feature, so they are entered once for each feature in every worker
+that runs part of it, rather than for every unit. Units are handed out in
+order, so a worker never comes back to a feature it has left."""
+
+from __future__ import with_statement
+
+import sys
+import contextlib
+import multiprocessing
+import multiprocessing.util
+from itertools import izip
+from ast_nodes import Scenario
+from ast_visitors import TestRunner, ExecutionContext, OutlineTemplate, feature_managers
+from events import Event, FEATURE, HEADER, MORE_EXAMPLES
+from reporters import TextReporter
+from output import CapturedOutput
+from walker import walk
+import core
+
+# The depths at which a serial TestRunner writes the scenarios of a
+# feature, the More Examples of a scenario, and the example rows
+SCENARIO_DEPTH = 2
+EXAMPLES_DEPTH = 4
+ROW_DEPTH = 6
+
+# The indents at which a TextReporter writes a scenario and its steps, for
+# the output that stands in for a unit that couldn't be run
+SCENARIO_INDENT = 4
+STEP_INDENT = 10
+
+# Set in the parent before the pool is forked, and so inherited by the workers
+_features = []
+_templates = {}
+_reporter = None
+
+# The index of the feature whose feature context managers this worker is
+# in, and the nested context they were entered through
+_entered = [None, None]
+
+def work_units(features):
+    """Yield a (feature, scenario, row) index triple for every unit of work.
+
+    The row is None for the unit that runs the scenario itself"""
+    for (feature_index, feature) in enumerate(features):
+        for (scenario_index, scenario) in enumerate(feature.scenarios):
+            yield (feature_index, scenario_index, None)
+            if scenario.more_examples:
+                for row_index in range(len(scenario.more_examples.rows)):
+                    yield (feature_index, scenario_index, row_index)
+
+def header_events(feature):
+    yield Event(FEATURE, feature)
+    for child in feature.header():
+        yield Event(HEADER, child, indent=SCENARIO_DEPTH)
+
+def template_for(runner, unit):
+    (feature_index, scenario_index, row_index) = unit
+    key = (feature_index, scenario_index)
+    if key not in _templates:
+        scenario = _features[feature_index].scenarios[scenario_index]
+        _templates[key] = OutlineTemplate(scenario, runner.bags)
+    return _templates[key]
+
+def scenario_events(runner, scenario):
+    context = ExecutionContext(SCENARIO_DEPTH)
+    yield runner.visitScenario(Scenario(scenario.text, scenario.conditions, scenario.steps, None), context)
+    if scenario.more_examples:
+        yield Event(MORE_EXAMPLES, scenario.more_examples, indent=EXAMPLES_DEPTH)
+
+def row_events(runner, row, template):
+    return runner.visitExampleRow(row, ExecutionContext(ROW_DEPTH, template=template))
+
+def unit_events(runner, unit):
+    (feature_index, scenario_index, row_index) = unit
+    scenario = _features[feature_index].scenarios[scenario_index]
+    if row_index is None:
+        return scenario_events(runner, scenario)
+    return row_events(runner, scenario.more_examples.rows[row_index], template_for(runner, unit))
+
+def run_unit(unit):
+    """Run one unit of work in a worker. Returns the output it would have
+    written in a serial run, whether its tests all succeeded, and the
+    summary of the reporter that wrote the output"""
+    runner = TestRunner(core._givens, core._whens, core._thens)
+    output = CapturedOutput()
+    reporter = _reporter.copy(output, _features[unit[0]])
+    # Step functions print to sys.stdout, so it has to be captured along
+    # with the runner's own output to keep them in order
+    stdout = sys.stdout
+    sys.stdout = output
+    try:
+        enter_feature(unit[0])
+        core.run_events(walk(unit_events(runner, unit)), output, False, reporter)
+    finally:
+        sys.stdout = stdout
+    return (output.getvalue(), runner.succeeded, reporter.summary())
+
+def enter_feature(feature_index):
+    """Enter the feature context managers for feature feature_index in this
+    worker, leaving those of the feature before first, unless it is already
+    in them"""
+    if _entered[0] == feature_index:
+        return
+    leave_feature()
+    managers = contextlib.nested(*feature_managers)
+    managers.__enter__()
+    _entered[:] = [feature_index, managers]
+
+def leave_feature():
+    """Leave the feature context managers this worker is in, if any"""
+    (feature_index, managers) = _entered
+    _entered[:] = [None, None]
+    if managers is not None:
+        managers.__exit__(None, None, None)
+
+def start_worker():
+    # Leave the last feature when the pool closes down (but not if it is
+    # terminated)
+    multiprocessing.util.Finalize(None, leave_feature, exitpriority=10)
+
+def missing_output(features, unit, reason):
+    """Return the output that stands in for a unit that couldn't be run,
+    saying why"""
+    (feature_index, scenario_index, row_index) = unit
+    scenario = features[feature_index].scenarios[scenario_index]
+    return (u"%sScenario: %s%s\n%s(%s)\n" % (
+        u" " * SCENARIO_INDENT, scenario.text,
+        u" (example row %d)" % (row_index + 1) if row_index is not None else u"",
+        u" " * STEP_INDENT, reason)).encode('utf-8')
+
+def ParallelTest(features, processes, output_stream=sys.stdout, reporter=None):
+    """Run the parsed features with a pool of processes workers, writing
+    their output to output_stream in feature order with reporter (by
+    default, a TextReporter). Returns whether every test succeeded"""
+    global _features, _reporter
+    if reporter is None:
+        reporter = TextReporter(output_stream)
+    _features = features
+    _reporter = reporter
+    _templates.clear()
+    units = list(work_units(features))
+    # Anything still buffered would otherwise be copied into every worker
+    output_stream.flush()
+    pool = multiprocessing.Pool(processes, start_worker)
+    try:
+        succeeded = report_units(features, izip(units, pool.imap(run_unit, units)), output_stream, reporter)
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    # Closing rather than terminating the pool lets the workers leave
+    # their last feature
+    pool.close()
+    pool.join()
+    return succeeded
+
+def report_units(features, results, output_stream, reporter):
+    """Write out the (unit, (output, succeeded, summary)) of each unit in
+    results, which are in the order of work_units, and merge their
+    summaries into reporter. A unit that couldn't be run has no summary.
+    Returns whether every unit succeeded"""
+    succeeded = True
+    for (unit, (output, unit_succeeded, summary)) in results:
+        (feature_index, scenario_index, row_index) = unit
+        if scenario_index == 0 and row_index is None:
+            for event in header_events(features[feature_index]):
+                reporter.report(event)
+        if summary is not None:
+            reporter.merge(summary)
+        output_stream.write(output if isinstance(output, str) else output.encode('utf-8'))
+        output_stream.flush()
+        succeeded = succeeded and unit_succeeded
+    return succeeded
@@ -0,0 +1,203 @@
+"""Profiling features, scenarios or step definitions, for run --profile.
+
+A ProfilingReporter profiles each scenario (and each example row) while it
+runs, on whichever thread or process runs it. With the feature granularity,
+the profiles of the scenarios of a feature are added together. With the step granularity, a
+StepProfiler is called by call_test around every call of a step
+definition instead, so that the profiles only cover step code.
+
+Profiles are written as pstats files, named after the feature and scenario
+or step definition they cover, or all added together into one file."""
+
+from __future__ import with_statement
+
+import os
+import re
+import pstats
+import cProfile
+import threading
+import ast_visitors
+from reporters import ScenarioReporter, describe_scenario
+from timing import describe_definition
+
+GRANULARITIES = ['feature', 'scenario', 'step']
+DEFAULT_DIRECTORY = '.pycucumber_profiles'
+SUFFIX = '.pstats'
+
+def file_name(name):
+    """Return a file name (without the suffix) made up of the letters and
+    digits of name"""
+    if isinstance(name, unicode):
+        name = name.encode('ascii', 'ignore')
+    return re.sub(r'[^A-Za-z0-9]+', '-', name).strip('-').lower()[:80] or 'unnamed'
+
+def profile_stats(profile):
+    """Return the statistics of profile, which can be pickled and passed to
+    Profiles.add"""
+    profile.create_stats()
+    return profile.stats
+
+class ProfileStats(object):
+    """Stands in for a profiler, to make a pstats.Stats from statistics
+    already taken from one"""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+class Profiles(object):
+    """The profiles of the units of a run. Each is written to directory, as
+    a pstats file named after the unit, or if merged_file is set, they are
+    all added together and written there at the end"""
+    def __init__(self, directory=DEFAULT_DIRECTORY, merged_file=None):
+        self.directory = directory
+        self.merged_file = merged_file
+        # name -> pstats.Stats
+        self.units = {}
+        self.used_names = set()
+        self.written = []
+
+    def add(self, name, stats):
+        if self.merged_file is not None:
+            name = None
+        if name in self.units:
+            self.units[name].add(ProfileStats(stats))
+        else:
+            self.units[name] = pstats.Stats(ProfileStats(stats))
+
+    def write(self, name):
+        """Write the profile of the unit name, unless they are being merged,
+        and forget it"""
+        if self.merged_file is not None or name not in self.units:
+            return
+        stats = self.units.pop(name)
+        base = file_name(name)
+        unique = base
+        count = 1
+        while unique in self.used_names:
+            count += 1
+            unique = "%s-%d" % (base, count)
+        self.used_names.add(unique)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, unique + SUFFIX)
+        stats.dump_stats(path)
+        self.written.append(path)
+
+    def finish(self):
+        """Write every profile still to be written. Returns the paths of all
+        the files written"""
+        if self.merged_file is not None:
+            if None in self.units:
+                self.units.pop(None).dump_stats(self.merged_file)
+                self.written.append(self.merged_file)
+        else:
+            for name in sorted(self.units):
+                self.write(name)
+        return self.written
+
+class StepProfiler(object):
+    """Profiles each step definition, with a profiler for each thread, as
+    a profiler can only profile the thread it was enabled on"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.local = threading.local()
+        # (fn, profile) for every thread
+        self.profiles = []
+
+    def install(self):
+        ast_visitors.step_hooks.append(self)
+
+    def uninstall(self):
+        if self in ast_visitors.step_hooks:
+            ast_visitors.step_hooks.remove(self)
+
+    def start(self, fn):
+        profiles = getattr(self.local, 'profiles', None)
+        if profiles is None:
+            profiles = self.local.profiles = {}
+        profile = profiles.get(fn)
+        if profile is None:
+            profile = profiles[fn] = cProfile.Profile()
+            with self.lock:
+                self.profiles.append((fn, profile))
+        profile.enable()
+        return profile
+
+    def stop(self, fn, profile):
+        profile.disable()
+
+    def take(self):
+        """Return the (name, stats) of each profile so far, and start again
+        from nothing"""
+        with self.lock:
+            (profiles, self.profiles) = (self.profiles, [])
+        self.local.profiles = {}
+        return [(describe_definition(fn), profile_stats(profile)) for (fn, profile) in profiles]
+
+class ProfilingReporter(ScenarioReporter):
+    """Adds the profiles of the granularity given to profiles (as do its
+    copies, once merged)"""
+    def __init__(self, reporter, profiles, granularity, step_profiler=None):
+        ScenarioReporter.__init__(self, reporter)
+        self.profiles = profiles
+        self.granularity = granularity
+        self.step_profiler = step_profiler
+        # The (name, stats) of the profiles taken by a copy
+        self.taken = None
+
+    def start_feature(self, feature):
+        self.end_feature()
+        ScenarioReporter.start_feature(self, feature)
+
+    def start_scenario(self, scenario, row):
+        if self.granularity == 'step':
+            return None
+        profile = cProfile.Profile()
+        name = describe_scenario(self.feature, scenario, row)
+        profile.enable()
+        return (name, profile)
+
+    def end_scenario(self, current):
+        (name, profile) = current
+        stats = profile_stats(profile)
+        if self.granularity == 'feature':
+            name = self.feature.text if self.feature else u""
+        self.add(name, stats)
+
+    def add(self, name, stats):
+        if self.taken is not None:
+            self.taken.append((name, stats))
+            return
+        self.profiles.add(name, stats)
+        if self.granularity == 'scenario':
+            self.profiles.write(name)
+
+    def end_feature(self):
+        if self.granularity == 'feature' and self.feature is not None and self.taken is None:
+            self.profiles.write(self.feature.text)
+
+    def wrap(self, reporter):
+        reporter = ProfilingReporter(reporter, self.profiles, self.granularity, self.step_profiler)
+        reporter.taken = []
+        return reporter
+
+    def own_summary(self):
+        taken = self.taken
+        # In a worker process, the step profiles have to be handed back too
+        if self.step_profiler is not None and os.getpid() != self.step_profiler.pid:
+            taken = taken + self.step_profiler.take()
+        return taken
+
+    def merge_own(self, taken):
+        for (name, stats) in taken:
+            self.add(name, stats)
+
+    def finish(self):
+        self.end_feature()
+        if self.step_profiler is not None:
+            for (name, stats) in self.step_profiler.take():
+                self.profiles.add(name, stats)
+        ScenarioReporter.finish(self)
@@ -0,0 +1,447 @@
+"""Writing the events of a TestRunner (see events) as output.
+
+A reporter is handed every event of a run, along with any text that has
+already been written out in full (by CheckRules, or by another reporter of
+the same kind, as the runners that buffer the output of each scenario do),
+and formats only what it actually writes.
+
+Runners that run scenarios on their own give each of them a copy of the
+reporter to write to a buffer with, and merge the copy back in once they
+write the buffer out, so that a reporter can report on the whole run in
+finish."""
+
+import re
+import sys
+import time
+import json
+from xml.sax.saxutils import escape, quoteattr
+from ast_nodes import Purpose, Role, Goal, Condition, Action, Result
+from ast_visitors import (Succeeded, Failed, Skipped, format_feature, format_purpose, format_role,
+                          format_goal, format_scenario, format_test, format_more_examples, format_row,
+                          format_test_result)
+from events import (FEATURE, HEADER, SCENARIO, TEST, TEST_RESULT, MORE_EXAMPLES, ROW, ROW_RESULT,
+                    SCENARIO_END)
+
+INDENT = u"  "
+
+PREFIXES = {Condition: "Given", Action: "When", Result: "Then"}
+
+HEADER_FORMATTERS = {Purpose: format_purpose, Role: format_role, Goal: format_goal}
+
+def describe_scenario(feature, scenario, row=None):
+    """Return the name of a scenario, or of one of its example rows, within
+    its feature"""
+    return u"%s: %s%s" % (feature.text if feature else u"", scenario.text,
+                          u" |%s|" % u"|".join(row.data) if row is not None else u"")
+
+class Reporter(object):
+    def __init__(self, stream):
+        self.stream = stream
+
+    def report(self, event):
+        pass
+
+    def write(self, text):
+        """Write text that has already been formatted"""
+        print >> self.stream, text,
+
+    def copy(self, stream, feature):
+        """Return a reporter of the same kind that writes to stream, part
+        way through running feature"""
+        return type(self)(stream)
+
+    def summary(self):
+        """Return what a copy has to add to the report on the whole run, in
+        a form that can be pickled, and sent as JSON (with its tuples
+        turned into lists) by distributed"""
+        return None
+
+    def merge(self, summary):
+        """Add the summary of a copy to the report on the whole run"""
+        pass
+
+    def finish(self):
+        """Called once every feature of a run has been run"""
+        self.stream.flush()
+
+class ScenarioReporter(Reporter):
+    """Passes everything on to reporter, calling start_scenario before each
+    scenario (and each example row) and end_scenario after it, outside of
+    what reporter does with the same events. Whatever start_scenario returns
+    is handed to end_scenario.
+
+    Subclasses give wrap(reporter), which returns a reporter of their kind,
+    with the same settings, wrapping reporter, for a copy. What a copy adds
+    to the summary of reporter comes from own_summary, and is handed to
+    merge_own"""
+    def __init__(self, reporter):
+        Reporter.__init__(self, reporter.stream)
+        self.reporter = reporter
+        self.feature = None
+        self.row = None
+        self.current = None
+
+    def report(self, event):
+        kind = event.kind
+        if kind is SCENARIO_END or kind is MORE_EXAMPLES:
+            if self.current is not None:
+                (current, self.current) = (self.current, None)
+                self.end_scenario(current)
+        elif kind is ROW:
+            self.row = event.node
+        elif kind is FEATURE:
+            self.start_feature(event.node)
+        self.reporter.report(event)
+        if kind is SCENARIO:
+            self.current = self.start_scenario(event.node, self.row)
+            self.row = None
+
+    def start_feature(self, feature):
+        self.feature = feature
+
+    def start_scenario(self, scenario, row):
+        return None
+
+    def end_scenario(self, current):
+        pass
+
+    def write(self, text):
+        self.reporter.write(text)
+
+    def copy(self, stream, feature):
+        reporter = self.wrap(self.reporter.copy(stream, feature))
+        reporter.feature = feature
+        return reporter
+
+    def own_summary(self):
+        return None
+
+    def merge_own(self, summary):
+        pass
+
+    def summary(self):
+        return (self.reporter.summary(), self.own_summary())
+
+    def merge(self, summary):
+        (reporter_summary, own_summary) = summary
+        self.reporter.merge(reporter_summary)
+        self.merge_own(own_summary)
+
+    def finish(self):
+        self.reporter.finish()
+
+class TextReporter(Reporter):
+    """Writes out every node, and the result of every test, as it is run"""
+    def report(self, event):
+        if event.kind is SCENARIO_END:
+            self.stream.flush()
+        else:
+            print >> self.stream, self.format(event),
+
+    def format(self, event):
+        kind = event.kind
+        if kind is TEST_RESULT:
+            return format_test_result(event.result)
+        indent = INDENT * event.indent
+        node = event.node
+        if kind is TEST:
+            return indent + format_test(node, PREFIXES[type(node)], event.first, INDENT)
+        if kind is ROW_RESULT:
+            return indent + format_test_result(event.result)
+        if kind is SCENARIO:
+            return indent + format_scenario(node)
+        if kind is ROW:
+            return indent + format_row(node.data)
+        if kind is MORE_EXAMPLES:
+            return indent + format_more_examples(node)
+        if kind is HEADER:
+            return indent + HEADER_FORMATTERS[type(node)](node)
+        return indent + format_feature(node)
+
+class ProgressReporter(Reporter):
+    """Writes a single character for each test as it is run, and the
+    details of just the tests that failed, or could not be run, at the end"""
+    SYMBOLS = {Succeeded: '.', Failed: 'F', Skipped: '-'}
+    # Every other result means the test couldn't be run at all
+    OTHER = '?'
+    LABELS = [('.', 'succeeded'), ('F', 'failed'), ('?', 'unimplemented or ambiguous'), ('-', 'skipped')]
+
+    def __init__(self, stream):
+        Reporter.__init__(self, stream)
+        self.feature = None
+        self.scenario = None
+        self.row = None
+        self.counts = dict.fromkeys([symbol for (symbol, label) in self.LABELS], 0)
+        self.failures = []
+
+    def report(self, event):
+        kind = event.kind
+        if kind is TEST_RESULT:
+            symbol = self.SYMBOLS.get(type(event.result), self.OTHER)
+            self.counts[symbol] += 1
+            if symbol in 'F?':
+                self.failures.append(self.describe(event.node, event.result))
+            self.stream.write(symbol)
+        elif kind is SCENARIO_END:
+            self.stream.flush()
+        elif kind is SCENARIO:
+            self.scenario = event.node
+        elif kind is ROW:
+            self.row = event.node
+        elif kind is ROW_RESULT:
+            self.row = None
+        elif kind is FEATURE:
+            self.feature = event.node
+
+    def describe(self, test, result):
+        lines = [format_feature(self.feature) if self.feature else u"",
+                 INDENT + format_scenario(self.scenario)]
+        if self.row is not None:
+            lines.append(INDENT * 2 + format_row(self.row.data))
+        lines.append(INDENT * 2 + format_test(test, PREFIXES[type(test)], True, INDENT) + u"\n")
+        lines.append(INDENT * 3 + format_test_result(result))
+        return u"".join(lines)
+
+    def write(self, text):
+        self.stream.write(text)
+
+    def copy(self, stream, feature):
+        reporter = ProgressReporter(stream)
+        reporter.feature = feature
+        return reporter
+
+    def summary(self):
+        return (self.counts, self.failures)
+
+    def merge(self, summary):
+        (counts, failures) = summary
+        for (symbol, count) in counts.items():
+            self.counts[symbol] += count
+        self.failures.extend(failures)
+
+    def finish(self):
+        self.stream.write("\n")
+        if self.failures:
+            self.stream.write("\n")
+            for failure in self.failures:
+                self.stream.write(failure)
+                self.stream.write("\n")
+        total = sum(self.counts.values())
+        self.stream.write("%d test%s: %s\n" % (
+            total, "" if total == 1 else "s",
+            ", ".join("%d %s" % (self.counts[symbol], label)
+                      for (symbol, label) in self.LABELS if self.counts[symbol]) or "none run"))
+        self.stream.flush()
+
+class RecordReporter(Reporter):
+    """Writes a record of each scenario, and of each example row, once it
+    has been run, keeping nothing in memory but the scenario being run (so
+    along with StreamTest, which doesn't keep the parsed feature either, a
+    run's memory use doesn't grow with the number of scenarios).
+
+    Copies keep hold of their records, to be written by the reporter they
+    are merged into, rather than writing them with the output of the
+    scenario, so that what steps print never ends up in the middle of the
+    records. Text that has already been formatted (which, from a copy, is
+    only what steps printed) goes to sys.stdout, as it would in a serial run.
+    Subclasses set format_record to the function that turns a record (see
+    scenario_record) into the utf-8 encoded string written for it.
+
+    Each record written gives the path of its feature file, from paths (see
+    locate_features), and the position of its scenario in the run, as the
+    [feature index, scenario index] of positions, or counted from the
+    features and scenarios reported if not given"""
+    def __init__(self, stream):
+        Reporter.__init__(self, stream)
+        self.feature = None
+        self.paths = []
+        self.positions = None
+        self.feature_index = -1
+        self.scenario_index = -1
+        self.row = None
+        # [scenario, row, [(test, result, duration)...]]
+        self.current = None
+        self.test_started = None
+        self.records = None
+
+    def report(self, event):
+        kind = event.kind
+        if kind is TEST:
+            self.test_started = time.time()
+        elif kind is TEST_RESULT:
+            self.current[2].append((event.node, event.result, time.time() - self.test_started))
+        elif kind is SCENARIO:
+            self.current = [event.node, self.row, []]
+            self.row = None
+        elif kind is SCENARIO_END or kind is MORE_EXAMPLES:
+            # The record of a scenario with More Examples is written before
+            # those of its rows
+            self.end_scenario()
+        elif kind is ROW:
+            self.row = event.node
+        elif kind is FEATURE:
+            self.feature_index += 1
+            self.scenario_index = -1
+            self.start_feature(event.node)
+
+    def locate_features(self, paths, positions=None):
+        """Give the path of the feature file of each feature to be reported,
+        in order, and, for a run of only some of their scenarios, the
+        [feature index, scenario index] each scenario had in the whole run,
+        by feature"""
+        self.paths = paths
+        self.positions = positions
+
+    def end_scenario(self):
+        if self.current is not None:
+            (scenario, row, steps) = self.current
+            self.current = None
+            self.write_record(scenario_record(self.feature, scenario, row, steps))
+
+    def write_record(self, record):
+        if self.records is None:
+            self.locate(record)
+            self.stream.write(self.format_record(record))
+            self.stream.flush()
+        else:
+            self.records.append(record)
+
+    def locate(self, record):
+        """Add the path and position of the scenario of record to it"""
+        if record['row'] is None:
+            self.scenario_index += 1
+        if self.positions is not None:
+            position = self.positions[self.feature_index][self.scenario_index]
+        else:
+            position = (self.feature_index, self.scenario_index)
+        record['path'] = self.paths[self.feature_index] if 0 <= self.feature_index < len(self.paths) else None
+        record['position'] = list(position)
+
+    def start_feature(self, feature):
+        self.feature = feature
+
+    def write(self, text):
+        print >> sys.stdout, text,
+
+    def copy(self, stream, feature):
+        reporter = type(self)(stream)
+        reporter.feature = feature
+        reporter.records = []
+        return reporter
+
+    def summary(self):
+        return self.records
+
+    def merge(self, records):
+        for record in records:
+            self.write_record(record)
+
+def result_name(result):
+    return type(result).__name__.lower()
+
+def first_failure(steps):
+    """Return the test and result of the first of steps that didn't
+    succeed, or (None, None) if they all did"""
+    for (test, result, duration) in steps:
+        if not result.is_success():
+            return (test, result)
+    return (None, None)
+
+def step_line(test):
+    return format_test(test, PREFIXES[type(test)], True, INDENT)
+
+def scenario_record(feature, scenario, row, steps):
+    """Return the record of a scenario as a dict, as written by the
+    JSONLinesReporter and read back by the merge command"""
+    (test, result) = first_failure(steps)
+    return {'feature': feature.text if feature else None,
+            'scenario': scenario.text,
+            'row': row.data if row is not None else None,
+            'result': result_name(result) if result else 'succeeded',
+            'duration': sum(duration for (step, step_result, duration) in steps),
+            'steps': [step_record(*step) for step in steps]}
+
+def step_record(test, result, duration):
+    step = {'step': step_line(test), 'result': result_name(result), 'duration': duration}
+    if isinstance(result, Failed):
+        step['reason'] = result.reason
+    elif not isinstance(result, (Succeeded, Skipped)):
+        step['reason'] = unicode(result)
+    return step
+
+def json_line(record):
+    """Return the JSON Lines line of the record of a scenario"""
+    return json.dumps(record, sort_keys=True) + "\n"
+
+class JSONLinesReporter(RecordReporter):
+    """Writes a JSON object on a line of its own for each scenario"""
+    format_record = staticmethod(json_line)
+
+# Characters that can't appear in an XML document at all
+INVALID_XML = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def xml_text(text):
+    return escape(INVALID_XML.sub(u'?', text))
+
+def xml_attribute(text):
+    return quoteattr(INVALID_XML.sub(u'?', text))
+
+def junit_testcase(record):
+    """Return the testcase element of the record of a scenario, as a utf-8
+    encoded string"""
+    name = record['scenario']
+    if record['row'] is not None:
+        name += u" " + format_row(record['row']).strip()
+    lines = [u'  <testcase classname=%s name=%s time="%.6f">' % (
+        xml_attribute(record['feature'] or u""), xml_attribute(name), record['duration'])]
+    failures = [step for step in record['steps'] if step['result'] != 'succeeded']
+    if failures:
+        step = failures[0]
+        if step['result'] == 'failed':
+            lines.append(u'    <failure message=%s>%s</failure>' % (xml_attribute(step['step']),
+                                                                   xml_text(step['reason'])))
+        elif step['result'] == 'skipped':
+            lines.append(u'    <skipped/>')
+        else:
+            lines.append(u'    <error message=%s/>' % xml_attribute(u"%s: %s" % (step['step'], step['reason'])))
+    lines.append(u'    <system-out>%s</system-out>' % xml_text(u"".join(
+        u"%s (%s) %.6fs\n" % (step['step'], step['result'], step['duration']) for step in record['steps'])))
+    lines.append(u'  </testcase>\n')
+    return u"\n".join(lines).encode('utf-8')
+
+class JUnitReporter(RecordReporter):
+    """Writes a JUnit XML document, with a testsuite for each feature and a
+    testcase for each scenario. As the document is written as the run
+    goes, a testsuite doesn't give the number of its tests or failures"""
+    format_record = staticmethod(junit_testcase)
+
+    def __init__(self, stream):
+        RecordReporter.__init__(self, stream)
+        self.document_started = False
+        self.in_suite = False
+
+    def start_document(self):
+        if not self.document_started:
+            self.document_started = True
+            self.stream.write('<?xml version="1.0" encoding="utf-8"?>\n<testsuites>\n')
+
+    def start_feature(self, feature):
+        RecordReporter.start_feature(self, feature)
+        self.start_suite(feature.text)
+
+    def start_suite(self, name):
+        self.start_document()
+        if self.in_suite:
+            self.stream.write('</testsuite>\n')
+        self.stream.write((u'<testsuite name=%s>\n' % xml_attribute(name)).encode('utf-8'))
+        self.in_suite = True
+
+    def finish(self):
+        self.start_document()
+        if self.in_suite:
+            self.stream.write('</testsuite>\n')
+        self.stream.write('</testsuites>\n')
+        self.stream.flush()
+
+REPORTERS = {'text': TextReporter, 'progress': ProgressReporter, 'junit': JUnitReporter,
+             'jsonl': JSONLinesReporter}
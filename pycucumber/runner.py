@@ -3,10 +3,35 @@ from __future__ import with_statement
 import sys
 import pprint
 import os
-from ast_visitors import YieldResults
-from pycucumber import Test, display_implemented_commands, CheckSyntax, package_globals
+from ast_visitors import TestRunner, YieldResults
+from ast_cache import FeatureCache, DEFAULT_DIRECTORY, DEFAULT_MAX_SIZE
+from parallel import ParallelTest
+from threaded import ThreadedTestRunner
+from cooperative import CooperativeTestRunner
+from compiler import CompiledFeatures, CompiledTest, SOURCE_SUFFIX
+from compiler import DEFAULT_DIRECTORY as DEFAULT_COMPILED_DIRECTORY
+from core import parse_text, run_visitor, _givens, _whens, _thens
+from output import BufferedOutput, DEFAULT_INTERVAL
+from reporters import REPORTERS
+from timing import StepTimer, DurationsReporter
+from profiling import Profiles, StepProfiler, ProfilingReporter, GRANULARITIES
+from profiling import DEFAULT_DIRECTORY as DEFAULT_PROFILE_DIRECTORY
+from memory import MemoryReporter, snapshots, DEFAULT_THRESHOLD, DEFAULT_TOP
+from history import History, HistoryReporter, trends, write_trends, feature_path, DEFAULT_FILE as DEFAULT_HISTORY_FILE
+from history import DEFAULT_RUNS, DEFAULT_THRESHOLD as DEFAULT_REGRESSION_THRESHOLD, DEFAULT_MIN_CHANGE
+from sharding import shard, shard_positions, select_scenarios, read_records, write_merged, merge_summary
+from distributed import CoordinatedTest, work, is_loopback, DEFAULT_ATTEMPTS, DEFAULT_CONNECT_TIMEOUT
+from daemon import serve, DEFAULT_SOCKET
+from isolation import IsolatedTest
+from isolation import GRANULARITIES as ISOLATION_GRANULARITIES
+from pycucumber import StreamTest, display_implemented_commands, CheckSyntax, package_globals
 from argparse import ArgumentParser
 
+# The formats whose reports can't have anything else mixed in with them
+RECORD_FORMATS = ['junit', 'jsonl']
+
+COMMANDS = ['list', 'run', 'check', 'compile', 'history', 'merge', 'worker', 'serve']
+
 def load_rules(rules):
     for rule in rules:
         old_path = sys.path
@@ -38,29 +63,152 @@ def main():
     
     rules = []
     args = sys.argv[1:]
-    while args and args[0] not in ['list', 'run', 'check']:
+    while args and args[0] not in COMMANDS:
         rules.append(args.pop(0))
 
-    if not rules:
+    # The history and merge commands can do without rules
+    if not rules and args[:1] not in (['history'], ['merge']):
         print 'Must specify at least one rule file'
         return 1
 
     load_rules(rules)
 
+    parser = make_parser()
+    args = parser.parse_args(args)
+    # For the workers that run --coordinator starts
+    args.rules = rules
+    return execute(parser, args)
+
+def make_parser():
+    """Return the parser of the command line after the rule files, with the
+    options the rules added"""
     parser = ArgumentParser()
     subparsers = parser.add_subparsers(dest='command')
     parser_list = subparsers.add_parser('list', help='list all commands implemented in the rule files')
     parser_check = subparsers.add_parser('check', help='check the syntax of the specified feature files')
     parser_check.add_argument('feature', nargs='+')
+    parser_compile = subparsers.add_parser('compile', help='compile the specified feature files into Python code, '
+                                           'unless they or the rule files have not changed since they were last compiled')
+    parser_compile.add_argument('feature', nargs='+')
+    parser_history = subparsers.add_parser('history', help='report how long each scenario took over the last runs '
+                                           'recorded with run --history, and which have regressed since')
+    parser_history.add_argument('--history', metavar='FILE', default=DEFAULT_HISTORY_FILE,
+                                help='database the runs were recorded in (default: %(default)s)')
+    parser_history.add_argument('--runs', type=int, metavar='N', default=DEFAULT_RUNS,
+                                help='number of runs before the latest to compare it with (default: %(default)s)')
+    parser_history.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                                help='fraction of the median of the earlier runs by which a scenario has to have '
+                                'slowed down to have regressed (default: %(default)s)')
+    parser_history.add_argument('--min-change', type=float, metavar='SECONDS', default=DEFAULT_MIN_CHANGE,
+                                help='smallest slowdown, in seconds, that counts as a regression (default: %(default)s)')
+    parser_history.add_argument('--feature', metavar='PATH', help='only report the scenarios of feature file PATH')
+    parser_history.add_argument('--scenario', metavar='TEXT', help='only report the scenarios whose text contains TEXT')
+    parser_history.add_argument('--regressions', action='store_true', help='only report the scenarios that regressed')
+    parser_merge = subparsers.add_parser('merge', help='merge the JSON Lines reports of the shards of a run '
+                                         '(see run --shard) into one report, and exit with 1 if any scenario '
+                                         'did not succeed')
+    parser_merge.add_argument('shard_report', nargs='+', metavar='report')
+    parser_merge.add_argument('--format', choices=['jsonl', 'junit'], default='jsonl',
+                              help='format of the merged report (default: %(default)s)')
+    parser_merge.add_argument('--report', metavar='FILE', help='write the merged report to FILE rather than standard output')
+    parser_worker = subparsers.add_parser('worker', help='run scenarios handed out by the run --coordinator at '
+                                          'ADDRESS until it has none left')
+    parser_worker.add_argument('address', metavar='ADDRESS')
+    parser_worker.add_argument('--connect-timeout', type=float, metavar='SECONDS', default=DEFAULT_CONNECT_TIMEOUT,
+                               help='how long to keep trying to connect to the coordinator (default: %(default)s)')
+    parser_serve = subparsers.add_parser('serve', help='keep the rules loaded, and carry out the commands sent by '
+                                         'pycucumber/client.py, reloading the rule files when they change')
+    parser_serve.add_argument('--socket', metavar='PATH', default=DEFAULT_SOCKET,
+                              help='Unix socket to listen on (default: %(default)s)')
     parser_run = subparsers.add_parser('run', help='run the specified feature files')
     parser_run.add_argument('feature', nargs='+')
     parser_run.add_argument('-i', '--interactive', action='store_true')
+    parser_run.add_argument('-j', '--jobs', type=int, default=1,
+                            help='number of worker processes to run scenarios in. Feature context managers are '
+                            'entered once for each feature in each worker that runs part of it (default: %(default)s)')
+    parser_run.add_argument('--threads', type=int, default=1,
+                            help='number of scenarios of each feature to run concurrently in threads (default: %(default)s)')
+    parser_run.add_argument('--concurrent', type=int, default=1,
+                            help='number of scenarios of each feature to run concurrently on one thread, '
+                            'switching between them while coroutine steps wait (default: %(default)s)')
+    parser_run.add_argument('--isolate', choices=ISOLATION_GRANULARITIES,
+                            help='run each scenario, or each feature, in a process of its own, forked from the runner '
+                            'once the rules are loaded, so that what one leaves behind in module globals can\'t '
+                            'affect the next, entering the feature context managers once in each process')
+    parser_run.add_argument('--compiled', action='store_true',
+                            help='run the compiled code of each feature, compiling it first if need be')
+    parser_run.add_argument('--stream', action='store_true',
+                            help='run each scenario as soon as it is parsed, without keeping the parsed feature in memory. '
+                            'A feature named - is read from stdin')
+    parser_run.add_argument('--format', choices=sorted(REPORTERS), default='text',
+                            help='how to report the run: text writes out every scenario and test, progress a single '
+                            'character for each test and the details of just the failures, junit a JUnit XML '
+                            'document and jsonl a JSON object for each scenario. Unless junit or jsonl go to a '
+                            '--report file, what the steps print goes to standard error (default: %(default)s)')
+    parser_run.add_argument('--durations', type=int, metavar='N', default=0,
+                            help='time every step definition and scenario, and end with the N slowest of each, and '
+                            'how much time was spent in step definitions')
+    parser_run.add_argument('--profile', choices=GRANULARITIES,
+                            help='profile each feature, each scenario, or the code of each step definition, '
+                            'and write a pstats file for each')
+    parser_run.add_argument('--profile-dir', default=DEFAULT_PROFILE_DIRECTORY,
+                            help='directory to write profiles to (default: %(default)s)')
+    parser_run.add_argument('--profile-merged', metavar='FILE',
+                            help='add all the profiles together, and write them to FILE instead')
+    parser_run.add_argument('--track-memory', action='store_true',
+                            help='take a snapshot of memory before and after each scenario, and end with the scenarios '
+                            'that left the most allocated, and where it was allocated')
+    parser_run.add_argument('--memory-threshold', type=int, metavar='BYTES', default=DEFAULT_THRESHOLD,
+                            help='smallest growth in memory, in bytes, for a scenario to be reported (default: %(default)s)')
+    parser_run.add_argument('--memory-top', type=int, metavar='N', default=DEFAULT_TOP,
+                            help='number of places that allocated memory to report for each scenario (default: %(default)s)')
+    parser_run.add_argument('--history', metavar='FILE', nargs='?', const=DEFAULT_HISTORY_FILE,
+                            help='record the result and duration of every scenario and step in the SQLite database '
+                            'FILE (default: %s), for the history command' % DEFAULT_HISTORY_FILE)
+    parser_run.add_argument('--shard', type=shard, metavar='I/N',
+                            help='only run the scenarios of shard I (from 1) of N, for splitting a run between N '
+                            'machines that are all given the same feature files')
+    parser_run.add_argument('--shard-history', metavar='FILE',
+                            help='balance the shards by the durations of the runs recorded in FILE (by default, the '
+                            '--history file, if any), rather than by the number of scenarios')
+    parser_run.add_argument('--coordinator', metavar='ADDRESS',
+                            help='hand the scenarios out to the workers that connect to ADDRESS (unix:PATH, HOST:PORT '
+                            'or PORT, on 127.0.0.1), started with the worker command')
+    parser_run.add_argument('--allow-remote-workers', action='store_true',
+                            help='with --coordinator, let it listen on a HOST other than the loopback interface, for '
+                            'workers on other machines, which are sent the features and trusted with their results')
+    parser_run.add_argument('--local-workers', type=int, metavar='N', default=0,
+                            help='with --coordinator, also start N workers on this machine, replacing those that die')
+    parser_run.add_argument('--unit-attempts', type=int, metavar='N', default=DEFAULT_ATTEMPTS,
+                            help='with --coordinator, how many workers a scenario is given to before it is reported '
+                            'as lost, if they die running it (default: %(default)s)')
+    parser_run.add_argument('--report', metavar='FILE',
+                            help='write the junit or jsonl report to FILE, leaving standard output to what the steps print')
+    for subparser in (parser_compile, parser_run):
+        subparser.add_argument('--compiled-dir', default=DEFAULT_COMPILED_DIRECTORY,
+                               help='directory to store compiled features in (default: %(default)s)')
+    for subparser in (parser_check, parser_run):
+        subparser.add_argument('--output', choices=['auto', 'buffered', 'unbuffered'], default='auto',
+                               help='whether to write output in batches, at the end of each scenario, or as soon as '
+                               'it is produced. auto buffers output unless it goes to a terminal (default: %(default)s)')
+        subparser.add_argument('--flush-interval', type=float, default=DEFAULT_INTERVAL,
+                               help='longest time in seconds that buffered output is held back for (default: %(default)s)')
+    for subparser in (parser_check, parser_compile, parser_run):
+        subparser.add_argument('--cache-dir', default=DEFAULT_DIRECTORY,
+                               help='directory to cache parsed feature files in (default: %(default)s)')
+        subparser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_SIZE,
+                               help='maximum size of the cache, in bytes (default: %(default)s)')
+        subparser.add_argument('--no-cache', action='store_true',
+                               help='always parse feature files, without reading or updating the cache')
     if package_globals.rule_args:
         from_rules = parser_run.add_argument_group('from rules')
         for (stored_args, stored_kwargs) in package_globals.rule_args:
             from_rules.add_argument(*stored_args, **stored_kwargs)
+    return parser
 
-    args = parser.parse_args(args)
+def execute(parser, args):
+    """Carry out the command of args, parsed by parser. Returns the exit
+    status"""
     if args.command == 'run':
         for fn in package_globals.callbacks:
             fn(args)
@@ -68,16 +216,257 @@ def main():
     if args.command == 'list':
         display_implemented_commands()
         return 0
+    elif args.command == 'history':
+        if not os.path.exists(args.history):
+            parser.error('no runs have been recorded in %s' % args.history)
+        return run_history(args)
+    elif args.command == 'merge':
+        return run_merge(args)
+    elif args.command == 'worker':
+        work(args.address, args.connect_timeout)
+        return 0
+    elif args.command == 'serve':
+        return serve(args.socket, args.rules, load_rules, serve_request)
     else:
-        succeeded = True
-        for feature_file in args.feature:
-            with open(feature_file) as file:
-                if args.command == 'check':
-                    feature = CheckSyntax(file.read())
+        cache = None if args.no_cache else FeatureCache(args.cache_dir, args.cache_size)
+        if args.command == 'run':
+            if args.interactive and (args.jobs > 1 or args.threads > 1 or args.concurrent > 1):
+                parser.error('--interactive can not be combined with --jobs, --threads or --concurrent')
+            if args.jobs > 1 and (args.stream or args.threads > 1 or args.concurrent > 1):
+                parser.error('--jobs can not be combined with --stream, --threads or --concurrent')
+            if args.stream and (args.threads > 1 or args.concurrent > 1):
+                parser.error('--stream can not be combined with --threads or --concurrent')
+            if args.threads > 1 and args.concurrent > 1:
+                parser.error('--threads can not be combined with --concurrent')
+            if args.compiled and (args.interactive or args.stream or args.jobs > 1 or
+                                  args.threads > 1 or args.concurrent > 1):
+                parser.error('--compiled can not be combined with --interactive, --stream, --jobs, --threads or --concurrent')
+            if args.compiled and args.format != 'text':
+                parser.error('--compiled can only be combined with --format text')
+            if args.compiled and (args.durations or args.profile or args.track_memory or args.history):
+                parser.error('--compiled can not be combined with --durations, --profile, --track-memory or --history')
+            if args.track_memory and (args.threads > 1 or args.concurrent > 1):
+                parser.error('--track-memory can not be combined with --threads or --concurrent')
+            if args.concurrent > 1 and args.profile in ('feature', 'scenario'):
+                parser.error('--concurrent can only be combined with --profile step')
+            if args.shard and (args.stream or args.compiled):
+                parser.error('--shard can not be combined with --stream or --compiled')
+            if args.coordinator and (args.interactive or args.stream or args.compiled or args.jobs > 1 or
+                                     args.threads > 1 or args.concurrent > 1):
+                parser.error('--coordinator can not be combined with --interactive, --stream, --compiled, --jobs, '
+                             '--threads or --concurrent')
+            if args.coordinator and (args.durations or args.profile or args.track_memory):
+                parser.error('--coordinator can not be combined with --durations, --profile or --track-memory')
+            if args.isolate and (args.interactive or args.stream or args.compiled or args.jobs > 1 or
+                                 args.threads > 1 or args.concurrent > 1 or args.coordinator):
+                parser.error('--isolate can not be combined with --interactive, --stream, --compiled, --jobs, '
+                             '--threads, --concurrent or --coordinator')
+            if ((args.local_workers or args.unit_attempts != DEFAULT_ATTEMPTS or args.allow_remote_workers) and
+                    not args.coordinator):
+                parser.error('--local-workers, --unit-attempts and --allow-remote-workers can only be combined with '
+                             '--coordinator')
+            if args.coordinator and not args.allow_remote_workers and not is_loopback(args.coordinator):
+                parser.error('--coordinator only listens on the loopback interface, unless given '
+                             '--allow-remote-workers')
+            if args.unit_attempts < 1:
+                parser.error('--unit-attempts must be at least 1')
+            if args.report and args.format not in ('junit', 'jsonl'):
+                parser.error('--report can only be combined with --format %s' % ' or '.join(RECORD_FORMATS))
+
+        if args.command == 'compile':
+            return run_command(args, cache)
+
+        # Steps print to sys.stdout, so it is replaced as well, to keep what
+        # they print in order with the runner's output
+        interactive = args.command == 'run' and args.interactive
+        if args.output == 'unbuffered' or interactive or (args.output == 'auto' and sys.stdout.isatty()):
+            interval = 0
+        else:
+            interval = args.flush_interval
+        stdout = sys.stdout
+        report = None
+        if args.command == 'run' and args.format in RECORD_FORMATS and not args.report:
+            # What the steps print would corrupt the report, so it goes to
+            # standard error, leaving standard output to the report
+            report = BufferedOutput(stdout, interval)
+            sys.stdout = BufferedOutput(sys.stderr, interval)
+        else:
+            sys.stdout = BufferedOutput(stdout, interval)
+        try:
+            return run_command(args, cache, report)
+        finally:
+            sys.stdout.stop()
+            sys.stdout = stdout
+            if report is not None:
+                report.stop()
+
+def serve_request(rules, argv):
+    """Carry out argv, the command line after the rule files, for serve.
+    Returns the exit status"""
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    args.rules = rules
+    if args.command in ('serve', 'worker'):
+        parser.error('%s can not be sent to serve' % args.command)
+    if getattr(args, 'interactive', False) or '-' in getattr(args, 'feature', []):
+        parser.error('serve can not read standard input, for --interactive or a feature file of -')
+    return execute(parser, args)
+
+def run_command(args, cache, report=None):
+    """Run the check, compile or run command, with the report of the run
+    command going to report, if given. Returns the exit status"""
+    if args.command == 'run':
+        if args.report:
+            report = open(args.report, 'w')
+        elif report is None:
+            report = sys.stdout
+        timer = StepTimer()
+        step_profiler = StepProfiler()
+        history = History(args.history) if args.history else None
+        features = None
+        positions = None
+        paths = args.feature
+        if args.shard:
+            (index, count) = args.shard
+            parsed = parse_features(args.feature, cache)
+            positions = shard_positions(parsed, index, count, args.shard_history or args.history)
+            features = select_scenarios(parsed, positions)
+            paths = [path for (path, feature) in features]
+        try:
+            reporter = REPORTERS[args.format](report)
+            if args.format in RECORD_FORMATS:
+                reporter.locate_features([feature_path(path) for path in paths], positions)
+            if args.durations:
+                timer.install()
+                reporter = DurationsReporter(reporter, timer, args.durations)
+            if args.profile:
+                profiles = Profiles(args.profile_dir, args.profile_merged)
+                if args.profile == 'step':
+                    step_profiler.install()
+                    reporter = ProfilingReporter(reporter, profiles, args.profile, step_profiler)
                 else:
-                    feature = Test(file.read(), sys.stdout, args.interactive)
-                    succeeded = succeeded and all(result.is_success() for result in feature.accept(YieldResults()))
+                    reporter = ProfilingReporter(reporter, profiles, args.profile)
+            if args.track_memory:
+                reporter = MemoryReporter(reporter, snapshots(), args.memory_threshold, args.memory_top)
+            if history is not None:
+                history.start_run(" ".join(sys.argv[1:]))
+                run = history.run
+                reporter = HistoryReporter(reporter, history, paths)
+            succeeded = run_features(args, cache, reporter, features)
+            reporter.finish()
+        finally:
+            timer.uninstall()
+            step_profiler.uninstall()
+            if args.report:
+                report.close()
+            if history is not None:
+                history.close()
+        if history is not None:
+            print >> sys.stderr, "run %d recorded in %s" % (run, args.history)
+        if args.profile:
+            written = profiles.finish()
+            print >> sys.stderr, "%d profile%s written to %s" % (
+                len(written), "" if len(written) == 1 else "s", args.profile_merged or args.profile_dir)
         return not succeeded
 
+    if args.command == 'compile':
+        compiled = CompiledFeatures(args.compiled_dir)
+        for feature_file in args.feature:
+            with open(feature_file) as file:
+                (key, code, fresh) = compiled.compile(file.read(), _givens, _whens, _thens, cache)
+            print '%s: %s %s' % (feature_file, 'compiled to' if fresh else 'up to date in',
+                                 compiled.path(key, SOURCE_SUFFIX))
+        return 0
+
+    for feature_file in args.feature:
+        with open(feature_file) as file:
+            CheckSyntax(file.read(), sys.stdout, cache)
+    return 0
+
+def run_history(args):
+    """Report on the runs recorded in args.history. Returns 1 if any
+    scenario regressed, or 0"""
+    history = History(args.history)
+    try:
+        found = trends(history, args.runs, args.threshold, args.min_change,
+                       feature_path(args.feature) if args.feature else None,
+                       args.scenario.decode('utf-8') if args.scenario else None)
+    finally:
+        history.close()
+    return int(write_trends(sys.stdout, found, args.runs, args.regressions) > 0)
+
+def run_merge(args):
+    """Merge the shard reports of args into one. Returns 1 if any scenario
+    didn't succeed, or 0"""
+    records = read_records(args.shard_report)
+    out = open(args.report, 'w') if args.report else sys.stdout
+    try:
+        write_merged(out, records, args.format)
+    finally:
+        if args.report:
+            out.close()
+    print >> sys.stderr, merge_summary(records, len(args.shard_report))
+    return int(any(record['result'] != 'succeeded' for record in records))
+
+def parse_features(paths, cache):
+    """Return the (path, parsed feature) of each of paths"""
+    features = []
+    for feature_file in paths:
+        with open(feature_file) as file:
+            features.append((feature_file, parse_text(file.read(), cache)))
+    return features
+
+def run_features(args, cache, reporter, features=None):
+    """Run the features of the run command with reporter, or if features
+    is set, the (path, parsed feature) in it instead. Returns whether every
+    test succeeded"""
+    if args.coordinator:
+        if features is None:
+            features = parse_features(args.feature, cache)
+        return CoordinatedTest([feature for (path, feature) in features], args.coordinator, sys.stdout,
+                               (args.format, bool(args.history)), reporter, args.rules, args.local_workers,
+                               args.unit_attempts)
+    if args.isolate:
+        if features is None:
+            features = parse_features(args.feature, cache)
+        return IsolatedTest([feature for (path, feature) in features], args.isolate, sys.stdout, reporter)
+    if args.jobs > 1:
+        if features is None:
+            features = parse_features(args.feature, cache)
+        return ParallelTest([feature for (path, feature) in features], args.jobs, sys.stdout, reporter)
+
+    succeeded = True
+    if features is not None:
+        for (path, feature) in features:
+            succeeded = run_feature(args, feature, reporter) and succeeded
+        return succeeded
+    for feature_file in args.feature:
+        if args.stream:
+            if feature_file == '-':
+                succeeded = StreamTest(sys.stdin, sys.stdout, args.interactive, reporter) and succeeded
+            else:
+                with open(feature_file) as file:
+                    succeeded = StreamTest(file, sys.stdout, args.interactive, reporter) and succeeded
+        elif args.compiled:
+            with open(feature_file) as file:
+                succeeded = CompiledTest(file.read(), CompiledFeatures(args.compiled_dir), sys.stdout, cache) and succeeded
+        else:
+            with open(feature_file) as file:
+                feature = parse_text(file.read(), cache)
+            succeeded = run_feature(args, feature, reporter) and succeeded
+    return succeeded
+
+def run_feature(args, feature, reporter):
+    """Run a parsed feature on threads, cooperatively or one scenario at a
+    time, as args says. Returns whether every test succeeded"""
+    if args.threads > 1:
+        runner = ThreadedTestRunner(_givens, _whens, _thens, args.threads, reporter)
+    elif args.concurrent > 1:
+        runner = CooperativeTestRunner(_givens, _whens, _thens, args.concurrent, reporter)
+    else:
+        runner = TestRunner(_givens, _whens, _thens)
+    run_visitor(feature, runner, sys.stdout, args.interactive, reporter)
+    return all(result.is_success() for result in feature.accept(YieldResults()))
+
 if __name__ == '__main__':
     exit(int(main()))
@@ -0,0 +1,154 @@
+"""Splitting the scenarios of a run between several machines, for run
+--shard, and putting the JSON Lines reports of the shards back together,
+for the merge command.
+
+Each shard of a run is given the same feature files, and picks out its own
+scenarios from them. A scenario is never split from its example rows.
+Without anything to go on, scenarios are dealt out in turn, in the order
+of the feature files. Given the history of earlier runs (see history),
+each scenario is expected to take as long as the median of the runs in
+which it was recorded, and the scenarios are handed out longest first to
+the shard expected to finish soonest, so that the shards take about as
+long as each other. Scenarios that haven't been recorded are expected to
+take as long as the median of those that have.
+
+Shards only agree on which of them runs what if they are all given the
+same feature files and history.
+
+Each record of a shard's JSON Lines report gives the path of its feature
+file, and the position its scenario had in the whole run, which the merge
+command puts the records back in."""
+
+from __future__ import with_statement
+
+import os
+import json
+from ast_nodes import Feature
+from history import History, feature_path, scenario_name, median, DEFAULT_RUNS
+from reporters import JUnitReporter, junit_testcase, json_line
+
+def shard(text):
+    """Return the (index, count) of text of the form i/N, where i counts
+    from 1"""
+    (index, count) = [int(part) for part in text.split('/')]
+    if not 1 <= index <= count:
+        raise ValueError(text)
+    return (index - 1, count)
+
+def expected_durations(history, features, runs=DEFAULT_RUNS):
+    """Return the expected duration of each scenario of features, a list of
+    (path, feature), by (feature index, scenario index), from the last runs
+    runs recorded in history. Scenarios that haven't been recorded are left
+    out"""
+    recorded = history.durations(history.runs(runs))
+    expected = {}
+    for (feature_index, (path, feature)) in enumerate(features):
+        path = feature_path(path)
+        for (scenario_index, scenario) in enumerate(feature.scenarios):
+            rows = [None] + (scenario.more_examples.rows if scenario.more_examples else [])
+            names = [scenario_name(scenario, row) for row in rows]
+            if not all((path, name) in recorded for name in names):
+                continue
+            expected[(feature_index, scenario_index)] = sum(
+                median(typical_durations(recorded[(path, name)])) for name in names)
+    return expected
+
+def typical_durations(runs):
+    """Return the durations of the runs in which a scenario succeeded, or
+    of all of them if it never has"""
+    succeeded = [duration for (run, result, duration) in runs if result == 'succeeded']
+    return succeeded or [duration for (run, result, duration) in runs]
+
+def partition(units, count, expected=None):
+    """Split units (any list of keys) into count shards, balanced by the
+    durations in expected where there are any, and return the units of
+    each shard, in their original order"""
+    shards = [[] for index in range(count)]
+    if not expected:
+        for (position, unit) in enumerate(units):
+            shards[position % count].append((position, unit))
+    else:
+        default = median(expected.values())
+        loads = [[0.0, 0, index] for index in range(count)]
+        # Longest first, and in order among equals, to the shard with the
+        # least to do so far (then with the fewest units, then the first)
+        ranked = sorted(enumerate(units), key=lambda (position, unit): (-expected.get(unit, default), position))
+        for (position, unit) in ranked:
+            load = min(loads)
+            load[0] += expected.get(unit, default)
+            load[1] += 1
+            shards[load[2]].append((position, unit))
+    return [[unit for (position, unit) in sorted(shard_units)] for shard_units in shards]
+
+def shard_features(features, index, count, history_file=None):
+    """Return the (path, feature) of features, a list of (path, feature),
+    that shard index of count runs, keeping only its scenarios, and leaving
+    out features it has none of"""
+    return select_scenarios(features, shard_positions(features, index, count, history_file))
+
+def shard_positions(features, index, count, history_file=None):
+    """Return the [feature index, scenario index] in features, a list of
+    (path, feature), of the scenarios that shard index of count runs, as a
+    list for each feature it has any of, in order"""
+    units = [(feature_index, scenario_index)
+             for (feature_index, (path, feature)) in enumerate(features)
+             for scenario_index in range(len(feature.scenarios))]
+    expected = None
+    if history_file is not None and os.path.exists(history_file):
+        history = History(history_file)
+        try:
+            expected = expected_durations(history, features)
+        finally:
+            history.close()
+    positions = []
+    for (feature_index, scenario_index) in partition(units, count, expected)[index]:
+        if not positions or positions[-1][0][0] != feature_index:
+            positions.append([])
+        positions[-1].append([feature_index, scenario_index])
+    return positions
+
+def select_scenarios(features, positions):
+    """Return the (path, feature) of features, a list of (path, feature),
+    keeping only the scenarios at positions (as given by shard_positions)"""
+    selected = []
+    for scenarios in positions:
+        (path, feature) = features[scenarios[0][0]]
+        selected.append((path, Feature(feature.text, feature.purpose, feature.role, feature.goal,
+                                       [feature.scenarios[scenario_index]
+                                        for (feature_index, scenario_index) in scenarios])))
+    return selected
+
+def read_records(paths):
+    """Return the records of the JSON Lines reports in paths, in the order
+    of the run they were sharded from"""
+    records = []
+    for path in paths:
+        with open(path) as report:
+            records.extend(json.loads(line) for line in report if line.strip())
+    # sort is stable, so the records of the rows of a scenario, which are
+    # all in the same report, stay in order
+    records.sort(key=lambda record: record['position'])
+    return records
+
+def write_merged(out, records, format):
+    if format == 'jsonl':
+        for record in records:
+            out.write(json_line(record))
+        return
+    reporter = JUnitReporter(out)
+    path = None
+    for (position, record) in enumerate(records):
+        if position == 0 or record['path'] != path:
+            path = record['path']
+            reporter.start_suite(record['feature'] or u"")
+        out.write(junit_testcase(record))
+    reporter.finish()
+
+def merge_summary(records, shards):
+    """Return a line giving the number of scenarios with each result"""
+    counts = {}
+    for record in records:
+        counts[record['result']] = counts.get(record['result'], 0) + 1
+    return "%d scenarios from %d shard%s: %s" % (
+        len(records), shards, "" if shards == 1 else "s",
+        ", ".join("%d %s" % (counts[result], result) for result in sorted(counts)) or "none run")
@@ -0,0 +1,229 @@
+"""Indexes over bags of step definitions.
+
+Matching a step line used to mean trying every regular expression in the
+bag, so that ambiguous lines could be detected. A StepIndex instead files
+each definition under the literal text its pattern must start with or, if
+it has none, under the longest literal text every match must contain. A
+line is then only tried against the definitions whose literal text it
+starts with or contains. The matches found, and their order, are the same
+as for a full scan.
+
+The threads of a ThreadedTestRunner share the indexes, so the caches of
+matches, and the rebuilding of an index, are guarded by locks. Matching
+itself only reads the index."""
+
+from __future__ import with_statement
+
+import sre_parse
+import sre_constants
+import collections
+import threading
+
+# Number of distinct step lines whose matches each StepIndex remembers
+CACHE_SIZE = 4096
+
+CacheInfo = collections.namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+def parse_pattern(regex):
+    """Return the sre_parse tree of the compiled regex, or None if its
+    literals can't be relied on (because it ignores case, for instance)"""
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except (sre_constants.error, TypeError):
+        return None
+    if parsed.pattern.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        return None
+    return parsed
+
+def literal_prefix(regex):
+    """Return the text that every match of the compiled regex must start with"""
+    parsed = parse_pattern(regex)
+    if parsed is None:
+        return u""
+    prefix = []
+    for (op, arg) in parsed:
+        if op != sre_constants.LITERAL:
+            break
+        prefix.append(unichr(arg))
+    return u"".join(prefix)
+
+def collect_literals(parsed, literals):
+    run = []
+    for (op, arg) in parsed:
+        if op == sre_constants.LITERAL:
+            run.append(unichr(arg))
+            continue
+        if run:
+            literals.append(u"".join(run))
+            run = []
+        if op == sre_constants.SUBPATTERN:
+            collect_literals(arg[-1], literals)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and arg[0] >= 1:
+            collect_literals(arg[2], literals)
+    if run:
+        literals.append(u"".join(run))
+    return literals
+
+def required_literals(regex):
+    """Return a list of strings that every match of the compiled regex must contain.
+
+    Only runs of literal characters that can't be skipped count, so the text
+    inside alternations and optional repetitions is left out"""
+    parsed = parse_pattern(regex)
+    if parsed is None:
+        return []
+    return collect_literals(parsed, [])
+
+class LiteralMatcher(object):
+    """An Aho-Corasick automaton, which finds all the values whose literal
+    occurs in a line in a single pass over the line"""
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+    def add(self, literal, value):
+        state = 0
+        for char in literal:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = next_state
+            state = next_state
+        self.output[state].append(value)
+
+    def build(self):
+        """Compute the failure links. Must be called after the last add"""
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for (char, next_state) in self.goto[state].iteritems():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def search(self, line):
+        found = []
+        state = 0
+        for char in line:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            found.extend(self.output[state])
+        return found
+
+class LRUCache(object):
+    """A dictionary that holds at most maxsize items, discarding the least
+    recently used item to make room for a new one. Safe to share between
+    threads"""
+    missing = object()
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, self.missing)
+            if value is self.missing:
+                self.misses += 1
+                return value
+            self.hits += 1
+            self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self.items))
+
+class StepIndex(object):
+    def __init__(self, bag, cache_size=CACHE_SIZE):
+        self.entries = list(bag)
+        self.cache = LRUCache(cache_size)
+        # Each trie node is a pair of (children by character, positions in
+        # the bag of the definitions whose literal prefix ends at this node)
+        self.root = ({}, [])
+        self.literals = LiteralMatcher()
+        for (position, (regex, fn, names)) in enumerate(self.entries):
+            prefix = literal_prefix(regex)
+            literals = required_literals(regex) if not prefix else []
+            if literals:
+                self.literals.add(max(literals, key=len), position)
+                continue
+            node = self.root
+            for char in prefix:
+                node = node[0].setdefault(char, ({}, []))
+            node[1].append(position)
+        self.literals.build()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def candidates(self, line):
+        """Return the positions of the definitions that might match line, in bag order"""
+        node = self.root
+        positions = list(node[1])
+        for char in line:
+            node = node[0].get(char)
+            if node is None:
+                break
+            positions.extend(node[1])
+        positions.extend(set(self.literals.search(line)))
+        positions.sort()
+        return positions
+
+    def matches(self, line):
+        """Return a (fn, args) pair for every definition that matches line,
+        in bag order. Results are remembered for the most recently used lines"""
+        matches = self.cache.get(line)
+        if matches is self.cache.missing:
+            matches = self.find_matches(line)
+            self.cache.put(line, matches)
+        return matches
+
+    def find_matches(self, line):
+        matches = []
+        for position in self.candidates(line):
+            (regex, fn, names) = self.entries[position]
+            match = regex.match(line)
+            if match:
+                matches.append((fn, match.groups()))
+        return matches
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+def index_for(bag):
+    """Return the StepIndex for bag, rebuilding it if definitions have been
+    registered in the bag since it was last built. Rebuilding the index also
+    discards the matches it remembered"""
+    (indexed_bag, index) = _indexes.get(id(bag), (None, None))
+    if indexed_bag is bag and len(index) == len(bag):
+        return index
+    with _indexes_lock:
+        # Another thread may have rebuilt it meanwhile
+        (indexed_bag, index) = _indexes.get(id(bag), (None, None))
+        if indexed_bag is not bag or len(index) != len(bag):
+            index = StepIndex(bag)
+            _indexes[id(bag)] = (bag, index)
+        return index
+
+def cache_info():
+    """Return the combined hit and miss counts of the match caches of all the
+    current indexes"""
+    infos = [index.cache.info() for (bag, index) in _indexes.itervalues()]
+    return CacheInfo(*[sum(field) for field in zip(*infos)] or [0, 0, 0, 0])
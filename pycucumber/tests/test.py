@@ -1,8 +1,45 @@
 from __future__ import with_statement
-from pycucumber.ast_nodes import prefixed_line, named_type, empty_line, comment, example_row, parse
+from pycucumber.ast_nodes import prefixed_line, named_type, empty_line, comment, example_row, parse, parse_pyparsing
+from pycucumber.feature_parser import parse_feature, stream_feature, FeatureSyntaxError
 from pyparsing import ZeroOrMore, SkipTo, ParseException
-from pycucumber.core import override
+from pycucumber.core import override, create_collector, run_visitor, _givens, _whens, _thens
+from pycucumber.parallel import ParallelTest
+from pycucumber.ast_visitors import feature_managers
+from pycucumber.threaded import ThreadedTestRunner
+from pycucumber.cooperative import CooperativeTestRunner
+from pycucumber import coroutines
+from pycucumber import When, Then
+from pycucumber.ast_visitors import TestRunner, CheckRules, YieldResults, Succeeded, Failed, Skipped, WrongNumArgs
+from StringIO import StringIO
+from pycucumber.ast_cache import FeatureCache, encode_feature, decode_feature
+from pycucumber.ast_visitors import get_matches, check_test, Unimplemented, Ambiguous, WellFormed, run_test
+from pycucumber.walker import walk
+from pycucumber.compiler import CompiledFeatures, run_compiled
+from pycucumber.output import BufferedOutput, CapturedOutput
+from pycucumber.timing import StepTimer, DurationsReporter
+from pycucumber.profiling import Profiles, StepProfiler, ProfilingReporter
+from pycucumber.memory import MemoryReporter, ObjectSnapshots
+from pycucumber.history import History, HistoryReporter, trends, write_trends
+from pycucumber.sharding import shard, partition, shard_features, read_records
+from pycucumber.client import REQUEST, OUTPUT, ERROR, EXIT, send_frame, receive_frame
+from pycucumber.distributed import Coordinator, parse_address, is_loopback, connect, send, receive, LENGTH
+from pycucumber.isolation import IsolatedTest, groups
+from pycucumber.reporters import TextReporter, ProgressReporter, JSONLinesReporter, JUnitReporter
+from pycucumber.step_matcher import literal_prefix, required_literals, LiteralMatcher, LRUCache, index_for
+import re
+import json
 import unittest
+import xml.dom.minidom
+import pstats
+import sys
+import time
+import threading
+import glob
+import subprocess
+import socket
+import tempfile
+import shutil
+import os
 
 class TestParsing(unittest.TestCase):
     def test_empty_line(self):
@@ -67,6 +104,1354 @@ class TestParsing(unittest.TestCase):
             string = file.read()
             self.assertEqual(parse(string), parse(string))
 
+class TestFeatureParser(unittest.TestCase):
+    def assertParsesLikePyparsing(self, text):
+        feature = parse_feature(text)
+        self.assertEqual(feature, parse_pyparsing(text))
+        return feature
+
+    def test_feature_files(self):
+        for filename in ['parse_test.feature'] + glob.glob('helper/features/*.feature'):
+            with open(filename) as file:
+                self.assertParsesLikePyparsing(unicode(file.read(), 'utf-8'))
+
+    def test_structure(self):
+        with open('parse_test.feature') as file:
+            feature = self.assertParsesLikePyparsing(unicode(file.read(), 'utf-8'))
+        [scenario] = feature.scenarios
+        self.assertEqual(scenario.conditions, [])
+        [step] = scenario.steps
+        self.assertEqual([action.text for action in step.actions], ["I do something", "do something else"])
+        self.assertEqual([result.text for result in step.results], ["I should see something", "I should see something else"])
+        self.assertEqual(scenario.more_examples.header, ["head1", "head2"])
+        self.assertEqual([row.data for row in scenario.more_examples.rows], [["arg1", "arg2"]])
+
+    def test_header(self):
+        feature = self.assertParsesLikePyparsing(
+            "Feature: Header\n  As a user\n  I want a header\n  In order to test it\n"
+            "  Scenario: s\n    When a\n    Then b\n")
+        self.assertEqual(feature.role.text, "a user")
+        self.assertEqual(feature.goal.text, "a header")
+        self.assertEqual(feature.purpose.text, "to test it")
+
+    def test_syntax_errors(self):
+        for text in ["Feature: x\n  Scenario: s\n    When a\n",
+                     "Feature: x\n  Scenario: s\n    When a\n    Then b\n    garbage\n",
+                     "Feature: x\n  Scenario: s\n    When a\n    Then b\n    More Examples:\n    | a | b\n    | c | d |\n"]:
+            self.assertRaises(FeatureSyntaxError, parse_feature, text)
+            self.assertRaises(ParseException, parse, text)
+
+    def test_stream(self):
+        lines = iter(["Feature: x\n", "  Scenario: first\n", "    When a\n", "    Then b\n",
+                      "  Scenario: second\n", "    When c\n", "    Then d\n", "  garbage\n"])
+        feature = stream_feature(lines)
+        self.assertEqual(feature.text, "x")
+        children = iter(feature.children())
+        self.assertEqual(children.next().text, "first")
+        self.assertEqual(lines.next(), "    When c\n")
+        self.assertRaises(FeatureSyntaxError, children.next)
+
+class TestFeatureCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        with open('parse_test.feature') as file:
+            text = file.read()
+        feature = parse(unicode(text, 'utf-8'))
+        self.assertEqual(decode_feature(encode_feature(feature)), feature)
+
+        cache = FeatureCache(self.directory)
+        self.assertEqual(cache.parse(text), feature)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.assertEqual(cache.load(cache.key(text)), feature)
+
+    def test_eviction(self):
+        cache = FeatureCache(self.directory, max_size=0)
+        cache.parse("Feature: x\n  Scenario: s\n    When a\n    Then b\n")
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def feature_text(self, number):
+        return "Feature: x%d\n  Scenario: s\n    When a\n    Then b\n" % number
+
+    def test_scans_only_when_over_limit(self):
+        cache = FeatureCache(self.directory)
+        scans = []
+        entries = cache.entries
+        cache.entries = lambda: scans.append(1) or entries()
+        for number in range(20):
+            cache.parse(self.feature_text(number))
+        self.assertEqual(len(scans), 1)
+        self.assertEqual(cache.size, sum(os.path.getsize(os.path.join(self.directory, name))
+                                         for name in os.listdir(self.directory)))
+        # Once over the limit, the oldest entries go
+        cache.max_size = cache.size - 1
+        cache.parse(self.feature_text(20))
+        self.assertTrue(cache.size <= cache.max_size)
+        self.assertEqual(len(os.listdir(self.directory)), 19)
+
+    def test_failed_store_leaves_no_temporary_file(self):
+        cache = FeatureCache(self.directory)
+        text = self.feature_text(0)
+        # A directory in the way of the entry makes the rename fail
+        os.mkdir(cache.path(cache.key(text)))
+        cache.parse(text)
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(cache.path(cache.key(text)))])
+
+class TestCompiler(unittest.TestCase):
+    feature = ("Feature: compiled\n"
+               "  As a tester\n"
+               "  Scenario: outline\n"
+               "    Given a start\n"
+               "    When I add 1 and 2\n"
+               "    And I do something unknown\n"
+               "    Then the sum is 3\n"
+               "    And the sum is 3\n"
+               "    More Examples:\n"
+               "      | a | b | sum |\n"
+               "      | 2 | 2 | 4   |\n"
+               "      | 5 | 1 | 7   |\n"
+               "  Scenario: plain\n"
+               "    When I add 2 and 2\n"
+               "    Then the sum is 5\n"
+               "    And the sum is 4\n"
+               "    When I add 0 and 0\n"
+               "    Then the sum is 0\n")
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.givens, self.whens, self.thens = [], [], []
+        self.sums = []
+        create_collector(self.givens)(r"a start")(lambda: None)
+        create_collector(self.whens)(r"I add (\d+) and (\d+)")(lambda a, b: self.sums.append(int(a) + int(b)))
+        create_collector(self.whens)(r"I do something unknown")(lambda: None)
+        create_collector(self.thens)(r"the sum is (\d+)")(self.check_sum)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_sum(self, expected):
+        assert self.sums[-1] == int(expected), "%s != %s" % (self.sums[-1], expected)
+
+    def test_same_as_test_runner(self):
+        # Leave one step unimplemented
+        del self.whens[1]
+        expected = StringIO()
+        runner = TestRunner(self.givens, self.whens, self.thens)
+        run_visitor(parse(self.feature), runner, expected, False)
+
+        compiled = CompiledFeatures(self.directory)
+        (key, code, fresh) = compiled.compile(self.feature, self.givens, self.whens, self.thens)
+        self.assertTrue(fresh)
+        output = StringIO()
+        self.assertEqual(run_compiled(code, self.givens, self.whens, self.thens, output), runner.succeeded)
+        self.assertEqual(output.getvalue(), expected.getvalue())
+
+    def test_recompiled_on_change(self):
+        compiled = CompiledFeatures(self.directory)
+        (key, code, fresh) = compiled.compile(self.feature, self.givens, self.whens, self.thens)
+        self.assertTrue(fresh)
+        self.assertEqual(compiled.compile(self.feature, self.givens, self.whens, self.thens)[1:], (code, False))
+        self.assertNotEqual(compiled.compile(self.feature + "    And the sum is 0\n",
+                                             self.givens, self.whens, self.thens)[0], key)
+        create_collector(self.thens)(r"the sum is (\d+) again")(self.check_sum)
+        (new_key, code, fresh) = compiled.compile(self.feature, self.givens, self.whens, self.thens)
+        self.assertTrue(fresh)
+        self.assertNotEqual(new_key, key)
+
+class TestStepMatching(unittest.TestCase):
+    patterns = ["pass", "fail", "ambig.*", "ambiguous", "var:(.+)", "(?i)Var:(.+)",
+                "a feature file (\\S+)", "a (new|old) test", "(\\d+) test(?:s)? should (.+)",
+                "", "a?b", "foo|bar", "(.*)bar", "(?:x|y)+ (?:on|off)", "x*(?:on)+(?!y)"]
+
+    def setUp(self):
+        self.bag = [(re.compile(r"%s\Z" % pattern), pattern, []) for pattern in self.patterns]
+
+    def linear_matches(self, line):
+        matches = []
+        for (regex, fn, names) in self.bag:
+            match = regex.match(line)
+            if match:
+                matches.append((fn, match.groups()))
+        return matches
+
+    def test_literal_prefix(self):
+        self.assertEqual(literal_prefix(self.bag[6][0]), "a feature file ")
+        self.assertEqual(literal_prefix(self.bag[5][0]), "")
+        self.assertEqual(literal_prefix(self.bag[8][0]), "")
+        self.assertEqual(literal_prefix(self.bag[10][0]), "")
+
+    def test_required_literals(self):
+        self.assertEqual(required_literals(self.bag[8][0]), [" test", " should "])
+        self.assertEqual(required_literals(self.bag[11][0]), [])
+        self.assertEqual(required_literals(self.bag[14][0]), ["on"])
+        self.assertEqual(required_literals(self.bag[5][0]), [])
+
+    def test_literal_matcher(self):
+        matcher = LiteralMatcher()
+        for (literal, value) in [("he", 1), ("she", 2), ("his", 3), ("hers", 4)]:
+            matcher.add(literal, value)
+        matcher.build()
+        self.assertEqual(sorted(matcher.search("ushers")), [1, 2, 4])
+        self.assertEqual(matcher.search("xyz"), [])
+
+    def test_same_as_linear_scan(self):
+        for line in [u"pass", u"ambiguous", u"ambig", u"var:x", u"VAR:y", u"a feature file x.feature",
+                     u"a new test", u"a test", u"3 tests should pass", u"", u"b", u"ab", u"foo", u"bar",
+                     u"fooxyz", u"unknown", u"foobar", u"xy on", u"xxonon", u"onon"]:
+            self.assertEqual(get_matches(self.bag, line), self.linear_matches(line))
+
+    def test_check_test(self):
+        self.assertTrue(isinstance(check_test(self.bag, u"unknown"), Unimplemented))
+        self.assertTrue(isinstance(check_test(self.bag, u"ambiguous"), Ambiguous))
+        result = check_test(self.bag, u"a feature file x.feature")
+        self.assertTrue(isinstance(result, WellFormed))
+        self.assertEqual((result.fn, result.args), ("a feature file (\\S+)", ("x.feature",)))
+
+    def test_new_definitions(self):
+        self.assertTrue(isinstance(check_test(self.bag, u"new"), Unimplemented))
+        self.bag.append((re.compile(r"new\Z"), "new", []))
+        self.assertTrue(isinstance(check_test(self.bag, u"new"), WellFormed))
+
+    def test_match_cache(self):
+        index = index_for(self.bag)
+        for line in [u"pass", u"pass", u"unknown", u"pass"]:
+            get_matches(self.bag, line)
+        self.assertEqual((index.cache.hits, index.cache.misses), (2, 2))
+
+        self.bag.append((re.compile(r"unknown\Z"), "unknown", []))
+        self.assertTrue(isinstance(check_test(self.bag, u"unknown"), WellFormed))
+        self.assertEqual(index_for(self.bag).cache.info().misses, 1)
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertEqual(cache.get("b"), cache.missing)
+        self.assertEqual(cache.info(), (1, 1, 2, 2))
+
+    def test_shared_between_threads(self):
+        bag = [(re.compile(r"a line (\d+)\Z"), "line", [])]
+        errors = []
+        def match_lines():
+            try:
+                for number in range(2000):
+                    line = u"a line %d" % (number % 3)
+                    self.assertEqual(get_matches(bag, line), [("line", (line[7:],))])
+            except Exception, e:
+                errors.append(e)
+        # Switch threads as often as possible, to make any race show up
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            threads = [threading.Thread(target=match_lines) for thread in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+        self.assertEqual(errors, [])
+        info = index_for(bag).cache.info()
+        self.assertEqual((info.hits + info.misses, info.currsize), (8 * 2000, 3))
+
+class TestOutlines(unittest.TestCase):
+    feature = ("Feature: outlines\n"
+               "  Scenario: adding\n"
+               "    When I add 1 and 2\n"
+               "    Then the sum is 3\n"
+               "    More Examples:\n"
+               "      | a | b | sum |\n"
+               "      | 2 | 2 | 4   |\n"
+               "      | 5 | 1 | 7   |\n"
+               "      | 0 | 0 | 0   |\n")
+
+    def setUp(self):
+        self.givens, self.whens, self.thens = [], [], []
+        self.sums = []
+        create_collector(self.whens)(r"I add (\d+) and (\d+)")(self.add)
+        create_collector(self.thens)(r"the sum is (\d+)")(self.check_sum)
+
+    def add(self, a, b):
+        self.sums.append(int(a) + int(b))
+
+    def check_sum(self, expected):
+        assert self.sums[-1] == int(expected)
+
+    def run_feature(self, text):
+        feature = parse(text)
+        runner = TestRunner(self.givens, self.whens, self.thens)
+        run_visitor(feature, runner, StringIO(), False)
+        return (feature, runner)
+
+    def test_rows_bind_values(self):
+        (feature, runner) = self.run_feature(self.feature)
+        self.assertEqual(self.sums, [3, 4, 6, 0])
+        rows = feature.scenarios[0].more_examples.rows
+        self.assertEqual([type(row.result) for row in rows], [Succeeded, Failed, Succeeded])
+        self.assertEqual([type(test.result) for test in rows[1].scenario.tests()], [Succeeded, Failed])
+        self.assertEqual(rows[1].scenario.more_examples, None)
+        self.assertFalse(runner.succeeded)
+        self.assertFalse(all(result.is_success() for result in feature.accept(YieldResults())))
+
+    def test_rows_share_template(self):
+        (feature, runner) = self.run_feature(self.feature)
+        template = feature.scenarios[0]
+        self.assertEqual([type(test.result) for test in template.tests()], [Succeeded, Succeeded])
+        for row in template.more_examples.rows:
+            self.assertTrue(row.template is template)
+            self.assertEqual(len(row.results), 2)
+        self.assertEqual([test.text for test in row.scenario.tests()], [test.text for test in template.tests()])
+
+    def test_check_rules(self):
+        feature = parse(self.feature + "      | 1 | 2 |\n")
+        run_visitor(feature, CheckRules(self.givens, self.whens, self.thens), StringIO(), False)
+        self.assertEqual([type(test.result) for test in feature.scenarios[0].tests()], [WellFormed, WellFormed])
+        rows = feature.scenarios[0].more_examples.rows
+        self.assertEqual([type(row.result) for row in rows], [WellFormed] * 3 + [WrongNumArgs])
+        self.assertEqual(self.sums, [])
+
+    def test_steps_resolved_once(self):
+        many_rows = self.feature + "      | 1 | 1 | 2   |\n" * 50
+        self.run_feature(many_rows)
+        self.assertEqual(len(self.sums), 54)
+        lookups = [index_for(bag).cache.info() for bag in (self.whens, self.thens)]
+        self.assertEqual([info.hits + info.misses for info in lookups], [2, 2])
+
+@When(r"parallel step (\d+)")
+def parallel_step(number):
+    print "step", number
+
+@Then(r"parallel step (\d+) is even")
+def parallel_check(number):
+    assert int(number) % 2 == 0
+
+@When(r"step prints utf-8")
+def print_utf8():
+    print "caf\xc3\xa9"
+
+# Steps that print byte strings that aren't ASCII, along with the runner's
+# unicode output
+UTF8_FEATURE = ("Feature: utf-8\n"
+                "  Scenario: first\n    When step prints utf-8\n    Then parallel step 2 is even\n"
+                "  Scenario: second\n    When step prints utf-8\n    Then parallel step 4 is even\n")
+
+class TestParallel(unittest.TestCase):
+    feature = ("Feature: parallel\n"
+               "  In order to use every core\n"
+               "  Scenario: first\n"
+               "    When parallel step 2\n"
+               "    Then parallel step 2 is even\n"
+               "    More Examples:\n"
+               "      | n | n |\n"
+               "      | 3 | 3 |\n"
+               "      | 4 | 4 |\n"
+               "  Scenario: second\n"
+               "    When parallel step 6\n"
+               "    Then parallel step 6 is even\n")
+
+    def run_serial(self, texts):
+        output = StringIO()
+        succeeded = True
+        for text in texts:
+            runner = TestRunner(_givens, _whens, _thens)
+            stdout = sys.stdout
+            sys.stdout = output
+            try:
+                run_visitor(parse(text), runner, output, False)
+            finally:
+                sys.stdout = stdout
+            succeeded = succeeded and runner.succeeded
+        return (output.getvalue(), succeeded)
+
+    def test_same_as_serial(self):
+        texts = [self.feature, self.feature.replace("| 3 | 3 |", "| 8 | 8 |")]
+        for features in [texts[:1], texts[1:], texts]:
+            output = StringIO()
+            succeeded = ParallelTest([parse(text) for text in features], 3, output)
+            self.assertEqual((output.getvalue(), succeeded), self.run_serial(features))
+
+    def test_steps_print_utf8(self):
+        output = CapturedOutput()
+        self.assertTrue(ParallelTest([parse(UTF8_FEATURE)], 2, output))
+        self.assertEqual(output.getvalue().count("caf\xc3\xa9"), 2)
+
+    def test_feature_managers_entered_once_per_worker(self):
+        log = os.path.join(tempfile.mkdtemp(), "managers.log")
+        feature_managers.append(LoggingManager(log))
+        try:
+            for processes in [1, 3]:
+                ParallelTest([parse(self.feature), parse(self.feature)], processes, StringIO())
+                with open(log) as entries:
+                    lines = entries.read().split()
+                os.remove(log)
+                self.assertEqual(lines.count("enter"), lines.count("exit"))
+                if processes == 1:
+                    self.assertEqual(lines, ["enter", "exit", "enter", "exit"])
+                else:
+                    # Not once for every one of the 4 units of each feature
+                    self.assertTrue(2 <= lines.count("enter") <= 2 * processes)
+        finally:
+            feature_managers.pop()
+            shutil.rmtree(os.path.dirname(log))
+
+class LoggingManager(object):
+    """A context manager that appends to a file, which the workers of a pool
+    can all do"""
+    def __init__(self, path):
+        self.path = path
+
+    def log(self, text):
+        with open(self.path, "a") as log:
+            log.write(text + "\n")
+
+    def __enter__(self):
+        self.log("enter")
+
+    def __exit__(self, *exc_info):
+        self.log("exit")
+
+isolated_state = []
+
+@When("isolated state is added to")
+def add_isolated_state():
+    isolated_state.append(1)
+
+@Then("isolated state has (\d+) entr(?:y|ies)")
+def check_isolated_state(count):
+    assert len(isolated_state) == int(count)
+
+@When("isolated process exits")
+def exit_isolated_process():
+    os._exit(3)
+
+class TestIsolation(unittest.TestCase):
+    feature = ("Feature: isolation\n"
+               "  In order to keep scenarios apart\n"
+               "  Scenario: first\n"
+               "    When isolated state is added to\n"
+               "    Then isolated state has 1 entry\n"
+               "  Scenario: second\n"
+               "    When isolated state is added to\n"
+               "    Then isolated state has 1 entry\n")
+
+    def tearDown(self):
+        del isolated_state[:]
+
+    def run_isolated(self, texts, granularity):
+        output = StringIO()
+        succeeded = IsolatedTest([parse(text) for text in texts], granularity, output)
+        return (output.getvalue(), succeeded)
+
+    def test_groups(self):
+        units = [(0, 0, None), (0, 1, None), (0, 1, 0), (1, 0, None)]
+        self.assertEqual(groups(units, 'scenario'), [[unit] for unit in units])
+        self.assertEqual(groups(units, 'feature'), [units[:3], units[3:]])
+
+    def test_scenarios_start_from_parent_state(self):
+        (output, succeeded) = self.run_isolated([self.feature], 'scenario')
+        self.assertTrue(succeeded, output)
+        self.assertEqual(isolated_state, [])
+        # Without isolation, the second scenario sees what the first left
+        output = StringIO()
+        run_visitor(parse(self.feature), TestRunner(_givens, _whens, _thens), output, False)
+        self.assertTrue("has 1 entry (Failed" in output.getvalue())
+
+    def test_features_share_a_process(self):
+        (output, succeeded) = self.run_isolated([self.feature, self.feature], 'feature')
+        self.assertFalse(succeeded)
+        self.assertEqual(output.count("has 1 entry (Failed"), 2)
+
+    def test_same_as_parallel(self):
+        texts = [TestParallel.feature, TestParallel.feature.replace("| 3 | 3 |", "| 8 | 8 |")]
+        output = StringIO()
+        succeeded = ParallelTest([parse(text) for text in texts], 2, output)
+        self.assertEqual(self.run_isolated(texts, 'scenario'), (output.getvalue(), succeeded))
+
+    def test_crash_fails_rest_of_feature(self):
+        crashing = self.feature.replace("Scenario: first\n    When isolated state is added to",
+                                        "Scenario: first\n    When isolated process exits")
+        (output, succeeded) = self.run_isolated([crashing, self.feature], 'feature')
+        self.assertFalse(succeeded)
+        self.assertEqual(output.count("exited with status 3"), 2)
+        self.assertEqual(output.count("has 1 entry (Succeeded)"), 1)
+
+    def test_feature_managers_entered_once_per_child(self):
+        log = os.path.join(tempfile.mkdtemp(), "managers.log")
+        feature_managers.append(LoggingManager(log))
+        try:
+            for (granularity, children) in [('feature', 2), ('scenario', 4)]:
+                self.run_isolated([self.feature, self.feature], granularity)
+                with open(log) as entries:
+                    self.assertEqual(entries.read().split(), ["enter", "exit"] * children)
+                os.remove(log)
+        finally:
+            feature_managers.pop()
+            shutil.rmtree(os.path.dirname(log))
+
+concurrent_steps = []
+
+@When(r"threaded step (\d+) waits")
+def threaded_step(number):
+    concurrent_steps.append(number)
+    # Wait for the other scenarios to start, which only happens in time if
+    # they are running concurrently
+    deadline = time.time() + 5
+    while len(concurrent_steps) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    print "waited", number
+
+@Then(r"threaded step (\d+) saw the others")
+def threaded_check(number):
+    assert len(concurrent_steps) >= 3
+
+class TestThreaded(unittest.TestCase):
+    feature = "Feature: threads\n" + "".join(
+        "  Scenario: %d\n    When threaded step %d waits\n    Then threaded step %d saw the others\n" % (n, n, n)
+        for n in range(3))
+
+    def run_feature(self, runner):
+        del concurrent_steps[:]
+        output = StringIO()
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            run_visitor(parse(self.feature), runner, output, False)
+        finally:
+            sys.stdout = stdout
+        return output.getvalue()
+
+    def test_concurrent_and_ordered(self):
+        runner = ThreadedTestRunner(_givens, _whens, _thens, 3)
+        output = self.run_feature(runner)
+        self.assertTrue(runner.succeeded)
+        self.assertEqual([line.split()[-1] for line in output.splitlines() if "waited" in line], ["0", "1", "2"])
+        self.assertEqual([line.strip() for line in output.splitlines() if "Scenario" in line],
+                         ["Scenario: 0", "Scenario: 1", "Scenario: 2"])
+
+    def test_steps_print_utf8(self):
+        runner = ThreadedTestRunner(_givens, _whens, _thens, 2)
+        output = CapturedOutput()
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            run_visitor(parse(UTF8_FEATURE), runner, output, False)
+        finally:
+            sys.stdout = stdout
+        self.assertTrue(runner.succeeded)
+        self.assertEqual(output.getvalue().count("caf\xc3\xa9"), 2)
+
+active_coroutines = []
+most_active_coroutines = []
+
+@When(r"coroutine step (\d+) waits")
+def coroutine_step(number):
+    active_coroutines.append(number)
+    most_active_coroutines.append(len(active_coroutines))
+    print "started", number
+    yield coroutines.sleep(0.05)
+    yield coroutine_helper()
+    active_coroutines.remove(number)
+    print "finished", number
+
+def coroutine_helper():
+    yield None
+
+@Then(r"coroutine step (\d+) is odd")
+def coroutine_check(number):
+    yield None
+    assert int(number) % 2, "%s is even" % number
+
+class TestCoroutines(unittest.TestCase):
+    feature = "Feature: coroutines\n" + "".join(
+        "  Scenario: %d\n    When coroutine step %d waits\n    Then coroutine step %d is odd\n" % (n, n, n)
+        for n in range(6))
+
+    def run_feature(self, runner):
+        del most_active_coroutines[:]
+        output = StringIO()
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            run_visitor(parse(self.feature), runner, output, False)
+        finally:
+            sys.stdout = stdout
+        return output.getvalue()
+
+    def test_sync_step(self):
+        output = StringIO()
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            self.assertTrue(isinstance(run_test(_whens, "coroutine step 1 waits"), Succeeded))
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(output.getvalue(), "started 1\nfinished 1\n")
+        result = run_test(_thens, "coroutine step 2 is odd")
+        self.assertTrue(isinstance(result, Failed))
+        self.assertTrue(result.reason.endswith("AssertionError: 2 is even\n"))
+        self.assertTrue("in coroutine_check" in result.reason)
+
+    def test_sub_coroutine_exception(self):
+        def failing():
+            yield None
+            raise ValueError("inner")
+        def outer(caught):
+            try:
+                yield failing()
+            except ValueError, e:
+                caught.append(str(e))
+        caught = []
+        self.assertEqual(coroutines.run(outer(caught)).exc_info, None)
+        self.assertEqual(caught, ["inner"])
+        self.assertEqual(coroutines.run(failing()).exc_info[0], ValueError)
+
+    def test_same_as_serial(self):
+        serial = TestRunner(_givens, _whens, _thens)
+        expected = self.run_feature(serial)
+        self.assertEqual(max(most_active_coroutines), 1)
+
+        runner = CooperativeTestRunner(_givens, _whens, _thens, 3)
+        self.assertEqual(self.run_feature(runner), expected)
+        self.assertEqual(max(most_active_coroutines), 3)
+        self.assertFalse(runner.succeeded)
+        self.assertFalse(serial.succeeded)
+
+    def test_steps_print_utf8(self):
+        runner = CooperativeTestRunner(_givens, _whens, _thens, 2)
+        output = CapturedOutput()
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            run_visitor(parse(UTF8_FEATURE), runner, output, False)
+        finally:
+            sys.stdout = stdout
+        self.assertTrue(runner.succeeded)
+        self.assertEqual(output.getvalue().count("caf\xc3\xa9"), 2)
+
+class TestWalker(unittest.TestCase):
+    def nested(self, depth, log):
+        if depth:
+            log.append(("sent", depth, (yield "before %d" % depth)))
+            yield self.nested(depth - 1, log)
+            log.append(("sent", depth, (yield "after %d" % depth)))
+        else:
+            yield "leaf"
+
+    def test_events_and_sends(self):
+        log = []
+        gen = walk(self.nested(3, log))
+        events = [gen.next()]
+        try:
+            while True:
+                events.append(gen.send(len(events)))
+        except StopIteration:
+            pass
+        self.assertEqual(events, ["before 3", "before 2", "before 1", "leaf", "after 1", "after 2", "after 3"])
+        self.assertEqual(log, [("sent", 3, 1), ("sent", 2, 2), ("sent", 1, 3),
+                               ("sent", 1, 5), ("sent", 2, 6), ("sent", 3, 7)])
+
+    def test_exceptions_reach_parent(self):
+        def child():
+            yield "child"
+            raise ValueError("child failed")
+        def parent():
+            try:
+                yield child()
+            except ValueError, e:
+                yield str(e)
+        self.assertEqual(list(walk(parent())), ["child", "child failed"])
+        self.assertRaises(ValueError, list, walk(child()))
+
+    def test_abandoned_walk_exits_with_blocks(self):
+        exited = []
+        class Manager(object):
+            def __init__(self, name):
+                self.name = name
+            def __enter__(self):
+                pass
+            def __exit__(self, *exc_info):
+                exited.append(self.name)
+        def visit(name, child=None):
+            with Manager(name):
+                yield name
+                if child is not None:
+                    yield child
+        gen = walk(visit("outer", visit("inner")))
+        self.assertEqual([gen.next(), gen.next()], ["outer", "inner"])
+        gen.close()
+        self.assertEqual(exited, ["inner", "outer"])
+
+class FlushRecorder(object):
+    def __init__(self):
+        self.written = []
+        self.flushed = []
+    def write(self, text):
+        self.written.append(text)
+    def flush(self):
+        self.flushed.append(u"".join(self.written))
+        self.written = []
+
+class TestBufferedOutput(unittest.TestCase):
+    def test_held_until_flushed(self):
+        stream = FlushRecorder()
+        output = BufferedOutput(stream, interval=60)
+        print >> output, u"a",
+        print >> output, "b"
+        self.assertEqual(stream.written, [])
+        output.stop()
+        self.assertEqual(stream.flushed, [u"a b\n"])
+
+        unbuffered = BufferedOutput(stream, interval=0)
+        print >> unbuffered, u"c",
+        self.assertEqual(stream.flushed[1:], [u"c"])
+
+    def test_flushed_at_scenario_end(self):
+        stream = FlushRecorder()
+        output = BufferedOutput(stream, interval=60)
+        givens, whens, thens = [], [], []
+        create_collector(whens)(r"something")(lambda: None)
+        create_collector(thens)(r"it works")(lambda: None)
+        feature = parse("Feature: buffered\n" + "".join(
+            "  Scenario: %d\n    When something\n    Then it works\n" % n for n in range(3)))
+        run_visitor(feature, TestRunner(givens, whens, thens), output, False)
+        output.stop()
+        chunks = [chunk for chunk in stream.flushed if chunk]
+        self.assertEqual(len(chunks), 3)
+        self.assertTrue(chunks[0].startswith(u"Feature: buffered\n    Scenario: 0\n"))
+        self.assertTrue(all(chunk.endswith(u"Then it works (Succeeded)\n") for chunk in chunks))
+
+    def test_flushed_during_long_step(self):
+        stream = FlushRecorder()
+        output = BufferedOutput(stream, interval=0.05)
+        seen = []
+        def slow_step():
+            time.sleep(0.3)
+            # What came before the step has been written out meanwhile
+            seen.append(u"".join(stream.flushed))
+        givens, whens, thens = [], [], []
+        create_collector(whens)(r"something slow")(slow_step)
+        create_collector(thens)(r"it works")(lambda: None)
+        feature = parse("Feature: slow\n  Scenario: slow\n    When something slow\n    Then it works\n")
+        try:
+            run_visitor(feature, TestRunner(givens, whens, thens), output, False)
+        finally:
+            output.stop()
+        self.assertTrue(seen[0].startswith(u"Feature: slow\n    Scenario: slow\n"), seen)
+        output.timer.join(1)
+        self.assertFalse(output.timer.isAlive())
+
+class TestReporters(unittest.TestCase):
+    feature = ("Feature: reported\n"
+               "  Scenario: passes\n    When something\n    Then it works\n"
+               "  Scenario: fails\n    When something breaks\n    Then it works\n"
+               "  Scenario: outline\n    When something\n    Then it works\n"
+               "    More Examples:\n      |a|\n      |b|\n")
+
+    def setUp(self):
+        self.givens, self.whens, self.thens = [], [], []
+        create_collector(self.whens)(r"something")(lambda: None)
+        create_collector(self.whens)(r"something breaks")(self.breaks)
+        create_collector(self.thens)(r"it works")(lambda: None)
+
+    def breaks(self):
+        raise ValueError("broken")
+
+    def runner(self):
+        return TestRunner(self.givens, self.whens, self.thens)
+
+    def run_feature(self, runner, reporter):
+        run_visitor(parse(self.feature), runner, reporter.stream, False, reporter)
+        reporter.finish()
+        return reporter.stream.getvalue()
+
+    def test_text_is_default(self):
+        expected = StringIO()
+        run_visitor(parse(self.feature), self.runner(), expected, False)
+        self.assertEqual(self.run_feature(self.runner(), TextReporter(StringIO())), expected.getvalue())
+
+    def test_progress(self):
+        output = self.run_feature(self.runner(), ProgressReporter(StringIO()))
+        lines = output.splitlines()
+        self.assertEqual(lines[0], "..F-....")
+        self.assertEqual(lines[2:5], ["Feature: reported", "  Scenario: fails", "    When something breaks"])
+        self.assertTrue("ValueError: broken" in output)
+        self.assertEqual(lines[-1], "8 tests: 6 succeeded, 1 failed, 1 skipped")
+
+    def test_progress_only_formats_failures(self):
+        reporter = ProgressReporter(StringIO())
+        reporter.describe = lambda test, result: (test.text, unicode(result))
+        run_visitor(parse(self.feature), self.runner(), reporter.stream, False, reporter)
+        self.assertEqual([text for (text, result) in reporter.failures], ["something breaks"])
+
+    def test_threaded_progress_same_as_serial(self):
+        serial = self.run_feature(self.runner(), ProgressReporter(StringIO()))
+        reporter = ProgressReporter(StringIO())
+        runner = ThreadedTestRunner(self.givens, self.whens, self.thens, 3, reporter)
+        self.assertEqual(self.run_feature(runner, reporter), serial)
+
+    def json_records(self, runner, reporter):
+        return [json.loads(line) for line in self.run_feature(runner, reporter).splitlines()]
+
+    def test_json_lines(self):
+        records = self.json_records(self.runner(), JSONLinesReporter(StringIO()))
+        self.assertEqual([(record['scenario'], record['row'], record['result']) for record in records],
+                         [("passes", None, "succeeded"), ("fails", None, "failed"),
+                          ("outline", None, "succeeded"), ("outline", ["b"], "succeeded")])
+        steps = records[1]['steps']
+        self.assertEqual([(step['step'], step['result']) for step in steps],
+                         [("When something breaks", "failed"), ("Then it works", "skipped")])
+        self.assertTrue("ValueError: broken" in steps[0]['reason'])
+        self.assertTrue(all(step['duration'] >= 0 for step in steps))
+
+    def test_threaded_json_lines_same_as_serial(self):
+        def without_durations(records):
+            for record in records:
+                del record['duration']
+                for step in record['steps']:
+                    del step['duration']
+            return records
+        serial = self.json_records(self.runner(), JSONLinesReporter(StringIO()))
+        reporter = JSONLinesReporter(StringIO())
+        runner = ThreadedTestRunner(self.givens, self.whens, self.thens, 3, reporter)
+        self.assertEqual(without_durations(self.json_records(runner, reporter)), without_durations(serial))
+
+    def test_junit(self):
+        document = xml.dom.minidom.parseString(self.run_feature(self.runner(), JUnitReporter(StringIO())))
+        [suite] = document.getElementsByTagName('testsuite')
+        self.assertEqual(suite.getAttribute('name'), "reported")
+        cases = suite.getElementsByTagName('testcase')
+        self.assertEqual([case.getAttribute('name') for case in cases], ["passes", "fails", "outline", "outline |b|"])
+        [failure] = document.getElementsByTagName('failure')
+        self.assertEqual(failure.getAttribute('message'), "When something breaks")
+        self.assertTrue("ValueError: broken" in failure.firstChild.data)
+
+    def test_report_on_standard_output_keeps_step_output_out(self):
+        helper = os.path.join(os.path.dirname(os.path.abspath(__file__)), "helper")
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.dirname(helper)))
+        features = sorted(glob.glob(os.path.join(helper, "features", "*.feature")))
+        for format in ["jsonl", "junit"]:
+            process = subprocess.Popen([sys.executable, "-m", "pycucumber.runner", "rules/simple.py", "run",
+                                        "--no-cache", "--format", format] + features,
+                                       cwd=helper, env=environment, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            (out, err) = process.communicate()
+            if format == "jsonl":
+                self.assertEqual(len([json.loads(line) for line in out.splitlines()]), 10)
+            else:
+                document = xml.dom.minidom.parseString(out)
+                for suite in document.getElementsByTagName('testsuite'):
+                    self.assertFalse(any(child.nodeType == child.TEXT_NODE and child.data.strip()
+                                         for child in suite.childNodes))
+            # The steps of the helper rules print as they run
+            self.assertTrue("succeeding" in err)
+
+@When(r"timed step sleeps")
+def timed_sleep():
+    time.sleep(0.05)
+
+@When(r"timed step does nothing")
+@Then(r"timed step returns")
+def timed_return():
+    pass
+
+class TestDurations(unittest.TestCase):
+    feature = ("Feature: timed\n"
+               "  Scenario: slow\n    When timed step sleeps\n    Then timed step returns\n"
+               "  Scenario: fast\n    When timed step does nothing\n    Then timed step returns\n")
+
+    def run_feature(self, runner, reporter):
+        timer = StepTimer()
+        timer.install()
+        try:
+            run_visitor(parse(self.feature), runner, reporter.stream, False, reporter)
+        finally:
+            timer.uninstall()
+        return timer
+
+    def test_step_definitions(self):
+        timer = self.run_feature(TestRunner(_givens, _whens, _thens), TextReporter(StringIO()))
+        totals = timer.totals()
+        sleeps = [totals[name] for name in totals if "timed_sleep" in name]
+        returns = [totals[name] for name in totals if "timed_return" in name]
+        self.assertEqual([calls for (calls, wall, cpu) in sleeps + returns], [1, 3])
+        self.assertTrue(sleeps[0][1] >= 0.05)
+        self.assertTrue(returns[0][1] < 0.05)
+        self.assertTrue(any(name.startswith("When timed step sleeps") for name in totals))
+        self.assertTrue(any(name.startswith("When timed step does nothing / Then timed step returns")
+                            for name in totals))
+
+    def test_slowest_scenarios(self):
+        timer = StepTimer()
+        reporter = DurationsReporter(TextReporter(StringIO()), timer, 1)
+        runner = ThreadedTestRunner(_givens, _whens, _thens, 2, reporter)
+        self.run_feature(runner, reporter)
+        self.assertEqual(reporter.scenarios, 2)
+        self.assertEqual([name for (duration, name) in reporter.slowest], [u"timed: slow"])
+        self.assertTrue(reporter.scenario_time >= 0.05)
+
+    def test_not_timed_unless_installed(self):
+        timer = StepTimer()
+        run_visitor(parse(self.feature), TestRunner(_givens, _whens, _thens), StringIO(), False)
+        self.assertEqual(timer.totals(), {})
+
+class TestProfiling(unittest.TestCase):
+    feature = TestDurations.feature
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_feature(self, granularity, merged_file=None, threads=1):
+        profiles = Profiles(self.directory, merged_file)
+        step_profiler = StepProfiler() if granularity == 'step' else None
+        reporter = ProfilingReporter(TextReporter(StringIO()), profiles, granularity, step_profiler)
+        if threads > 1:
+            runner = ThreadedTestRunner(_givens, _whens, _thens, threads, reporter)
+        else:
+            runner = TestRunner(_givens, _whens, _thens)
+        if step_profiler is not None:
+            step_profiler.install()
+        try:
+            run_visitor(parse(self.feature), runner, reporter.stream, False, reporter)
+            reporter.finish()
+        finally:
+            if step_profiler is not None:
+                step_profiler.uninstall()
+        return [os.path.basename(path) for path in profiles.finish()]
+
+    def functions(self, name):
+        stats = pstats.Stats(os.path.join(self.directory, name))
+        return set(function for (filename, line, function) in stats.stats)
+
+    def test_scenarios(self):
+        written = self.run_feature('scenario', threads=2)
+        self.assertEqual(written, ["timed-slow.pstats", "timed-fast.pstats"])
+        self.assertTrue("timed_sleep" in self.functions("timed-slow.pstats"))
+        self.assertFalse("timed_sleep" in self.functions("timed-fast.pstats"))
+
+    def test_feature(self):
+        self.assertEqual(self.run_feature('feature'), ["timed.pstats"])
+        self.assertTrue(set(["timed_sleep", "timed_return"]) <= self.functions("timed.pstats"))
+
+    def test_steps(self):
+        written = self.run_feature('step')
+        self.assertEqual(len(written), 2)
+        [sleep] = [name for name in written if name.startswith("when-timed-step-sleeps")]
+        functions = self.functions(sleep)
+        self.assertTrue("timed_sleep" in functions)
+        # Only the step code is profiled, not the visitors
+        self.assertFalse("walk" in functions)
+
+    def test_merged(self):
+        merged_file = os.path.join(self.directory, "merged.pstats")
+        self.assertEqual(self.run_feature('scenario', merged_file),
+                         ["merged.pstats"])
+        self.assertTrue(set(["timed_sleep", "timed_return"]) <= self.functions("merged.pstats"))
+
+leaked = []
+
+@When(r"memory step leaks (\d+) lists")
+def memory_leak(count):
+    leaked.append([[] for i in range(int(count))])
+
+class TestMemory(unittest.TestCase):
+    feature = ("Feature: memory\n"
+               "  Scenario: leaks\n    When memory step leaks 2000 lists\n    Then timed step returns\n"
+               "  Scenario: keeps nothing\n    When timed step does nothing\n    Then timed step returns\n")
+
+    def tearDown(self):
+        del leaked[:]
+
+    def test_growth(self):
+        reporter = MemoryReporter(TextReporter(StringIO()), ObjectSnapshots(), top=1)
+        run_visitor(parse(self.feature), TestRunner(_givens, _whens, _thens), reporter.stream, False, reporter)
+        self.assertEqual(reporter.scenarios, 2)
+        [(name, growth, places)] = reporter.grown
+        self.assertEqual(name, u"memory: leaks")
+        self.assertTrue(growth > 2000 * sys.getsizeof([]))
+        [(size, count, place)] = places
+        self.assertEqual(place, "__builtin__.list objects")
+        self.assertTrue(count >= 2000)
+
+class TestHistory(unittest.TestCase):
+    feature = TestReporters.feature
+
+    def setUp(self):
+        self.givens, self.whens, self.thens = [], [], []
+        create_collector(self.whens)(r"something")(lambda: None)
+        create_collector(self.whens)(r"something breaks")(TestReporters.breaks.im_func)
+        create_collector(self.thens)(r"it works")(lambda: None)
+        self.history = History(":memory:")
+
+    def tearDown(self):
+        self.history.close()
+
+    def runner(self):
+        return TestRunner(self.givens, self.whens, self.thens)
+
+    def record(self, runner, reporter):
+        self.history.start_run()
+        run_visitor(parse(self.feature), runner, reporter.stream, False, reporter)
+        reporter.finish()
+
+    def test_records_scenarios_and_steps(self):
+        reporter = HistoryReporter(TextReporter(StringIO()), self.history, ["features/./reported.feature"])
+        self.record(self.runner(), reporter)
+        durations = self.history.durations(self.history.runs(1))
+        self.assertEqual(sorted((scenario, [result for (run, result, duration) in runs])
+                                for ((feature, scenario), runs) in durations.items()),
+                         [(u"fails", ["failed"]), (u"outline", ["succeeded"]), (u"outline |b|", ["succeeded"]),
+                          (u"passes", ["succeeded"])])
+        self.assertEqual(set(feature for (feature, scenario) in durations), set([u"features/reported.feature"]))
+        steps = self.history.connection.execute("SELECT step, result FROM steps ORDER BY scenario, position").fetchall()
+        self.assertTrue((u"When something breaks", u"failed") in steps)
+        self.assertTrue((u"Then it works", u"skipped") in steps)
+        (succeeded,) = self.history.connection.execute("SELECT succeeded FROM runs").fetchone()
+        self.assertEqual(succeeded, 0)
+
+    def test_threaded_matches_serial(self):
+        reporter = HistoryReporter(TextReporter(StringIO()), self.history, ["reported.feature"])
+        self.record(self.runner(), reporter)
+        reporter = HistoryReporter(TextReporter(StringIO()), self.history, ["reported.feature"])
+        self.record(ThreadedTestRunner(self.givens, self.whens, self.thens, 3, reporter), reporter)
+        rows = self.history.connection.execute(
+            "SELECT run, feature, scenario, result FROM scenarios ORDER BY id").fetchall()
+        [serial, threaded] = [[row[1:] for row in rows if row[0] == run] for run in [1, 2]]
+        self.assertEqual(serial, threaded)
+
+    def test_regressions(self):
+        for durations in [(1.0, 0.5), (1.2, 0.5), (1.1, 0.5), (1.5, 0.52)]:
+            self.history.start_run()
+            self.history.add(u"a.feature", u"slower", "succeeded", durations[0], [])
+            self.history.add(u"a.feature", u"steady", "succeeded", durations[1], [])
+            self.history.end_run(True)
+        found = trends(self.history, runs=3, threshold=0.2)
+        self.assertEqual([(trend.scenario, trend.baseline, trend.regressed) for trend in found],
+                         [(u"slower", 1.1, True), (u"steady", 0.5, False)])
+        out = StringIO()
+        self.assertEqual(write_trends(out, found, 3, regressions_only=True), 1)
+        self.assertTrue("a.feature: slower  REGRESSED" in out.getvalue())
+        self.assertFalse("steady" in out.getvalue())
+        # Too small a slowdown doesn't count, however large in proportion
+        self.assertFalse(any(trend.regressed for trend in trends(self.history, 3, 0.2, min_change=1.0)))
+
+class TestSharding(unittest.TestCase):
+    helper = os.path.join(os.path.dirname(os.path.abspath(__file__)), "helper")
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_shard(self):
+        self.assertEqual(shard("2/3"), (1, 3))
+        for text in ["0/3", "4/3", "3", "a/b"]:
+            self.assertRaises(ValueError, shard, text)
+
+    def test_partition_by_count(self):
+        self.assertEqual(partition(range(7), 3), [[0, 3, 6], [1, 4], [2, 5]])
+
+    def test_partition_by_duration(self):
+        expected = {"a": 10.0, "b": 1.0, "c": 1.0, "d": 1.0, "e": 7.0}
+        self.assertEqual(partition(list("abcde"), 2, expected), [["a"], ["b", "c", "d", "e"]])
+        # Units without a duration are expected to take the median
+        self.assertEqual(partition(list("abcdef"), 2, expected), [["a", "f"], ["b", "c", "d", "e"]])
+
+    def test_shard_features(self):
+        features = [("one.feature", parse(TestReporters.feature)), ("two.feature", parse(TestDurations.feature))]
+        shards = [shard_features(features, index, 3) for index in range(3)]
+        self.assertEqual([[(path, [scenario.text for scenario in feature.scenarios]) for (path, feature) in selected]
+                          for selected in shards],
+                         [[("one.feature", [u"passes"]), ("two.feature", [u"slow"])],
+                          [("one.feature", [u"fails"]), ("two.feature", [u"fast"])],
+                          [("one.feature", [u"outline"])]])
+        self.assertEqual(shards[0][1][1].text, u"timed")
+
+    def test_shard_features_by_history(self):
+        history_file = os.path.join(self.directory, "history.sqlite")
+        history = History(history_file)
+        history.start_run()
+        for (path, scenario, duration) in [("one.feature", u"passes", 5.0), ("one.feature", u"fails", 1.0),
+                                           ("one.feature", u"outline", 1.0), ("one.feature", u"outline |b|", 1.0),
+                                           ("two.feature", u"slow", 1.0), ("two.feature", u"fast", 1.0)]:
+            history.add(path, scenario, "succeeded", duration, [])
+        history.end_run(True)
+        history.close()
+        features = [("./one.feature", parse(TestReporters.feature)), ("two.feature", parse(TestDurations.feature))]
+        self.assertEqual([[scenario.text for (path, feature) in shard_features(features, index, 2, history_file)
+                           for scenario in feature.scenarios] for index in range(2)],
+                         [[u"passes"], [u"fails", u"outline", u"slow", u"fast"]])
+
+    def run_command(self, *args):
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        command = [sys.executable, "-m", "pycucumber.runner"] + list(args)
+        process = subprocess.Popen(command, cwd=self.helper, env=environment,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process.communicate()
+        return process.returncode
+
+    def test_shards_merge_to_whole_run(self):
+        features = sorted(glob.glob(os.path.join(self.helper, "features", "*.feature")))
+        whole = os.path.join(self.directory, "whole.jsonl")
+        self.run_command("rules/simple.py", "run", "--no-cache", "--format", "jsonl", "--report", whole, *features)
+        reports = [os.path.join(self.directory, "shard%d.jsonl" % index) for index in range(3)]
+        for (index, report) in enumerate(reports):
+            self.run_command("rules/simple.py", "run", "--no-cache", "--shard", "%d/3" % (index + 1),
+                             "--format", "jsonl", "--report", report, *features)
+        merged = os.path.join(self.directory, "merged.jsonl")
+        self.assertEqual(self.run_command("merge", "--report", merged, *reports), 1)
+        def outcomes(path):
+            return sorted((record['feature'], record['scenario'], record['row'], record['result'])
+                          for record in read_records([path]))
+        self.assertEqual(outcomes(merged), outcomes(whole))
+        self.assertTrue(all(os.path.getsize(report) for report in reports))
+
+    def test_merge_restores_order_of_features_alike(self):
+        text = ("Feature: Alike\n  Scenario: first\n    When pass\n    Then pass\n"
+                "  Scenario: second\n    When var:pass\n    Then var:pass\n\n"
+                "    More Examples:\n      | input1 | input2 |\n      | pass   | pass   |\n"
+                "  Scenario: third\n    When pass\n    Then pass\n")
+        features = [os.path.join(self.directory, name, "alike.feature") for name in ["a", "b"]]
+        for path in features:
+            os.mkdir(os.path.dirname(path))
+            with open(path, "w") as feature:
+                feature.write(text)
+        features.insert(1, os.path.join(self.helper, "features", "success.feature"))
+        whole = os.path.join(self.directory, "whole.jsonl")
+        self.run_command("rules/simple.py", "run", "--no-cache", "--format", "jsonl", "--report", whole, *features)
+        reports = [os.path.join(self.directory, "shard%d.jsonl" % index) for index in range(2)]
+        for (index, report) in enumerate(reports):
+            self.run_command("rules/simple.py", "run", "--no-cache", "--shard", "%d/2" % (index + 1),
+                             "--format", "jsonl", "--report", report, *features)
+        merged = os.path.join(self.directory, "merged.jsonl")
+        self.assertEqual(self.run_command("merge", "--report", merged, *reports), 0)
+        def outcomes(path):
+            with open(path) as report:
+                return [(record['path'], record['position'], record['scenario'], record['row'], record['result'])
+                        for record in (json.loads(line) for line in report)]
+        self.assertEqual(outcomes(merged), outcomes(whole))
+        self.assertEqual([(record[0], record[2]) for record in outcomes(merged)],
+                         [(features[0], u"first"), (features[0], u"second"), (features[0], u"second"),
+                          (features[0], u"third"), (features[1], u""), (features[2], u"first"),
+                          (features[2], u"second"), (features[2], u"second"), (features[2], u"third")])
+
+class TestDistributed(unittest.TestCase):
+    helper = os.path.join(os.path.dirname(os.path.abspath(__file__)), "helper")
+    feature_text = ("Feature: Distributed\n  As a tester\n  I want units\n  In order to test\n"
+                    "  Scenario: first\n    When pass\n    Then pass\n"
+                    "  Scenario: second\n    When pass\n    Then pass\n")
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.address = "unix:" + os.path.join(self.directory, "coordinator.sock")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address("unix:run.sock"), (socket.AF_UNIX, "run.sock"))
+        self.assertEqual(parse_address("/tmp/run.sock"), (socket.AF_UNIX, "/tmp/run.sock"))
+        self.assertEqual(parse_address("8765"), (socket.AF_INET, ("127.0.0.1", 8765)))
+        self.assertEqual(parse_address("host:8765"), (socket.AF_INET, ("host", 8765)))
+
+    def test_is_loopback(self):
+        self.assertTrue(is_loopback(self.address))
+        self.assertTrue(is_loopback("8765"))
+        self.assertTrue(is_loopback("localhost:8765"))
+        self.assertFalse(is_loopback("0.0.0.0:8765"))
+
+    def worker(self):
+        connection = connect(self.address, 5)
+        self.assertEqual(receive(connection)[0], 'features')
+        return connection
+
+    def test_requeues_unit_of_dead_worker(self):
+        coordinator = Coordinator([parse(self.feature_text)], self.address, ('text', False))
+        coordinator.serve()
+        try:
+            # The first worker goes without answering for its unit
+            dead = self.worker()
+            (kind, index, unit) = receive(dead)
+            self.assertEqual(unit, [0, 0, None])
+            dead.close()
+            worker = self.worker()
+            ran = []
+            while True:
+                message = receive(worker)
+                if message[0] == 'done':
+                    break
+                ran.append(message[2])
+                send(worker, ('result', message[1], "ran %d\n" % message[1], True, None))
+            worker.close()
+            self.assertEqual(ran, [[0, 0, None], [0, 1, None]])
+            self.assertEqual([result for (unit, result) in coordinator.results_in_order()],
+                             [("ran 0\n", True, None), ("ran 1\n", True, None)])
+            self.assertEqual(coordinator.attempts, [2, 1])
+        finally:
+            coordinator.close()
+        self.assertFalse(os.path.exists(parse_address(self.address)[1]))
+
+    def test_gives_up_after_attempts(self):
+        coordinator = Coordinator([parse(self.feature_text)], self.address, ('text', False), attempts=1)
+        coordinator.serve()
+        try:
+            dead = self.worker()
+            receive(dead)
+            dead.close()
+            worker = self.worker()
+            message = receive(worker)
+            send(worker, ('result', message[1], "", True, None))
+            self.assertEqual(receive(worker), ['done'])
+            results = [result for (unit, result) in coordinator.results_in_order()]
+            self.assertFalse(results[0][1])
+            self.assertTrue("Lost" in results[0][0])
+            self.assertTrue(results[1][1])
+        finally:
+            coordinator.close()
+
+    def test_requeues_unit_of_worker_sending_garbage(self):
+        coordinator = Coordinator([parse(self.feature_text)], self.address, ('text', False))
+        coordinator.serve()
+        try:
+            garbage = self.worker()
+            receive(garbage)
+            garbage.sendall(LENGTH.pack(6) + "cos\nsy")
+            # The coordinator hangs up on it, and hands its unit on
+            self.assertEqual(garbage.recv(1), "")
+            garbage.close()
+            worker = self.worker()
+            while True:
+                message = receive(worker)
+                if message[0] == 'done':
+                    break
+                send(worker, ('result', message[1], "", True, None))
+            worker.close()
+            self.assertEqual(coordinator.attempts, [2, 1])
+        finally:
+            coordinator.close()
+
+    def run_command(self, *args):
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        command = [sys.executable, "-m", "pycucumber.runner"] + list(args)
+        process = subprocess.Popen(command, cwd=self.helper, env=environment,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process.communicate()
+        return process.returncode
+
+    def test_refuses_remote_workers_unless_allowed(self):
+        feature = os.path.join(self.helper, "features", "success.feature")
+        self.assertEqual(self.run_command("rules/simple.py", "run", "--no-cache", "--coordinator", "0.0.0.0:0",
+                                          feature), 2)
+
+    def test_local_workers_match_serial_run(self):
+        features = sorted(glob.glob(os.path.join(self.helper, "features", "*.feature")))
+        serial = os.path.join(self.directory, "serial.jsonl")
+        self.run_command("rules/simple.py", "run", "--no-cache", "--format", "jsonl", "--report", serial, *features)
+        coordinated = os.path.join(self.directory, "coordinated.jsonl")
+        self.assertEqual(self.run_command("rules/simple.py", "run", "--no-cache", "--coordinator", self.address,
+                                          "--local-workers", "2", "--format", "jsonl", "--report", coordinated,
+                                          *features), 1)
+        def outcomes(path):
+            with open(path) as report:
+                return [(record['feature'], record['scenario'], record['row'], record['result'])
+                        for record in map(json.loads, report)]
+        self.assertEqual(outcomes(coordinated), outcomes(serial))
+
+class TestDaemon(unittest.TestCase):
+    package_parent = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    rules_text = ("from pycucumber import When, Then\n"
+                  "@When('pass')\n@Then('pass')\ndef succeed():\n    %s\n")
+    feature_text = ("Feature: Served\n  As a tester\n  I want a daemon\n  In order to test\n"
+                    "  Scenario: served\n    When pass\n    Then pass\n")
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.rules = os.path.join(self.directory, "served_rules.py")
+        self.write_rules("pass", 0)
+        with open(os.path.join(self.directory, "served.feature"), "w") as feature:
+            feature.write(self.feature_text)
+        self.socket = os.path.join(self.directory, "serve.sock")
+        self.environment = dict(os.environ)
+        self.environment['PYTHONPATH'] = self.package_parent
+        self.daemon = subprocess.Popen([sys.executable, "-m", "pycucumber.runner", self.rules, "serve",
+                                        "--socket", self.socket], cwd=self.directory, env=self.environment,
+                                       stderr=subprocess.PIPE)
+        # The daemon says so once it is listening
+        self.assertTrue(self.daemon.stderr.readline().startswith("serving on"))
+
+    def tearDown(self):
+        if self.daemon.poll() is None:
+            self.daemon.terminate()
+            self.daemon.wait()
+        shutil.rmtree(self.directory)
+
+    def write_rules(self, body, age):
+        with open(self.rules, "w") as rules:
+            rules.write(self.rules_text % body)
+        # Make sure the modification time changes, however coarse it is
+        modified = time.time() - age
+        os.utime(self.rules, (modified, modified))
+
+    def request(self, *args):
+        process = subprocess.Popen([sys.executable, os.path.join(self.package_parent, "pycucumber", "client.py"),
+                                    "--socket", self.socket] + list(args),
+                                   cwd=self.directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = process.communicate()
+        return (process.returncode, out, err)
+
+    def test_runs_and_reloads_rules(self):
+        (status, out, err) = self.request("run", "--no-cache", "served.feature")
+        self.assertEqual(status, 0)
+        self.assertTrue("Then pass (Succeeded)" in out)
+        self.write_rules("assert False", -10)
+        (status, out, err) = self.request("run", "--no-cache", "served.feature")
+        self.assertEqual(status, 1)
+        self.assertTrue("When pass (Failed" in out)
+        self.assertTrue("reloaded served_rules.py" in err)
+        # The definitions of the first load are gone
+        (status, out, err) = self.request("list")
+        self.assertEqual(out.count("When pass"), 1)
+
+    def test_refuses_standard_input(self):
+        (status, out, err) = self.request("run", "--interactive", "served.feature")
+        self.assertEqual(status, 2)
+        self.assertTrue("standard input" in err)
+
+    def test_answers_malformed_requests_and_keeps_serving(self):
+        for (channel, data) in [(REQUEST, "{not json"), (REQUEST, "[]"), (REQUEST, '{"argv": "run", "cwd": "."}'),
+                                (REQUEST, '{"argv": ["list"]}'), (OUTPUT, "")]:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(self.socket)
+            try:
+                send_frame(connection, channel, data)
+                (error, message) = receive_frame(connection)
+                self.assertEqual(error, ERROR)
+                self.assertTrue("malformed request" in message)
+                self.assertEqual(receive_frame(connection), (EXIT, "2"))
+            finally:
+                connection.close()
+        (status, out, err) = self.request("list")
+        self.assertEqual(status, 0)
+        self.assertTrue("When pass" in out)
+
+    def test_removes_socket_when_terminated(self):
+        self.daemon.terminate()
+        self.daemon.wait()
+        self.assertFalse(os.path.exists(self.socket))
+        (status, out, err) = self.request("list")
+        self.assertEqual(status, 2)
+
 class TestMisc(unittest.TestCase):
     def test_override(self):
         self.assertEqual(list(override([1,2,3], [4,5,6,7,8])), [1,2,3,7,8])
@@ -0,0 +1,87 @@
+"""Running the scenarios of a feature concurrently on a pool of threads.
+
+Useful when steps spend most of their time waiting on I/O. Scenarios must
+be independent of each other, and any scenario context managers must be
+safe to enter from several threads at once. The threads share the step
+indexes (see step_matcher), which lock around their caches."""
+
+from __future__ import with_statement
+
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+from ast_visitors import TestRunner
+from events import Event, SCENARIO_END
+from reporters import TextReporter
+from output import CapturedOutput
+from walker import walk
+import core
+
+class ThreadOutput(object):
+    """Stands in for sys.stdout while scenarios run, sending whatever a
+    thread prints to that thread's buffer, if it has one"""
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def target(self):
+        return getattr(self.local, 'buffer', self.stream)
+
+    def write(self, text):
+        self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    # print keeps track of whether it owes a space in the softspace
+    # attribute of the file, which has to be per thread as well
+    def get_softspace(self):
+        return getattr(self.target(), 'softspace', 0)
+    def set_softspace(self, value):
+        self.target().softspace = value
+    softspace = property(get_softspace, set_softspace)
+
+class ThreadedTestRunner(TestRunner):
+    """A TestRunner that runs the scenarios of a feature on a pool of threads,
+    each with its own ExecutionContext. The output of each scenario,
+    including what its steps print, is written to a buffer by a copy of
+    reporter (by default, a TextReporter), and the buffers are written out
+    in order"""
+    def __init__(self, conditions, actions, results, threads, reporter=None):
+        TestRunner.__init__(self, conditions, actions, results)
+        self.threads = threads
+        self.reporter = TextReporter(sys.stdout) if reporter is None else reporter
+
+    def run_buffered(self, feature, scenario, context, output):
+        output.local.buffer = CapturedOutput()
+        reporter = self.reporter.copy(output, feature)
+        try:
+            core.run_events(walk(self.visitScenario(scenario, context)), output, False, reporter)
+            return (scenario, output.local.buffer.getvalue(), reporter.summary())
+        finally:
+            del output.local.buffer
+
+    def visitFeatureChildren(self, feature, context):
+        with context.indenter:
+            yield self.visitHeader(feature, context)
+
+            output = ThreadOutput(sys.stdout)
+            pool = ThreadPool(self.threads)
+            sys.stdout = output
+            try:
+                run = lambda scenario: self.run_buffered(feature, scenario, context.nested(), output)
+                for (scenario, text, summary) in pool.imap(run, feature.scenarios):
+                    self.reporter.merge(summary)
+                    yield text
+                    yield Event(SCENARIO_END, scenario)
+                pool.close()
+            finally:
+                sys.stdout = output.stream
+                pool.terminate()
+                pool.join()
+
+def ThreadedTest(text, threads, output_stream=sys.stdout, cache=None, reporter=None):
+    if reporter is None:
+        reporter = TextReporter(output_stream)
+    runner = ThreadedTestRunner(core._givens, core._whens, core._thens, threads, reporter)
+    return core.run_visitor(core.parse_text(text, cache), runner, output_stream, False, reporter)
@@ -0,0 +1,156 @@
+"""Timing step definitions and scenarios, for run --durations.
+
+A StepTimer, once installed, is called by call_test around every call of a
+step definition, and adds up the wall clock and CPU time spent in each one.
+A DurationsReporter stands in for the reporter of a run, timing each
+scenario, and ends the report with the slowest step definitions and
+scenarios, and how much of the time the scenarios took was spent in step
+definitions rather than in pycucumber itself.
+
+CPU time is that of the whole process, so it includes other threads when
+scenarios run on threads. Coroutine step definitions are only timed up to
+their first wait when scenarios run on a Scheduler."""
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import heapq
+import threading
+import ast_visitors
+import core
+from reporters import ScenarioReporter, describe_scenario
+
+class StepTimer(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        # fn -> [calls, wall, cpu]
+        self.steps = {}
+        # The same, by describe_definition, for timings from other processes
+        self.described = {}
+
+    def install(self):
+        ast_visitors.step_hooks.append(self)
+
+    def uninstall(self):
+        if self in ast_visitors.step_hooks:
+            ast_visitors.step_hooks.remove(self)
+
+    def start(self, fn):
+        return (time.time(), time.clock())
+
+    def stop(self, fn, started):
+        wall = time.time() - started[0]
+        cpu = time.clock() - started[1]
+        with self.lock:
+            totals = self.steps.get(fn)
+            if totals is None:
+                totals = self.steps[fn] = [0, 0.0, 0.0]
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu
+
+    def take(self):
+        """Return the timings so far by description, and start again from
+        nothing. Used to hand timings back from a worker process"""
+        with self.lock:
+            (steps, self.steps) = (self.steps, {})
+        return self.describe(steps)
+
+    def merge(self, described):
+        with self.lock:
+            add_totals(self.described, described)
+
+    def describe(self, steps):
+        described = {}
+        for (fn, totals) in steps.items():
+            add_totals(described, {describe_definition(fn): totals})
+        return described
+
+    def totals(self):
+        """Return [calls, wall, cpu] for each step definition by description"""
+        with self.lock:
+            described = self.describe(self.steps)
+            add_totals(described, self.described)
+        return described
+
+def add_totals(into, described):
+    for (name, totals) in described.items():
+        if name in into:
+            into[name] = [total + more for (total, more) in zip(into[name], totals)]
+        else:
+            into[name] = list(totals)
+
+def describe_definition(fn):
+    """Return the patterns fn is registered for, and its name"""
+    patterns = ["%s %s" % (prefix, regex.pattern[:-2] if regex.pattern.endswith(r"\Z") else regex.pattern)
+                for (bag, prefix) in [(core._givens, "Given"), (core._whens, "When"), (core._thens, "Then")]
+                for (regex, registered, names) in bag if registered is fn]
+    return "%s (%s.%s)" % (" / ".join(patterns) or "?", fn.__module__, fn.__name__)
+
+class DurationsReporter(ScenarioReporter):
+    """Times each scenario (and each example row), and adds the count
+    slowest step definitions and scenarios to the end of the report"""
+    def __init__(self, reporter, timer, count):
+        ScenarioReporter.__init__(self, reporter)
+        self.timer = timer
+        self.count = count
+        # A heap of the slowest (duration, name) so far
+        self.slowest = []
+        self.scenarios = 0
+        self.scenario_time = 0.0
+
+    def start_scenario(self, scenario, row):
+        return (scenario, row, time.time())
+
+    def end_scenario(self, current):
+        (scenario, row, started) = current
+        duration = time.time() - started
+        self.add_scenario(duration, describe_scenario(self.feature, scenario, row))
+        self.scenarios += 1
+        self.scenario_time += duration
+
+    def add_scenario(self, duration, name):
+        if len(self.slowest) < self.count:
+            heapq.heappush(self.slowest, (duration, name))
+        elif self.slowest and duration > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (duration, name))
+
+    def wrap(self, reporter):
+        return DurationsReporter(reporter, self.timer, self.count)
+
+    def own_summary(self):
+        # In a worker process, the step timings have to be handed back too
+        steps = self.timer.take() if os.getpid() != self.timer.pid else None
+        return (self.slowest, self.scenarios, self.scenario_time, steps)
+
+    def merge_own(self, summary):
+        (slowest, scenarios, scenario_time, steps) = summary
+        for (duration, name) in slowest:
+            self.add_scenario(duration, name)
+        self.scenarios += scenarios
+        self.scenario_time += scenario_time
+        if steps:
+            self.timer.merge(steps)
+
+    def finish(self):
+        self.reporter.finish()
+        write_durations(sys.stdout, self.timer.totals(), sorted(self.slowest, reverse=True),
+                        self.scenarios, self.scenario_time, self.count)
+        sys.stdout.flush()
+
+def write_durations(out, steps, slowest, scenarios, scenario_time, count):
+    print >> out
+    print >> out, "Slowest step definitions:"
+    ranked = sorted(steps.items(), key=lambda (name, totals): totals[1], reverse=True)[:count]
+    for (name, (calls, wall, cpu)) in ranked:
+        print >> out, "  %8.3fs wall %8.3fs cpu %7d calls  %s" % (wall, cpu, calls, name)
+    print >> out, "Slowest scenarios:"
+    for (duration, name) in slowest:
+        print >> out, (u"  %8.3fs  %s" % (duration, name)).encode('utf-8')
+    step_time = sum(wall for (calls, wall, cpu) in steps.values())
+    print >> out, "%d scenarios took %.3fs: %.3fs (%.1f%%) in step definitions, %.3fs in pycucumber" % (
+        scenarios, scenario_time, step_time, 100 * step_time / scenario_time if scenario_time else 0,
+        scenario_time - step_time)
@@ -0,0 +1,56 @@
+"""Explicit-stack traversal of Visitor generators.
+
+A visit method is a generator of events (text to print, callables to run,
+results, and so on). To visit a child node, it yields the generator of that
+child's visit, rather than forwarding each of the child's events itself.
+walk keeps the generators of the visits in progress on a stack, and delivers
+every event straight from the innermost visit to whatever is consuming the
+walk, so an event costs the same however deeply it is nested."""
+
+import sys
+from types import GeneratorType
+
+# Returned by next in place of raising StopIteration, which is much more
+# expensive to catch, when a visit is finished
+_finished = object()
+
+def walk(gen):
+    """Return a generator of the events of the visit generator gen and of all
+    the visits it yields, in order. A value sent to it is sent on to the visit
+    that produced the last event. A visit yielding a child visit resumes,
+    with None, once the child is finished. An exception raised by a child is
+    raised in its parent, as if the child had been called from it"""
+    stack = [gen]
+    value = None
+    exc_info = None
+    try:
+        while stack:
+            try:
+                if exc_info is not None:
+                    (exc_info, thrown) = (None, exc_info)
+                    event = stack[-1].throw(*thrown)
+                elif value is None:
+                    event = next(stack[-1], _finished)
+                else:
+                    event = stack[-1].send(value)
+            except StopIteration:
+                event = _finished
+            except:
+                stack.pop()
+                if not stack:
+                    raise
+                exc_info = sys.exc_info()
+                continue
+            if event is _finished:
+                stack.pop()
+                value = None
+            elif type(event) is GeneratorType:
+                stack.append(event)
+                value = None
+            else:
+                value = yield event
+    finally:
+        # If the walk is abandoned part way through, close the visits still in
+        # progress, innermost first, so that their with blocks are exited
+        while stack:
+            stack.pop().close()